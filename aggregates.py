@@ -0,0 +1,123 @@
+"""
+This module answers the common dashboard questions from the aggregate tables (see sql_queries.py) instead of
+the songplays fact table. The aggregates (daily plays by song, hourly plays by level, daily plays by user) are
+maintained incrementally by the refresh_aggregates node at the end of etl and incremental_load: only the
+songplays loaded since the last refresh are read.
+Each question is written once, over a source with the columns of its aggregate table: the router plugs in
+either the aggregate table or the same grouping computed from songplays (use_aggregates=False, e.g. to check the
+aggregates against the base tables).
+Contains the following functions:
+- base_source()
+- route()
+- ask()
+- main()
+
+Run e.g. 'python aggregates.py top_songs --start 2018-11-01 --limit 5' ('--local' for the local backend).
+"""
+import argparse
+import configparser
+from datetime import datetime
+
+from sql_queries import aggregate_tables
+
+QUESTIONS = {
+    'plays_per_hour': {
+        'aggregate': 'agg_hourly_level_plays',
+        'time_column': 'play_hour',
+        'query': "SELECT play_hour, level, SUM(plays) AS plays FROM {source} AS source {where} "
+                 "GROUP BY play_hour, level ORDER BY play_hour, level",
+    },
+    'top_songs': {
+        'aggregate': 'agg_daily_song_plays',
+        'time_column': 'play_day',
+        'query': "SELECT songs.song_id, songs.title, SUM(source.plays) AS plays FROM {source} AS source "
+                 "LEFT JOIN songs ON songs.song_key = source.song_key {where} "
+                 "GROUP BY songs.song_id, songs.title ORDER BY plays DESC, songs.song_id LIMIT {limit}",
+    },
+    'daily_active_users': {
+        'aggregate': 'agg_daily_user_plays',
+        'time_column': 'play_day',
+        'query': "SELECT play_day, level, COUNT(DISTINCT user_id) AS users FROM {source} AS source {where} "
+                 "GROUP BY play_day, level ORDER BY play_day, level",
+    },
+}
+
+
+def base_source(aggregate):
+    """
+    Returns the subquery computing the content of aggregate table 'aggregate' (string) from songplays.
+    """
+    spec = aggregate_tables[aggregate]
+    keys = ', '.join(spec['keys'])
+    return f"(SELECT {keys}, COUNT(*) AS plays FROM (SELECT {spec['key_expressions']} FROM (" \
+           f"SELECT start_time AS ts, user_id, COALESCE(level, 'unknown') AS level, song_key FROM songplays" \
+           f") AS songplays_keyed) AS keyed GROUP BY {keys})"
+
+
+def route(question, start=None, end=None, limit=10, use_aggregates=True):
+    """
+    Returns the query answering 'question' (string, a key of QUESTIONS) over the period from 'start' (included)
+    to 'end' (excluded) (ISO dates or timestamps as strings, optional), with at most 'limit' (int) rows for
+    top_songs. The query reads the aggregate table if use_aggregates (bool), songplays otherwise.
+    Raises ValueError for an unsupported question or an invalid date.
+    """
+    if question not in QUESTIONS:
+        raise ValueError(f"Unsupported question '{question}', use one of: {', '.join(QUESTIONS)}.")
+    spec = QUESTIONS[question]
+    source = spec['aggregate'] if use_aggregates else base_source(spec['aggregate'])
+    conditions = []
+    # Parsed, so that only valid timestamps are formatted into the query:
+    if start:
+        conditions.append(f"{spec['time_column']} >= TIMESTAMP '{datetime.fromisoformat(start)}'")
+    if end:
+        conditions.append(f"{spec['time_column']} < TIMESTAMP '{datetime.fromisoformat(end)}'")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return spec['query'].format(source=source, where=where, limit=int(limit)) + ";"
+
+
+def ask(run_query, question, start=None, end=None, limit=10, use_aggregates=True):
+    """
+    Answers 'question' (see route()) with run_query (function taking a query and returning its rows).
+    Returns the rows of the answer.
+    """
+    return run_query(route(question, start, end, limit, use_aggregates))
+
+
+def main():
+    """
+    Parses the command line and prints the answer to the question, from the cluster of dwh.cfg or from the
+    local backend with '--local'.
+    """
+    parser = argparse.ArgumentParser(description="Answers the dashboard questions from the aggregate tables.")
+    parser.add_argument('question', choices=list(QUESTIONS))
+    parser.add_argument('--start', help="first day or hour included (ISO format)")
+    parser.add_argument('--end', help="first day or hour excluded (ISO format)")
+    parser.add_argument('--limit', type=int, default=10, help="number of songs of top_songs")
+    parser.add_argument('--base', action='store_true', help="query songplays instead of the aggregates")
+    parser.add_argument('--local', action='store_true', help="query the local backend (section LOCAL)")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        run_query, close = backend.execute, backend.close
+    else:
+        from connection_manager import connect
+        conn = connect(config)
+
+        def run_query(query):
+            with conn.cursor() as cur:
+                cur.execute(query)
+                return cur.fetchall()
+        close = conn.close
+    try:
+        for row in ask(run_query, args.question, args.start, args.end, args.limit, not args.base):
+            print(*row, sep='\t')
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+This module benchmarks the pipeline stage by stage: for each scale, it generates a synthetic dataset
+(see data_generator.py), runs create_tables and etl on the local backend (see local_backend.py), times every
+step (drop, create, each COPY, each insert and upsert) and writes the results to a JSON file.
+Results can be compared to a previous run to catch regressions.
+Contains the following functions:
+- run_benchmark()
+- compare_results()
+- main()
+
+Run 'python benchmark.py --scales 10000,100000 --compare benchmarks/previous.json' to benchmark two scales
+and compare them with a previous run.
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import data_generator
+import local_backend
+
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000]
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+TABLES = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'time']
+
+
+def run_benchmark(config, scales, duplicate_rate=0.0, seed=0, data_dir=None):
+    """
+    Runs the pipeline on the local backend set in config (ConfigParser object) for each number of events
+    in 'scales' (list of int), on datasets generated with 'duplicate_rate' (float) and 'seed' (int) under
+    data_dir (string, a temporary directory by default).
+    Returns the list of results, one dictionary per scale (dataset, generation time, step timings, row counts).
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        for scale in scales:
+            output_dir = os.path.join(data_dir or temporary_dir, f"events-{scale}")
+            print(f"\nScale {scale} events: generating data in '{output_dir}'.")
+            start = time.perf_counter()
+            dataset = data_generator.generate_dataset(output_dir, scale, duplicate_rate=duplicate_rate, seed=seed)
+            generation_seconds = time.perf_counter() - start
+
+            backend = local_backend.get_backend(config)
+            try:
+                timings = local_backend.run_pipeline(backend, os.path.join(output_dir, 'log_data'),
+                                                     os.path.join(output_dir, 'song_data'))
+                row_counts = {table: backend.execute(f"SELECT COUNT(*) FROM {table}")[0][0] for table in TABLES}
+            finally:
+                backend.close()
+            results.append({'scale': scale, 'dataset': dataset, 'generation_seconds': generation_seconds,
+                            'timings': timings, 'total_seconds': sum(timings.values()), 'row_counts': row_counts})
+    return results
+
+
+def compare_results(results, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    Prints, for each scale and step present in both 'results' and 'baseline' (lists returned by
+    run_benchmark()), the ratio of the new duration to the baseline one. Steps slower than 'threshold'
+    (float) times the baseline are flagged.
+    Returns the list of regressions as (scale, step, ratio) tuples.
+    """
+    regressions = []
+    baseline_by_scale = {result['scale']: result for result in baseline}
+    for result in results:
+        previous = baseline_by_scale.get(result['scale'])
+        if previous is None:
+            continue
+        print(f"\nScale {result['scale']} events, compared to baseline:")
+        for step, seconds in result['timings'].items():
+            previous_seconds = previous['timings'].get(step)
+            if not previous_seconds:
+                continue
+            ratio = seconds / previous_seconds
+            flag = ''
+            if ratio > threshold:
+                regressions.append((result['scale'], step, ratio))
+                flag = '  \033[0;31m<- regression\033[0m'
+            print(f"- {step}: {previous_seconds:.2f}s -> {seconds:.2f}s (x{ratio:.2f}){flag}")
+    return regressions
+
+
+def main():
+    """
+    Parses the command line, runs the benchmark, writes the results to a JSON file and compares them to
+    a baseline if one is given. Exits with status 1 if a regression is found.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify pipeline stage by stage.")
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES),
+                        help="comma separated numbers of events (default 10000,100000,1000000)")
+    parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                        help="share of events and songs written twice (default 0.05)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default 0)")
+    parser.add_argument('--data-dir', default=None, help="keep the generated data in this directory")
+    parser.add_argument('--output', default=None, help="results file (default benchmarks/results-<time>.json)")
+    parser.add_argument('--compare', default=None, help="baseline results file to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="slowdown ratio flagged as a regression (default 1.2)")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    scales = [int(scale) for scale in args.scales.split(',')]
+    results = run_benchmark(config, scales, args.duplicate_rate, args.seed, args.data_dir)
+
+    output = args.output or os.path.join('benchmarks',
+                                         f"results-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump({'backend': config.get('LOCAL', 'backend', fallback='duckdb'), 'python': platform.python_version(),
+                   'results': results}, results_file, indent=2)
+    print(f"\nResults written to '{output}'.")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare_results(results, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+This module reloads the star schema without downtime (blue/green deployment). Instead of dropping the live
+tables, the tables are created and loaded into a shadow schema, on connections whose search_path is the shadow
+schema (the statements of sql_queries.py are not schema-qualified), while the live schema keeps serving reads.
+The row counts of the shadow tables are then validated and the schemas are swapped by renames in a single
+transaction: the live schema becomes the previous generation, kept for an instant rollback, and the shadow
+schema becomes the live one, the readers being granted access to it in the same transaction. Readers see either
+the old or the new tables, never a partial load.
+The live schema is the schema of the other modes (option cl_schema of section 'CLUSTER'), which must not be
+'public': Redshift can't move tables between schemas, only rename schemas. Analysts should query it (e.g. with
+ALTER USER ... SET search_path).
+Contains the following functions:
+- get_blue_green_settings()
+- schema_exists()
+- count_rows()
+- validate_shadow()
+- swap_statements()
+- rollback_statements()
+- build_shadow()
+- deploy()
+- rollback()
+- main()
+"""
+import argparse
+import configparser
+import re
+
+import checkpoints
+import create_tables
+import etl
+import instrumentation
+from connection_manager import ConnectionManager, DEFAULT_SCHEMA
+from sql_queries import schema_exists as schema_exists_query, schema_drop, schema_create, schema_rename, \
+    schema_table_count, table_exists, key_map_copy, song_key_table_create, artist_key_table_create
+from unit_of_work import get_retry_settings
+
+STAR_TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+# Surrogate key maps, carried over from the live schema so that the keys stay the same (see surrogate_keys.py):
+KEY_MAPS = {'song_keys': song_key_table_create, 'artist_keys': artist_key_table_create}
+DEFAULT_SETTINGS = {'shadow_schema': 'sparkify_next', 'previous_schema': 'sparkify_previous', 'min_row_ratio': 0.9}
+
+
+def get_blue_green_settings(config):
+    """
+    Returns the settings of section 'BLUE_GREEN' of config (ConfigParser object) as a dictionary: live_schema
+    (option cl_schema of section 'CLUSTER'), shadow_schema, previous_schema (strings) and min_row_ratio (float,
+    smallest accepted ratio between the row counts of the shadow and live tables).
+    Raises ValueError if a schema name is not a plain lowercase identifier or if two of them are the same.
+    """
+    settings = {'live_schema': config.get('CLUSTER', 'cl_schema', fallback=DEFAULT_SCHEMA)}
+    settings.update({key: config.get('BLUE_GREEN', key, fallback=DEFAULT_SETTINGS[key])
+                     for key in ['shadow_schema', 'previous_schema']})
+    for key, schema in settings.items():
+        if not re.fullmatch(r"[a-z_][a-z0-9_]*", schema) or schema == 'public':
+            option = 'cl_schema' if key == 'live_schema' else key
+            raise ValueError(f"Invalid {option} '{schema}': expected a lowercase identifier other than 'public'.")
+    if len(set(settings.values())) != 3:
+        raise ValueError("cl_schema, shadow_schema and previous_schema must be different.")
+    settings['min_row_ratio'] = config.getfloat('BLUE_GREEN', 'min_row_ratio',
+                                                fallback=DEFAULT_SETTINGS['min_row_ratio'])
+    return settings
+
+
+def schema_exists(cur, schema):
+    """
+    Returns True if schema 'schema' (string) exists.
+    """
+    cur.execute(schema_exists_query, (schema,))
+    return cur.fetchone()[0] > 0
+
+
+def count_rows(cur, schema, tables=STAR_TABLES):
+    """
+    Returns a dictionary mapping each table of 'tables' (list of strings) in schema 'schema' (string) to its
+    number of rows, counted with a single query.
+    """
+    cur.execute(" UNION ALL ".join(schema_table_count.format(schema=schema, table=table).strip()
+                                   for table in tables) + ";")
+    return {table: count for table, count in cur.fetchall()}
+
+
+def validate_shadow(cur, settings):
+    """
+    Compares the row counts of the star tables of the shadow schema with those of the live schema (if it
+    exists), 'settings' (dictionary) being the result of get_blue_green_settings().
+    Returns a tuple (shadow counts, live counts or None, list of problems, empty if the shadow schema can be
+    swapped in): an empty shadow table, or one with less than min_row_ratio times the rows of the live table.
+    """
+    shadow_counts = count_rows(cur, settings['shadow_schema'])
+    live_counts = count_rows(cur, settings['live_schema']) if schema_exists(cur, settings['live_schema']) else None
+    problems = []
+    for table, count in shadow_counts.items():
+        if count == 0:
+            problems.append(f"{settings['shadow_schema']}.{table} is empty")
+        elif live_counts and count < settings['min_row_ratio'] * live_counts[table]:
+            problems.append(f"{settings['shadow_schema']}.{table} has {count} rows, "
+                            f"{settings['live_schema']}.{table} {live_counts[table]}")
+    return shadow_counts, live_counts, problems
+
+
+def swap_statements(settings, live_exists, grants=()):
+    """
+    Returns the statements of the swap, to run in a single transaction: the previous generation is dropped,
+    the live schema (if 'live_exists', bool) becomes the previous generation and the shadow schema the live one,
+    then 'grants' (list of statements on the live schema) are run.
+    """
+    statements = [schema_drop.format(schema=settings['previous_schema'])]
+    if live_exists:
+        statements.append(schema_rename.format(schema=settings['live_schema'],
+                                               new_name=settings['previous_schema']))
+    statements.append(schema_rename.format(schema=settings['shadow_schema'], new_name=settings['live_schema']))
+    return statements + list(grants)
+
+
+def rollback_statements(settings, grants=()):
+    """
+    Returns the statements of the rollback, to run in a single transaction: the previous generation becomes
+    the live schema again and the rolled back generation becomes the shadow schema, then 'grants' (list of
+    statements on the live schema) are run.
+    """
+    return [schema_drop.format(schema=settings['shadow_schema']),
+            schema_rename.format(schema=settings['live_schema'], new_name=settings['shadow_schema']),
+            schema_rename.format(schema=settings['previous_schema'], new_name=settings['live_schema'])] + \
+        list(grants)
+
+
+def build_shadow(connections, config, settings, resume=False):
+    """
+    Creates the shadow schema (dropping a leftover one, unless 'resume' and it exists) with a copy of the key
+    maps of the live schema, on a connection of 'connections' (ConnectionManager object), then runs
+    create_tables and etl in it on a pool of its own, resuming a previous build of the shadow schema if
+    'resume' (bool, see checkpoints.py).
+    """
+    shadow = settings['shadow_schema']
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            resume = resume and schema_exists(cur, shadow)
+            live_maps = []
+            for table in KEY_MAPS:
+                cur.execute(table_exists, (settings['live_schema'], table))
+                if cur.fetchone()[0]:
+                    live_maps.append(table)
+        conn.commit()
+    if not resume:
+        statements = [schema_drop.format(schema=shadow), schema_create.format(schema=shadow)]
+        for table in live_maps:
+            statements += [KEY_MAPS[table].replace(f"EXISTS {table}(", f"EXISTS {shadow}.{table}("),
+                           key_map_copy.format(table=table, target_schema=shadow,
+                                               source_schema=settings['live_schema'])]
+        unit = connections.unit_of_work(connections.getconn(), **get_retry_settings(config))
+        try:
+            unit.run(statements)
+        finally:
+            connections.putconn(unit.conn)
+
+    shadow_connections = ConnectionManager.from_config(config, search_path=shadow)
+    try:
+        plan = checkpoints.prepare_run(shadow_connections, config, resume)
+        create_tables.main(shadow_connections, plan)
+        etl.main(shadow_connections, plan)
+    finally:
+        shadow_connections.print_summary()
+        shadow_connections.closeall()
+    print(f"Shadow schema '{shadow}' loaded.")
+
+
+def deploy(connections, config, resume=False):
+    """
+    Builds the star schema into the shadow schema (see build_shadow()), validates its row counts and swaps it
+    with the live schema in a single transaction, re-applying the grants of the readers, on connections of
+    'connections' (ConnectionManager object).
+    Raises ValueError if the validation fails: the live schema is left untouched and the shadow schema is kept
+    for inspection.
+    Returns the row counts of the new live tables (dictionary).
+    """
+    settings = get_blue_green_settings(config)
+    build_shadow(connections, config, settings, resume)
+
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            shadow_counts, live_counts, problems = validate_shadow(cur, settings)
+            live_exists = live_counts is not None
+        conn.commit()
+    for table, count in shadow_counts.items():
+        live = f" (live: {live_counts[table]})" if live_exists else ""
+        print(f"- {table}: {count} rows{live}")
+    if problems:
+        raise ValueError(f"Shadow schema '{settings['shadow_schema']}' not swapped in: {'; '.join(problems)}.")
+
+    unit = connections.unit_of_work(connections.getconn(), **get_retry_settings(config))
+    try:
+        unit.run(swap_statements(settings, live_exists, connections.grant_statements(settings['live_schema'])))
+    finally:
+        connections.putconn(unit.conn)
+    print(f"Schema '{settings['shadow_schema']}' swapped in as '{settings['live_schema']}'" +
+          (f", previous generation kept as '{settings['previous_schema']}'." if live_exists else "."))
+    return shadow_counts
+
+
+def rollback(connections, config):
+    """
+    Swaps the previous generation back in as the live schema, in a single transaction, on a connection of
+    'connections' (ConnectionManager object).
+    Raises ValueError if there is no previous generation.
+    """
+    settings = get_blue_green_settings(config)
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            exists = schema_exists(cur, settings['previous_schema']) and schema_exists(cur, settings['live_schema'])
+        conn.commit()
+    if not exists:
+        raise ValueError(f"No previous generation '{settings['previous_schema']}' to roll back to.")
+    unit = connections.unit_of_work(connections.getconn(), **get_retry_settings(config))
+    try:
+        unit.run(rollback_statements(settings, connections.grant_statements(settings['live_schema'])))
+    finally:
+        connections.putconn(unit.conn)
+    print(f"Rolled back: '{settings['previous_schema']}' is live again as '{settings['live_schema']}', "
+          f"the rolled back generation is kept as '{settings['shadow_schema']}'.")
+
+
+def main():
+    """
+    Parses the command line: builds and swaps in a new generation of the star schema, or rolls back to the
+    previous one with option --rollback.
+    """
+    parser = argparse.ArgumentParser(description="Blue/green reload of the star schema.")
+    parser.add_argument('--rollback', action='store_true', help="swap the previous generation back in")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume the previous build of the shadow schema (see checkpoints.py)")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    instrumentation.configure_from_config(config)
+    connections = ConnectionManager.from_config(config)
+    try:
+        if args.rollback:
+            rollback(connections, config)
+        else:
+            deploy(connections, config, args.resume)
+    finally:
+        connections.closeall()
+
+
+if __name__ == "__main__":
+    main()
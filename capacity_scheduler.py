@@ -0,0 +1,177 @@
+"""
+This module sizes the cluster to the data being loaded. Before the COPY and insert stages, it measures the
+bytes under the LOG_DATA and SONG_DATA prefixes and picks the number of nodes with which the load should finish
+within 'target_minutes', from a simple throughput model (each node loads 'mb_per_second_per_node' MB per
+second). The cluster is resized up if needed before the load, then resized back to num_nodes of section
+'CLUSTER', or paused, once the load is done, so that big backfills finish quickly and idle nodes don't cost
+money.
+Elastic resize (the default) takes minutes instead of hours but can only halve or double the number of
+nodes: the target is clamped to that range. Option resize_method = classic uses a classic resize instead
+(no range limit, but much slower, and the only one available under moto).
+All the functions take the boto3 clients as arguments so that they can run under moto.
+Contains the following functions:
+- get_capacity_settings()
+- measure_pending_bytes()
+- estimate_load_seconds()
+- choose_node_count()
+- resize_cluster()
+- resume_if_paused()
+- scale_for_load()
+- release_after_load()
+- run_with_capacity()
+"""
+import math
+import time
+
+import check_role_cluster as crc
+import provisioning
+from incremental_load import list_prefix
+
+DEFAULT_SETTINGS = {'mb_per_second_per_node': 20.0, 'target_minutes': 15.0, 'min_nodes': 2, 'max_nodes': 16,
+                    'after_load': 'resize', 'resize_method': 'elastic'}
+
+
+def get_capacity_settings(config):
+    """
+    Returns the settings of section 'CAPACITY' of config (ConfigParser object) as a dictionary:
+    mb_per_second_per_node, target_minutes (floats), min_nodes, max_nodes, baseline_nodes (ints, the latter
+    being num_nodes of section 'CLUSTER'), after_load ('resize', 'pause' or 'none'), resize_method ('elastic'
+    or 'classic'), waiter_delay, waiter_max_attempts and waiter (section 'PROVISIONING', see
+    provisioning.get_waiter_settings()).
+    """
+    waiter_settings = provisioning.get_waiter_settings(config)
+    return {
+        'mb_per_second_per_node': config.getfloat('CAPACITY', 'mb_per_second_per_node',
+                                                  fallback=DEFAULT_SETTINGS['mb_per_second_per_node']),
+        'target_minutes': config.getfloat('CAPACITY', 'target_minutes', fallback=DEFAULT_SETTINGS['target_minutes']),
+        'min_nodes': config.getint('CAPACITY', 'min_nodes', fallback=DEFAULT_SETTINGS['min_nodes']),
+        'max_nodes': config.getint('CAPACITY', 'max_nodes', fallback=DEFAULT_SETTINGS['max_nodes']),
+        'baseline_nodes': config.getint('CLUSTER', 'num_nodes'),
+        'after_load': config.get('CAPACITY', 'after_load', fallback=DEFAULT_SETTINGS['after_load']),
+        'resize_method': config.get('CAPACITY', 'resize_method', fallback=DEFAULT_SETTINGS['resize_method']),
+        'waiter_delay': waiter_settings['delay'],
+        'waiter_max_attempts': waiter_settings['max_attempts'],
+        'waiter': waiter_settings['waiter'],
+    }
+
+
+def measure_pending_bytes(s3_client, urls):
+    """
+    Returns the total size in bytes of the objects under the S3 urls 'urls' (list of strings).
+    """
+    return sum(sum(list_prefix(s3_client, url).values()) for url in urls)
+
+
+def estimate_load_seconds(pending_bytes, nodes, mb_per_second_per_node):
+    """
+    Returns the estimated duration in seconds of loading pending_bytes (int) on 'nodes' (int) nodes, each
+    loading mb_per_second_per_node (float) MB per second.
+    """
+    return pending_bytes / (nodes * mb_per_second_per_node * 1024 ** 2)
+
+
+def choose_node_count(pending_bytes, current_nodes, settings):
+    """
+    Returns the number of nodes to load pending_bytes (int) with: the smallest number of nodes finishing
+    within 'target_minutes', between min_nodes and max_nodes, never less than baseline_nodes. With elastic
+    resize, the target is kept between half and twice current_nodes (int).
+    'settings' (dictionary) is the result of get_capacity_settings().
+    """
+    target_seconds = settings['target_minutes'] * 60
+    nodes = math.ceil(pending_bytes / (settings['mb_per_second_per_node'] * 1024 ** 2 * target_seconds))
+    nodes = max(nodes, settings['min_nodes'], settings['baseline_nodes'])
+    nodes = min(nodes, settings['max_nodes'])
+    if settings['resize_method'] == 'elastic':
+        nodes = min(max(nodes, math.ceil(current_nodes / 2)), current_nodes * 2)
+    return nodes
+
+
+def resize_cluster(redshift_client, cluster_name, nodes, settings):
+    """
+    Resizes cluster 'cluster_name' (string) to 'nodes' (int) nodes with the resize method of 'settings'
+    (dictionary, see get_capacity_settings()) and waits for it to be available again.
+    Returns the number of nodes of the cluster once available.
+    """
+    print(f"Resizing cluster '{cluster_name}' to {nodes} node(s) ({settings['resize_method']} resize).")
+    if settings['resize_method'] == 'elastic':
+        redshift_client.resize_cluster(ClusterIdentifier=cluster_name, NumberOfNodes=nodes, Classic=False)
+    else:
+        redshift_client.modify_cluster(ClusterIdentifier=cluster_name, NumberOfNodes=nodes,
+                                       ClusterType='multi-node' if nodes > 1 else 'single-node')
+    provisioning.wait_until_available(redshift_client, cluster_name, settings['waiter_delay'],
+                                      settings['waiter_max_attempts'], settings['waiter'])
+    return crc.ClusterState(redshift_client, cluster_name).details['NumberOfNodes']
+
+
+def resume_if_paused(redshift_client, cluster_name, settings):
+    """
+    Resumes cluster 'cluster_name' (string) if it is paused and waits for it to be available.
+    Returns True if the cluster was paused, False otherwise.
+    """
+    if crc.ClusterState(redshift_client, cluster_name).status != 'paused':
+        return False
+    print(f"Cluster '{cluster_name}' is paused, resuming it.")
+    redshift_client.resume_cluster(ClusterIdentifier=cluster_name)
+    provisioning.wait_until_available(redshift_client, cluster_name, settings['waiter_delay'],
+                                      settings['waiter_max_attempts'], settings['waiter'])
+    return True
+
+
+def scale_for_load(redshift_client, s3_client, cluster_name, urls, settings):
+    """
+    Measures the bytes to load under 'urls' (list of S3 urls) and resizes cluster 'cluster_name' (string) up
+    if the load wouldn't finish within target_minutes on its current nodes. A paused cluster is resumed first.
+    Returns a dictionary: pending_bytes, nodes_before, nodes (during the load), estimated_seconds.
+    """
+    resume_if_paused(redshift_client, cluster_name, settings)
+    pending_bytes = measure_pending_bytes(s3_client, urls)
+    current_nodes = crc.ClusterState(redshift_client, cluster_name).details['NumberOfNodes']
+    nodes = choose_node_count(pending_bytes, current_nodes, settings)
+    print(f"{pending_bytes / 1024 ** 2:.1f} MB to load: {nodes} node(s) chosen "
+          f"(estimated load {estimate_load_seconds(pending_bytes, nodes, settings['mb_per_second_per_node']):.0f}s, "
+          f"cluster has {current_nodes}).")
+    if nodes > current_nodes:
+        nodes = resize_cluster(redshift_client, cluster_name, nodes, settings)
+    else:
+        nodes = current_nodes
+    return {'pending_bytes': pending_bytes, 'nodes_before': current_nodes, 'nodes': nodes,
+            'estimated_seconds': estimate_load_seconds(pending_bytes, nodes, settings['mb_per_second_per_node'])}
+
+
+def release_after_load(redshift_client, cluster_name, settings):
+    """
+    Releases the capacity of cluster 'cluster_name' (string) after the load, according to after_load of
+    'settings': 'resize' back to baseline_nodes, 'pause' the cluster, or 'none'.
+    Returns the action taken ('resized', 'paused' or None).
+    """
+    if settings['after_load'] == 'pause':
+        redshift_client.pause_cluster(ClusterIdentifier=cluster_name)
+        print(f"Cluster '{cluster_name}' paused. It will be resumed by the next load.")
+        return 'paused'
+    nodes = crc.ClusterState(redshift_client, cluster_name).details['NumberOfNodes']
+    if settings['after_load'] == 'resize' and nodes != settings['baseline_nodes']:
+        resize_cluster(redshift_client, cluster_name, settings['baseline_nodes'], settings)
+        return 'resized'
+    return None
+
+
+def run_with_capacity(redshift_client, s3_client, config, run):
+    """
+    Runs 'run' (function without arguments, e.g. the create_tables and etl stages) on a cluster sized for
+    the LOG_DATA and SONG_DATA of config (ConfigParser object), then releases the capacity, even if the run
+    fails.
+    Returns a dictionary: the result of scale_for_load() plus load_seconds and after_load (action taken).
+    """
+    settings = get_capacity_settings(config)
+    cluster_name = config.get('CLUSTER', 'cl_identifier')
+    urls = [config.get('S3', 'log_data'), config.get('S3', 'song_data')]
+    report = scale_for_load(redshift_client, s3_client, cluster_name, urls, settings)
+    start = time.perf_counter()
+    try:
+        run()
+    finally:
+        report['load_seconds'] = time.perf_counter() - start
+        report['after_load'] = release_after_load(redshift_client, cluster_name, settings)
+    print(f"Load done in {report['load_seconds']:.0f}s on {report['nodes']} node(s) "
+          f"(estimated {report['estimated_seconds']:.0f}s).")
+    return report
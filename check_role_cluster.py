@@ -7,10 +7,17 @@ Contains the following functions:
 - check_cluster_exists()
 - is_cluster_available()
 - check_cluster_status()
+- wait_for_cluster()
+and the following class:
+- ClusterState.
 """
+import random
+import time
 
 import botocore.exceptions as e
 
+DEFAULT_STATE_TTL = 5.0
+
 
 def get_role_details(client, role_name):
     """
@@ -61,33 +68,81 @@ def check_role_exists(client, role_name, details=False, **print_details):
     return True
 
 
-def get_cluster_details(client, cluster_name):
+class ClusterState:
     """
-    Fetch details/parameters for role 'role_name' (string) in client 'client' (iam client object)
-    List of details/parameters fetch: creation date, role id, role arn, role description.
-    Print the details.
+    State of cluster 'cluster_name' (string) in 'client' (botocore.client.Redshift object), served from a
+    single describe_clusters snapshot. The snapshot is cached for 'ttl' seconds (float): reading several
+    attributes in a row costs one API call, and the snapshot is refreshed on the first read after expiry.
+    Attributes: exists, status, endpoint, create_time, details (the raw describe_clusters entry).
     """
-    try:
-        client.describe_clusters(ClusterIdentifier=cluster_name)
-    except e.ClientError:
+    def __init__(self, client, cluster_name, ttl=DEFAULT_STATE_TTL):
+        self.client = client
+        self.cluster_name = cluster_name
+        self.ttl = ttl
+        self._cluster = None
+        self._taken_at = None
+
+    def refresh(self):
+        """
+        Takes a new describe_clusters snapshot. The snapshot is None if the cluster cannot be found.
+        """
+        try:
+            self._cluster = self.client.describe_clusters(ClusterIdentifier=self.cluster_name)['Clusters'][0]
+        except e.ClientError:
+            self._cluster = None
+        self._taken_at = time.monotonic()
+        return self._cluster
+
+    @property
+    def details(self):
+        if self._taken_at is None or time.monotonic() - self._taken_at > self.ttl:
+            self.refresh()
+        return self._cluster
+
+    @property
+    def exists(self):
+        return self.details is not None
+
+    @property
+    def status(self):
+        return self.details['ClusterStatus'] if self.exists else None
+
+    @property
+    def endpoint(self):
+        # Endpoint and ClusterCreateTime only exist once the cluster has been created, not while 'creating'.
+        if not self.exists or 'Endpoint' not in self.details:
+            return None
+        return self.details['Endpoint']['Address']
+
+    @property
+    def create_time(self):
+        return self.details.get('ClusterCreateTime') if self.exists else None
+
+
+def get_cluster_details(client, cluster_name, state=None):
+    """
+    Prints the details/parameters of cluster 'cluster_name' (string) in 'client' (botocore.client.Redshift
+    object): creation date, endpoint, DB name, username, status and zone.
+    'state' (ClusterState object, optional) is used instead of a new describe_clusters call.
+    """
+    state = state or ClusterState(client, cluster_name)
+    if not state.exists:
         print(f"Cluster {cluster_name} cannot be found.")
+        return
+    cluster = state.details
+    if state.status == 'creating':
+        print(f"Cluster {cluster_name} being created.")
     else:
-        cluster = client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
-        # If else required because ClusterCreateTime only exists once the cluster status is 'available'
-        # and not when 'creating'
-        if cluster['ClusterStatus'] == 'creating':
-            print(f"Cluster {cluster_name} being created.")
-        else:
-            print(
-                f"Cluster {cluster_name} exists, created on {cluster['ClusterCreateTime']}.\n"
-                f"Cluster endpoint: '{cluster['Endpoint']['Address']}'."
-            )
         print(
-            f"Cluster DB name: {cluster['DBName']}.\n"
-            f"Cluster username: {cluster['MasterUsername']}.\n"
-            f"Cluster status: {cluster['ClusterStatus']}.\n"
-            f"Cluster zone: {cluster['AvailabilityZone']}."
+            f"Cluster {cluster_name} exists, created on {state.create_time}.\n"
+            f"Cluster endpoint: '{state.endpoint}'."
         )
+    print(
+        f"Cluster DB name: {cluster['DBName']}.\n"
+        f"Cluster username: {cluster['MasterUsername']}.\n"
+        f"Cluster status: {state.status}.\n"
+        f"Cluster zone: {cluster['AvailabilityZone']}."
+    )
 
 
 def check_cluster_exists(client, cluster_name, details=False, **print_details):
@@ -108,16 +163,10 @@ def check_cluster_exists(client, cluster_name, details=False, **print_details):
     for key in print_details:
         if (key in keywords_triggers_printing) & (print_details[key] == True):
             details = True
-    try:
-        client.describe_clusters(ClusterIdentifier=cluster_name)
-    except e.ClientError:
-        if details:
-            print(f"Cluster {cluster_name} cannot be found.")
-        return False
-    else:
-        if details:
-            get_cluster_details(client, cluster_name)
-    return True
+    state = ClusterState(client, cluster_name)
+    if details:
+        get_cluster_details(client, cluster_name, state)
+    return state.exists
 
 
 def is_cluster_available(client, cluster_name):
@@ -131,15 +180,11 @@ def is_cluster_available(client, cluster_name):
     If cluster cannot be found, prints 'This cluster cannot be found.'
     Returns 1 if cluster cannot be found.
     """
-    try:
-        client.describe_clusters(ClusterIdentifier=cluster_name)
-    except e.ClientError:
+    state = ClusterState(client, cluster_name)
+    if not state.exists:
         print("This cluster cannot be found.")
         return 1
-    if client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]['ClusterStatus'] == 'available':
-        return True
-    else:
-        return False
+    return state.status == 'available'
 
 
 def check_cluster_status(client, cluster_name):
@@ -151,12 +196,33 @@ def check_cluster_status(client, cluster_name):
     If cluster cannot be found, prints 'This cluster cannot be found.'
     Returns 1 if the cluster cannot be found.
     """
-    try:
-        client.describe_clusters(ClusterIdentifier=cluster_name)
-        return client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]['ClusterStatus']
-    except e.ClientError:
+    state = ClusterState(client, cluster_name)
+    if not state.exists:
         print("This cluster cannot be found.")
         return 1
+    return state.status
+
+
+def wait_for_cluster(state, target_status='available', timeout=1800, initial_delay=5.0, max_delay=60.0):
+    """
+    Waits until the cluster of 'state' (ClusterState object) reaches 'target_status' (string), polling
+    with exponential backoff (from initial_delay to max_delay seconds, with jitter) for at most
+    'timeout' seconds. Prints each status change.
+    Returns the last status read: 'target_status' on success, another status (or None if the cluster
+    cannot be found) on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    state.refresh()
+    last_status = state.status
+    while last_status != target_status and time.monotonic() < deadline:
+        time.sleep(min(delay * random.uniform(0.5, 1.5), max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, max_delay)
+        state.refresh()
+        if state.status != last_status:
+            print(f"Waiting... cluster status: {state.status}.")
+        last_status = state.status
+    return last_status
 
 
 def main():
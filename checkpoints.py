@@ -0,0 +1,164 @@
+"""
+This module makes the runs of the pipeline resumable. Each stage (create_tables, each staging COPY, each insert
+and upsert) records a checkpoint in table pipeline_checkpoints, in the same transaction as the stage itself, with
+the fingerprint of its inputs: the statement, the fingerprints of the stages which wrote the tables it reads and,
+for the COPYs, the listing of their S3 prefix (keys and sizes).
+With --resume, a run skips create_tables if the DDL didn't change (the tables are kept instead of being dropped)
+and every stage whose checkpoint matches its current fingerprint, so a run which failed halfway only re-runs what
+didn't finish. A stage which has to run again although it completed before (its inputs changed) would append its
+rows twice: the run then restarts from create_tables.
+Re-creating the tables starts a new generation of checkpoints: the previous ones are deleted and the fingerprint
+of create_tables includes a new random id, which changes the fingerprint of every other stage.
+Contains the following functions:
+- fingerprint()
+- get_s3_client()
+- get_copy_fingerprints()
+- load_checkpoints()
+- plan_run()
+- checkpoint_query()
+- print_plan()
+- prepare_run()
+"""
+import hashlib
+import uuid
+
+import boto3
+
+import create_role_cluster as create_rc
+import incremental_load
+from sql_queries import (checkpoint_table_create, select_checkpoints, checkpoint_upsert, create_table_queries,
+                         drop_table_queries, etl_nodes)
+
+CREATE_TABLES_STAGE = 'create_tables'
+# S3 option of each COPY node, for the fingerprint of its input files:
+COPY_SOURCES = {'copy_staging_events': 'log_data', 'copy_staging_songs': 'song_data'}
+
+
+def fingerprint(*parts):
+    """
+    Returns the SHA-256 hexadecimal digest of 'parts' (strings).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+
+def get_s3_client(config):
+    """
+    Returns a boto3 S3 client for the region of config (ConfigParser object) and the credentials of aws-secret.cfg.
+    """
+    aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+    return boto3.client('s3', region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                        aws_secret_access_key=aws_cred.secret)
+
+
+def get_copy_fingerprints(s3_client, config):
+    """
+    Returns a dictionary mapping the name of each COPY node to the fingerprint of the objects (keys and sizes)
+    under its S3 prefix in section 'S3' of config (ConfigParser object), listed with s3_client (boto3 S3 client).
+    """
+    fingerprints = {}
+    for name, option in COPY_SOURCES.items():
+        objects = incremental_load.list_prefix(s3_client, config.get('S3', option).strip("'\""))
+        fingerprints[name] = fingerprint(*(f"{key}:{size}" for key, size in sorted(objects.items())))
+    return fingerprints
+
+
+def load_checkpoints(cur):
+    """
+    Creates table pipeline_checkpoints if needed and returns its content: a dictionary mapping each stage name to
+    a tuple (input fingerprint, output fingerprint).
+    """
+    cur.execute(checkpoint_table_create)
+    cur.execute(select_checkpoints)
+    return {stage: (input_fp.strip(), output_fp.strip()) for stage, input_fp, output_fp in cur.fetchall()}
+
+
+def plan_run(stored, resume, recreate_tables=True, copy_fingerprints=None, nodes=etl_nodes):
+    """
+    Returns the plan of a run: a dictionary mapping create_tables and the name of each node in 'nodes' (list of
+    dictionaries, see sql_queries.py) to a dictionary with keys input, output (fingerprints) and skip (bool).
+    'stored' (dictionary) are the checkpoints returned by load_checkpoints(), 'copy_fingerprints' (dictionary,
+    optional) the fingerprints of the COPY inputs returned by get_copy_fingerprints().
+    With 'resume' (bool), the stages whose checkpoint matches are skipped. Without 'recreate_tables' (bool), the
+    tables are used as they are: create_tables is always skipped (etl.py run on its own).
+    If a stage to run completed before with other inputs, the plan restarts from create_tables, or raises
+    ValueError without recreate_tables.
+    """
+    copy_fingerprints = copy_fingerprints or {}
+    ddl = fingerprint(*drop_table_queries, *create_table_queries)
+    previous = stored.get(CREATE_TABLES_STAGE)
+    if previous and previous[0] == ddl and (resume or not recreate_tables):
+        plan = {CREATE_TABLES_STAGE: {'input': ddl, 'output': previous[1], 'skip': True}}
+    elif not recreate_tables:
+        # Tables created without checkpoint: their generation is unknown, nothing can be skipped.
+        plan = {CREATE_TABLES_STAGE: {'input': ddl, 'output': fingerprint(ddl, 'unknown'), 'skip': True}}
+        resume = False
+    else:
+        plan = {CREATE_TABLES_STAGE: {'input': ddl, 'output': fingerprint(ddl, uuid.uuid4().hex), 'skip': False}}
+        resume = False
+
+    # Fingerprint of the stage which last wrote each table:
+    writers = {}
+    conflicts = []
+    for node in nodes:
+        parts = [node['query'], copy_fingerprints.get(node['name'], '')]
+        parts += [writers.get(table, plan[CREATE_TABLES_STAGE]['output']) for table in sorted(node['inputs'])]
+        node_fingerprint = fingerprint(*parts)
+        for table in node['outputs']:
+            writers[table] = node_fingerprint
+        skip = resume and stored.get(node['name'], (None,))[0] == node_fingerprint
+        if resume and not skip and node['name'] in stored:
+            conflicts.append(node['name'])
+        plan[node['name']] = {'input': node_fingerprint, 'output': node_fingerprint, 'skip': skip}
+
+    if conflicts:
+        if not recreate_tables:
+            raise ValueError(f"The inputs of completed stage(s) {', '.join(conflicts)} changed: "
+                             f"re-create the tables (run main.py or create_tables.py) instead of resuming.")
+        print(f"\033[0;33mThe inputs of completed stage(s) {', '.join(conflicts)} changed: "
+              f"restarting from create_tables.\033[0m")
+        return plan_run(stored, False, recreate_tables, copy_fingerprints, nodes)
+    return plan
+
+
+def checkpoint_query(plan, stage):
+    """
+    Returns the statement recording the checkpoint of 'stage' (string) of 'plan' (dictionary, see plan_run()),
+    to be run in the transaction of the stage.
+    """
+    return checkpoint_upsert.format(stage=stage, input_fingerprint=plan[stage]['input'],
+                                    output_fingerprint=plan[stage]['output'])
+
+
+def print_plan(plan):
+    """
+    Prints the stages of 'plan' (dictionary, see plan_run()) which are skipped, if any.
+    """
+    skipped = [stage for stage, step in plan.items() if step['skip']]
+    if plan[CREATE_TABLES_STAGE]['skip'] and len(skipped) > 1:
+        print(f"Resuming: {len(skipped) - 1} stage(s) already done with the same inputs, skipped: "
+              f"{', '.join(skipped[1:])}.")
+
+
+def prepare_run(connections, config, resume, recreate_tables=True):
+    """
+    Creates the schema of 'connections' (ConnectionManager object) if needed and reads the checkpoints with
+    one of its connections, fingerprints the S3
+    inputs if option fingerprint_s3 of section 'CHECKPOINT' of config (ConfigParser object) is set (the default),
+    and returns the plan of the run, see plan_run().
+    """
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            for query in connections.schema_statements():
+                cur.execute(query)
+            stored = load_checkpoints(cur)
+        conn.commit()
+    copy_fingerprints = None
+    if config.getboolean('CHECKPOINT', 'fingerprint_s3', fallback=True):
+        copy_fingerprints = get_copy_fingerprints(get_s3_client(config), config)
+    plan = plan_run(stored, resume, recreate_tables, copy_fingerprints)
+    print_plan(plan)
+    return plan
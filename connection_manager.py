@@ -0,0 +1,227 @@
+"""
+This module manages the connections to the cluster for a whole run of the pipeline. create_tables, etl and
+incremental_load used to rebuild the connection string from dwh.cfg and open their own connections, and the
+parallel stages opened a new pool each. A single ConnectionManager is now created by main.py and passed
+through all the stages: connections are opened lazily, on first use, at most 'max_connections' of them, and
+reused by the next stages. Threads asking for a connection while they are all in use wait for one to be
+given back.
+Every connection gets TCP keepalives, so that long COPYs aren't dropped by idle timeouts along the network
+path, and optionally a statement_timeout and a search_path. The search_path is the schema of option cl_schema
+of section 'CLUSTER' (or e.g. the shadow schema of blue_green.py): all the modes of the pipeline read and write
+the same schema, which the stages creating tables create if needed, granting read access on it to the users and
+groups of option cl_readers.
+Contains the following functions:
+- build_dsn()
+- get_connection_settings()
+- connect()
+and the following class:
+- ConnectionManager.
+"""
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+
+from sql_queries import schema_create_if_missing, schema_grant_usage, schema_grant_select
+from unit_of_work import UnitOfWork
+
+DEFAULT_SCHEMA = 'public'
+DEFAULT_MAX_CONNECTIONS = 5
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_KEEPALIVES_IDLE = 60
+DEFAULT_KEEPALIVES_INTERVAL = 15
+DEFAULT_KEEPALIVES_COUNT = 5
+
+
+def build_dsn(config):
+    """
+    Returns the connection string of the cluster described in section 'CLUSTER' of config (ConfigParser object).
+    """
+    cluster = config['CLUSTER']
+    return f"host={cluster['cl_endpoint']} dbname={cluster['cl_db_name']} user={cluster['cl_user']} " \
+           f"password={cluster['cl_password']} port={cluster['cl_port']}"
+
+
+def get_connection_settings(config):
+    """
+    Returns the connection settings from section 'CONNECTION' of config (ConfigParser object) as a dictionary
+    of keyword arguments for ConnectionManager: max_connections, statement_timeout (milliseconds, 0 for none),
+    connect_timeout (seconds), keepalives_idle, keepalives_interval (seconds) and keepalives_count, plus the
+    search_path (option cl_schema) and readers (option cl_readers, comma-separated) of section 'CLUSTER'.
+    """
+    readers = config.get('CLUSTER', 'cl_readers', fallback='')
+    return {
+        'max_connections': config.getint('CONNECTION', 'max_connections', fallback=DEFAULT_MAX_CONNECTIONS),
+        'statement_timeout': config.getint('CONNECTION', 'statement_timeout', fallback=0),
+        'connect_timeout': config.getint('CONNECTION', 'connect_timeout', fallback=DEFAULT_CONNECT_TIMEOUT),
+        'keepalives_idle': config.getint('CONNECTION', 'keepalives_idle', fallback=DEFAULT_KEEPALIVES_IDLE),
+        'keepalives_interval': config.getint('CONNECTION', 'keepalives_interval',
+                                             fallback=DEFAULT_KEEPALIVES_INTERVAL),
+        'keepalives_count': config.getint('CONNECTION', 'keepalives_count', fallback=DEFAULT_KEEPALIVES_COUNT),
+        'search_path': config.get('CLUSTER', 'cl_schema', fallback=DEFAULT_SCHEMA),
+        'readers': [reader.strip() for reader in readers.split(',') if reader.strip()],
+    }
+
+
+def connect(config):
+    """
+    Returns a new psycopg2 connection to the cluster of config (ConfigParser object), outside of any pool, with
+    the search_path of get_connection_settings(): for the scripts run on their own.
+    """
+    conn = psycopg2.connect(build_dsn(config))
+    with conn.cursor() as cur:
+        cur.execute(f"SET search_path TO {get_connection_settings(config)['search_path']}")
+    conn.commit()
+    return conn
+
+
+class ConnectionManager:
+    """
+    Pool of at most max_connections (int) connections to the database described by 'dsn' (string), opened
+    lazily with TCP keepalives (keepalives_idle, keepalives_interval in seconds, keepalives_count) and
+    connect_timeout (seconds). Each new connection gets statement_timeout (milliseconds, 0 for none) and
+    search_path (string, comma-separated schemas, optional), the first of which is the schema the tables are
+    created in. 'readers' (list of strings, users or 'GROUP name') are granted read access on it.
+    Thread-safe: getconn() waits when all the connections are in use.
+    """
+    def __init__(self, dsn, max_connections=DEFAULT_MAX_CONNECTIONS, statement_timeout=0,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, keepalives_idle=DEFAULT_KEEPALIVES_IDLE,
+                 keepalives_interval=DEFAULT_KEEPALIVES_INTERVAL, keepalives_count=DEFAULT_KEEPALIVES_COUNT,
+                 search_path=None, readers=()):
+        self.dsn = dsn
+        self.max_connections = max(1, max_connections)
+        self.statement_timeout = statement_timeout
+        self.search_path = search_path
+        self.schema = search_path.split(',')[0].strip() if search_path else DEFAULT_SCHEMA
+        self.readers = list(readers)
+        self.connect_kwargs = {'connect_timeout': connect_timeout, 'keepalives': 1,
+                               'keepalives_idle': keepalives_idle, 'keepalives_interval': keepalives_interval,
+                               'keepalives_count': keepalives_count}
+        self.conn_pool = None
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(self.max_connections)
+        self.prepared = set()
+        self.opened_count = 0
+        self.checkout_count = 0
+
+    @classmethod
+    def from_config(cls, config, **settings):
+        """
+        Returns a ConnectionManager for the cluster and the settings of config (ConfigParser object),
+        see build_dsn() and get_connection_settings(), overridden by 'settings' (keyword arguments).
+        """
+        return cls(build_dsn(config), **dict(get_connection_settings(config), **settings))
+
+    def get_pool(self):
+        """
+        Returns the psycopg2 pool, created on first use. No connection is opened until one is asked for.
+        """
+        with self.lock:
+            if self.conn_pool is None:
+                self.conn_pool = pool.ThreadedConnectionPool(0, self.max_connections, self.dsn,
+                                                             **self.connect_kwargs)
+                # psycopg2 opens 'minconn' connections upfront and closes the connections given back
+                # beyond it: created with 0 for lazy opening, raised so that every connection is kept.
+                self.conn_pool.minconn = self.max_connections
+            return self.conn_pool
+
+    def getconn(self):
+        """
+        Returns a connection of the pool, opening it if needed. Waits if all the connections are in use.
+        """
+        self.available.acquire()
+        try:
+            conn = self.get_pool().getconn()
+            if id(conn) not in self.prepared:
+                # New connection: set its timeout and search path once, outside of any unit of work.
+                if self.statement_timeout or self.search_path:
+                    with conn.cursor() as cur:
+                        if self.statement_timeout:
+                            cur.execute(f"SET statement_timeout TO {int(self.statement_timeout)}")
+                        if self.search_path:
+                            cur.execute(f"SET search_path TO {self.search_path}")
+                    conn.commit()
+                with self.lock:
+                    self.prepared.add(id(conn))
+                    self.opened_count += 1
+        except Exception:
+            self.available.release()
+            raise
+        with self.lock:
+            self.checkout_count += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Gives connection 'conn' back to the pool. It is closed if 'close' (bool) or if it is broken,
+        a new one being opened the next time one is needed.
+        """
+        close = close or bool(conn.closed)
+        if close:
+            with self.lock:
+                self.prepared.discard(id(conn))
+        try:
+            self.get_pool().putconn(conn, close=close)
+        finally:
+            self.available.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager lending a connection of the pool for the duration of the block.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def schema_statements(self):
+        """
+        Returns the statements creating the schema of the connections if it doesn't exist, to run before the
+        tables are created.
+        """
+        return [schema_create_if_missing.format(schema=self.schema)]
+
+    def grant_statements(self, schema=None):
+        """
+        Returns the statements granting the readers usage of schema 'schema' (string, the schema of the
+        connections if None) and read access to its tables, to run once the tables are (re-)created: the grants
+        of dropped tables are lost.
+        """
+        schema = schema or self.schema
+        return [template.format(schema=schema, grantee=grantee) for grantee in self.readers
+                for template in [schema_grant_usage, schema_grant_select]]
+
+    def unit_of_work(self, conn, **retry_settings):
+        """
+        Returns a UnitOfWork (see unit_of_work.py) on connection 'conn' (taken from this pool) with
+        retry_settings (keyword arguments), which replaces a dropped connection with a new one of the pool.
+        The connection to give back at the end is the unit's 'conn' attribute.
+        """
+        unit = UnitOfWork(conn, **retry_settings)
+
+        def reconnect():
+            self.putconn(unit.conn, close=True)
+            return self.getconn()
+        unit.connect = reconnect
+        return unit
+
+    def closeall(self):
+        """
+        Closes all the connections of the pool. The manager can still be used: connections are re-opened
+        on demand.
+        """
+        with self.lock:
+            if self.conn_pool is not None:
+                self.conn_pool.closeall()
+            self.conn_pool = None
+            self.prepared.clear()
+
+    def print_summary(self):
+        """
+        Prints the number of connections opened and the number of times a connection was handed out.
+        """
+        print(f"{self.opened_count} connection(s) opened for {self.checkout_count} use(s), "
+              f"at most {self.max_connections} at a time.")
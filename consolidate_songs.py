@@ -0,0 +1,299 @@
+"""
+This module consolidates the song data before COPY. SONG_DATA holds one tiny JSON file per song, and COPY
+spends most of its time opening tens of thousands of sub-KB objects instead of loading them. The files are
+listed concurrently (one listing per sub-prefix), then concatenated, whole files only so that no record is
+cut, into objects of about 'target_mb' megabytes (64 to 256 MB works best).
+An index records the source keys of each consolidated object: a rerun only consolidates the source files
+which are not in the index yet, into new objects, so that an incremental load (see incremental_load.py)
+pointed at the consolidated prefix only loads the new objects.
+Sources and output can each be a local directory or an S3 url (any boto3 client, e.g. moto).
+Contains the following functions:
+- get_store()
+- list_concurrently()
+- plan_batches()
+- write_batch()
+- load_index()
+- save_index()
+- consolidate()
+- main()
+and the following classes:
+- LocalStore
+- S3Store.
+
+Run 'python consolidate_songs.py' to consolidate SONG_DATA with the settings of section 'CONSOLIDATE' in dwh.cfg.
+"""
+import argparse
+import configparser
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from incremental_load import split_s3_url
+
+DEFAULT_TARGET_MB = 128
+DEFAULT_LIST_DEPTH = 2
+
+
+class LocalStore:
+    """
+    Files of the local file system, the keys being the file paths ('/' separated).
+    """
+
+    def list_children(self, prefix):
+        """
+        Returns a tuple (list of the sub-directories of directory 'prefix' (string), dictionary mapping each
+        file of the directory to its size in bytes).
+        """
+        directories, files = [], {}
+        if not os.path.isdir(prefix):
+            return directories, files
+        for entry in os.scandir(prefix):
+            if entry.is_dir():
+                directories.append(entry.path)
+            else:
+                files[entry.path] = entry.stat().st_size
+        return directories, files
+
+    def list(self, prefix):
+        """
+        Returns a dictionary mapping each file under directory 'prefix' (string), recursively, to its size.
+        """
+        files = {}
+        for directory, _, names in os.walk(prefix):
+            for name in names:
+                path = os.path.join(directory, name)
+                files[path] = os.path.getsize(path)
+        return files
+
+    def read(self, key):
+        with open(key, 'rb') as source:
+            return source.read()
+
+    def exists(self, key):
+        return os.path.exists(key)
+
+    def upload(self, key, fileobj):
+        """
+        Writes the content of 'fileobj' (binary file object) to file 'key' (string).
+        """
+        os.makedirs(os.path.dirname(key) or '.', exist_ok=True)
+        with open(key, 'wb') as target:
+            shutil.copyfileobj(fileobj, target)
+
+
+class S3Store:
+    """
+    Objects of S3 bucket 'bucket' (string), accessed with s3_client (boto3 S3 client).
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def list_children(self, prefix):
+        """
+        Returns a tuple (list of the sub-prefixes of 'prefix' (string), dictionary mapping each object
+        directly under 'prefix' to its size in bytes).
+        """
+        prefix = prefix.rstrip('/') + '/' if prefix else ''
+        prefixes, objects = [], {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            prefixes += [item['Prefix'] for item in page.get('CommonPrefixes', [])]
+            objects.update({item['Key']: item['Size'] for item in page.get('Contents', [])
+                            if not item['Key'].endswith('/')})
+        return prefixes, objects
+
+    def list(self, prefix):
+        """
+        Returns a dictionary mapping each object under 'prefix' (string), recursively, to its size.
+        """
+        objects = {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.update({item['Key']: item['Size'] for item in page.get('Contents', [])
+                            if not item['Key'].endswith('/')})
+        return objects
+
+    def read(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def exists(self, key):
+        # The first key listed under prefix 'key' is 'key' itself if it exists (e.g. not 'key.bak'):
+        contents = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=key, MaxKeys=1).get('Contents', [])
+        return bool(contents) and contents[0]['Key'] == key
+
+    def upload(self, key, fileobj):
+        """
+        Uploads the content of 'fileobj' (binary file object) to object 'key' (string), in multiple parts
+        if it is large.
+        """
+        self.s3_client.upload_fileobj(fileobj, self.bucket, key)
+
+
+def get_store(location, s3_client=None):
+    """
+    Returns a tuple (store, prefix) for 'location' (string): an S3Store and the key prefix for an S3 url
+    (s3_client being required), a LocalStore and the path for anything else.
+    """
+    location = location.strip().strip("'\"")
+    if location.startswith('s3://'):
+        if s3_client is None:
+            raise ValueError(f"An S3 client is required to access '{location}'.")
+        bucket, prefix = split_s3_url(location)
+        return S3Store(s3_client, bucket), prefix
+    return LocalStore(), location
+
+
+def list_concurrently(store, prefix, workers=8, depth=DEFAULT_LIST_DEPTH):
+    """
+    Lists all the files under 'prefix' (string) of 'store' (LocalStore or S3Store object): the prefix is
+    expanded 'depth' (int) levels down (e.g. song_data/A/B/), then each sub-prefix is listed by one of
+    'workers' (int) threads.
+    Returns a dictionary mapping each key to its size in bytes.
+    """
+    files = {}
+    prefixes = [prefix]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(depth):
+            next_prefixes = []
+            for children, level_files in executor.map(store.list_children, prefixes):
+                next_prefixes += children
+                files.update(level_files)
+            prefixes = next_prefixes
+        for listed in executor.map(store.list, prefixes):
+            files.update(listed)
+    return files
+
+
+def plan_batches(objects, target_bytes):
+    """
+    Groups the keys of 'objects' (dictionary key -> size), in key order, into batches of about
+    target_bytes (int) each: a batch is closed as soon as it reaches the target, a file is never split.
+    Returns the list of batches (lists of keys).
+    """
+    batches, batch, batch_size = [], [], 0
+    for key in sorted(objects):
+        batch.append(key)
+        batch_size += objects[key]
+        if batch_size >= target_bytes:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def write_batch(source_store, keys, output_store, output_key, workers=8):
+    """
+    Concatenates the files 'keys' (list of strings) of source_store, read by 'workers' (int) threads, into
+    object output_key (string) of output_store, one JSON record per line: a newline is added to the files
+    which don't end with one. The object is staged in a temporary file, so memory stays flat.
+    Returns the size of the object in bytes.
+    """
+    with tempfile.TemporaryFile() as staged:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for content in executor.map(source_store.read, keys):
+                staged.write(content)
+                if content and not content.endswith(b'\n'):
+                    staged.write(b'\n')
+        size = staged.tell()
+        staged.seek(0)
+        output_store.upload(output_key, staged)
+    return size
+
+
+def load_index(store, key):
+    """
+    Returns the consolidation index stored in 'key' (string) of 'store', or an empty index if there is none.
+    """
+    if not store.exists(key):
+        return {'objects': {}}
+    return json.loads(store.read(key))
+
+
+def save_index(store, key, index):
+    """
+    Writes the consolidation index 'index' (dictionary) to 'key' (string) of 'store'.
+    """
+    store.upload(key, io.BytesIO(json.dumps(index, indent=2).encode('utf-8')))
+
+
+def consolidate(source_store, source_prefix, output_store, output_prefix, index_key,
+                target_bytes=DEFAULT_TARGET_MB * 1024 ** 2, workers=8):
+    """
+    Consolidates the .json files under source_prefix (string) of source_store which are not in the index
+    yet into objects of about target_bytes (int) under output_prefix (string) of output_store, 'workers'
+    (int) threads listing and reading the files. The index, stored in index_key (string) of output_store,
+    is updated after each object so that an interrupted run keeps the objects already written.
+    Returns a dictionary summarizing the run (files listed, files consolidated, objects and bytes written).
+    """
+    index = load_index(output_store, index_key)
+    done = {key for item in index['objects'].values() for key in item['sources']}
+
+    start = time.perf_counter()
+    files = {key: size for key, size in list_concurrently(source_store, source_prefix, workers).items()
+             if key.endswith('.json')}
+    new_files = {key: size for key, size in files.items() if key not in done}
+    print(f"{len(files)} file(s) listed in {time.perf_counter() - start:.2f}s, "
+          f"{len(new_files)} not consolidated yet.")
+
+    summary = {'files': len(files), 'consolidated': 0, 'objects': 0, 'bytes': 0}
+    first_part = len(index['objects'])
+    for number, keys in enumerate(plan_batches(new_files, target_bytes), start=first_part):
+        output_key = f"{output_prefix.rstrip('/')}/songs-part{number:05d}.json"
+        start = time.perf_counter()
+        size = write_batch(source_store, keys, output_store, output_key, workers)
+        index['objects'][output_key] = {'sources': keys, 'size': size}
+        save_index(output_store, index_key, index)
+        print(f"{output_key}: {len(keys)} file(s), {size / 1024 ** 2:.1f} MB "
+              f"written in {time.perf_counter() - start:.2f}s.")
+        summary.update({'consolidated': summary['consolidated'] + len(keys), 'objects': summary['objects'] + 1,
+                        'bytes': summary['bytes'] + size})
+    return summary
+
+
+def main():
+    """
+    Parses the command line (defaults from section 'CONSOLIDATE' of dwh.cfg) and consolidates the song files.
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser(description="Consolidate the small song files into large objects.")
+    parser.add_argument('--source', default=config.get('S3', 'song_data'), help="directory or S3 url of the songs")
+    parser.add_argument('--output', default=config.get('CONSOLIDATE', 'output', fallback=None),
+                        help="directory or S3 url of the consolidated objects")
+    parser.add_argument('--index', default=config.get('CONSOLIDATE', 'index', fallback=None),
+                        help="path or S3 url (in the output bucket) of the consolidation index")
+    parser.add_argument('--target-mb', type=int,
+                        default=config.getint('CONSOLIDATE', 'target_mb', fallback=DEFAULT_TARGET_MB),
+                        help="size of the consolidated objects in MB")
+    parser.add_argument('--workers', type=int, default=config.getint('CONSOLIDATE', 'workers', fallback=8),
+                        help="number of threads listing and reading the files")
+    args = parser.parse_args()
+    if not args.output or not args.index:
+        parser.error("--output and --index are required (or options 'output' and 'index' of section CONSOLIDATE).")
+
+    s3 = None
+    if any(location.strip("'\"").startswith('s3://') for location in [args.source, args.output]):
+        import boto3
+        import create_role_cluster as create_rc
+        aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+        s3 = boto3.client('s3', region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                          aws_secret_access_key=aws_cred.secret)
+    source_store, source_prefix = get_store(args.source, s3)
+    output_store, output_prefix = get_store(args.output, s3)
+    _, index_key = get_store(args.index, s3)
+
+    summary = consolidate(source_store, source_prefix, output_store, output_prefix, index_key,
+                          args.target_mb * 1024 ** 2, args.workers)
+    print(f"{summary['consolidated']} of {summary['files']} file(s) consolidated into {summary['objects']} "
+          f"new object(s), {summary['bytes'] / 1024 ** 2:.1f} MB.")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,7 @@ and the following class:
 - AwsCredentials.
 """
 import sys
-import boto3
 import configparser
-import check_role_cluster as crc
 import json
 
 CONFIG_FILE_NAME = 'dwh.cfg'
@@ -155,62 +153,13 @@ class AwsCredentials:
 
 def main():
     """
+    Provisions the role and the cluster described in dwh.cfg, without waiting for the cluster to be
+    available. The independent calls run concurrently, see provisioning.py.
+    Returns a tuple (redshift client, cluster name).
     """
-    aws_cred = AwsCredentials(CONFIG_SECRET_FILE_NAME)
-
-    # Read and extract data from non secret config file.
-    with open(CONFIG_FILE_NAME) as config_file:
-        config = configparser.ConfigParser()
-        config.read_file(config_file)
-
-    aws_key = aws_cred.key
-    aws_secret = aws_cred.secret
-
-    aws_region = config.get('AWS', 'region')
-
-    print(f"Config data extracted from '{CONFIG_SECRET_FILE_NAME} and {CONFIG_FILE_NAME}'.")
-
-    # Creates IAM client
-    iam = boto3.client('iam',
-                       region_name=aws_region,
-                       aws_access_key_id=aws_key,
-                       aws_secret_access_key=aws_secret
-                       )
-    print("Boto3 IAM client created.")
-
-    # Create IAM role if role doesn't already exist:
-    role_name_iam = config['IAM_ROLE']['iam_role_name']
-    if not crc.check_role_exists(iam, role_name_iam, print_details=False):
-        arn_role_iam = create_iam_role(iam, role_name_iam)
-        print(f"Role '{role_name_iam}' created.")
-    else:
-        arn_role_iam = iam.get_role(RoleName=role_name_iam)['Role']['Arn']
-        print(f"\033[0;33mRole '{role_name_iam}' exists already, not creating a new role.\033[0m")
-
-    # Update roleArn in dwh.cfg
-    update_section_key(CONFIG_FILE_NAME, 'IAM_ROLE', 'arn', arn_role_iam)
-    print(f"Config file '{CONFIG_FILE_NAME}' updated with role arn.")
-
-    # Attach a policy to the role
-    attach_policy_to_role(iam, "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess", role_name_iam)
-
-    # Create redshift client
-    redshift = boto3.client('redshift',
-                            region_name=aws_region,
-                            aws_access_key_id=aws_key,
-                            aws_secret_access_key=aws_secret
-                            )
-    print("Boto3 redshift client created.")
-
-    # Create cluster cl-sparkify if it doesn't already exist:
-    cluster_name = config['CLUSTER']['cl_identifier']
-    if not crc.check_cluster_exists(redshift, cluster_name, details=False):
-        create_redshift_cluster(config, 'CLUSTER', redshift, cluster_name, arn_role_iam)
-        print(f"Cluster '{cluster_name}' created. Wait for availability.")
-    else:
-        print(f"\033[0;33mCluster '{cluster_name}' exists already, not creating a new cluster.\033[0m")
-
-    return redshift, cluster_name
+    # Imported here: provisioning.py builds on the functions of this module.
+    import provisioning
+    return provisioning.main(wait=False)
 
 
 if __name__ == "__main__":
@@ -1,41 +1,45 @@
 import configparser
-import psycopg2 as pg
-from sql_queries import create_table_queries, drop_table_queries
-
-
-def drop_tables(cur, conn):
-    for query in drop_table_queries:
-        print(f"Query {query} executed.")
-        cur.execute(query)
-        conn.commit()
-
-
-def create_tables(cur, conn):
-    for query in create_table_queries:
-        print(f"Query {query} executed.")
-        cur.execute(query)
-        conn.commit()
-
-
-def main():
+import checkpoints
+import instrumentation
+from connection_manager import ConnectionManager
+from sql_queries import create_table_queries, drop_table_queries, checkpoints_delete
+from unit_of_work import get_retry_settings
+
+
+def main(connections=None, plan=None):
+    """
+    Drops and re-creates all the tables, on a connection of 'connections' (ConnectionManager object shared
+    by the stages of the run, one is created from dwh.cfg if None).
+    'plan' (dictionary, see checkpoints.py) is the plan of the run: the tables are kept if it skips
+    create_tables (resumed run). A new plan re-creating the tables is made if None.
+    """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
-
-    cl_values = list(config['CLUSTER'].values())
-    cl_keys = list(config['CLUSTER'].keys())
-    cl_dic = dict(zip(cl_keys, cl_values))
-
-    conn = pg.connect(f"host={cl_dic['cl_endpoint']} dbname={cl_dic['cl_db_name']} \
-                      user={cl_dic['cl_user']} password={cl_dic['cl_password']} port={cl_dic['cl_port']}")
-    cur = conn.cursor()
-
-    drop_tables(cur, conn)
-    print("Tables dropped.")
-    create_tables(cur, conn)
-    print("Tables created.")
-
-    conn.close()
+    instrumentation.configure_from_config(config)
+    own_connections = connections is None
+    if own_connections:
+        connections = ConnectionManager.from_config(config)
+    if plan is None:
+        plan = checkpoints.prepare_run(connections, config, resume=False)
+
+    if plan[checkpoints.CREATE_TABLES_STAGE]['skip']:
+        print("Resuming: tables kept, not dropped and re-created.")
+    else:
+        # Drop and re-create the tables as one unit of work: if anything fails, the previous tables are kept.
+        # The checkpoints of the previous tables are replaced by the one of the new tables in the same unit, and
+        # the readers granted access to the new tables.
+        unit = connections.unit_of_work(connections.getconn(), **get_retry_settings(config))
+        try:
+            unit.run(drop_table_queries + create_table_queries + connections.grant_statements() +
+                     [checkpoints_delete, checkpoints.checkpoint_query(plan, checkpoints.CREATE_TABLES_STAGE)])
+        finally:
+            connections.putconn(unit.conn)
+        print("Tables dropped and created.")
+        unit.print_summary()
+
+    if own_connections:
+        connections.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
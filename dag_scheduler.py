@@ -0,0 +1,239 @@
+"""
+This module schedules the query nodes declared in sql_queries.py as a dependency graph (DAG).
+A node depends on every earlier node that writes a table it reads or writes, or reads a table it
+writes, so running the graph gives the same result as running the nodes in declaration order,
+while independent branches (e.g. the songs, artists, users and time inserts) run concurrently.
+Contains the following functions:
+- get_dag_workers()
+- build_dependencies()
+- topological_order()
+- get_node_costs()
+- critical_path()
+- print_plan()
+- run_node()
+- run_dag()
+- main()
+
+Run 'python dag_scheduler.py --plan' to print the critical path and expected speedup of each stage.
+"""
+import argparse
+import configparser
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import sql_queries
+
+DEFAULT_DAG_WORKERS = 4
+
+
+def get_dag_workers(config):
+    """
+    Returns the number of concurrent statements set by option 'dag_workers' of section 'ETL'
+    in config (ConfigParser object).
+    Returns DEFAULT_DAG_WORKERS if the section or option doesn't exist.
+    """
+    return max(1, config.getint('ETL', 'dag_workers', fallback=DEFAULT_DAG_WORKERS))
+
+
+def build_dependencies(nodes):
+    """
+    Returns a dictionary mapping the name of each node in 'nodes' (list of dictionaries with keys
+    name, query, inputs, outputs) to the set of names of the nodes it depends on.
+    """
+    dependencies = {}
+    for index, node in enumerate(nodes):
+        reads, writes = set(node['inputs']), set(node['outputs'])
+        dependencies[node['name']] = set()
+        for earlier in nodes[:index]:
+            earlier_reads, earlier_writes = set(earlier['inputs']), set(earlier['outputs'])
+            if earlier_writes & (reads | writes) or earlier_reads & writes:
+                dependencies[node['name']].add(earlier['name'])
+    return dependencies
+
+
+def topological_order(nodes, dependencies):
+    """
+    Returns the names of the nodes in an order compatible with 'dependencies' (dictionary
+    returned by build_dependencies()). Ties are broken by declaration order.
+    Raises ValueError if the dependencies contain a cycle.
+    """
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    order = []
+    while remaining:
+        ready = [node['name'] for node in nodes if node['name'] in remaining and not remaining[node['name']]]
+        if not ready:
+            raise ValueError(f"Dependency cycle between nodes: {', '.join(sorted(remaining))}.")
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+
+def get_node_costs(config, nodes):
+    """
+    Returns a dictionary mapping each node name to its expected cost (float, e.g. seconds).
+    Costs are read from section 'DAG_COSTS' in config (ConfigParser object), one option per node
+    name. Nodes without a cost default to 1.
+    """
+    return {node['name']: config.getfloat('DAG_COSTS', node['name'], fallback=1.0) for node in nodes}
+
+
+def critical_path(nodes, dependencies, costs):
+    """
+    Returns the critical path of the graph, i.e. the chain of dependent nodes with the highest
+    total cost, as a tuple (list of node names, total cost).
+    """
+    finish = {}
+    previous = {}
+    for name in topological_order(nodes, dependencies):
+        start = 0.0
+        previous[name] = None
+        for dep in dependencies[name]:
+            if finish[dep] > start:
+                start, previous[name] = finish[dep], dep
+        finish[name] = start + costs[name]
+
+    if not finish:
+        return [], 0.0
+    last = max(finish, key=finish.get)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    path.reverse()
+    return path, finish[path[-1]]
+
+
+def print_plan(stage_name, nodes, costs, workers):
+    """
+    Prints the execution plan of 'nodes' for stage 'stage_name' (string): the waves of nodes
+    which can run concurrently, the critical path and the expected speedup over running the
+    nodes in sequence with 'workers' (int) concurrent statements.
+    """
+    dependencies = build_dependencies(nodes)
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    print(f"\nPlan for stage '{stage_name}' ({len(nodes)} statements, {workers} workers):")
+    wave = 1
+    while remaining:
+        ready = [node['name'] for node in nodes if node['name'] in remaining and not remaining[node['name']]]
+        print(f"  Wave {wave}: {', '.join(ready)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+        wave += 1
+
+    path, path_cost = critical_path(nodes, dependencies, costs)
+    total_cost = sum(costs.values())
+    # The run can't be shorter than the critical path, nor than the total work spread over the workers.
+    expected_cost = max(path_cost, total_cost / workers)
+    speedup = total_cost / expected_cost if expected_cost else 1.0
+    print(f"  Critical path: {' -> '.join(path)} (cost {path_cost:g})")
+    print(f"  Sequential cost: {total_cost:g}, expected parallel cost: {expected_cost:g}, "
+          f"expected speedup: x{speedup:.2f}")
+
+
+def run_node(connections, node, running, running_lock, retry_settings):
+    """
+    Runs the query of 'node' on a connection taken from 'connections' (ConnectionManager object) as a unit
+    of work, transient errors (dropped connections included) being retried according to retry_settings
+    (dictionary, see unit_of_work.py). The optional 'checkpoint' statement of the node (see checkpoints.py)
+    is committed with its query, after its optional 'before_commit' check (function taking the cursor, see
+    UnitOfWork.run()): a failed check commits neither.
+    'running' (dict) records the connection in use so that it can be cancelled, under 'running_lock'
+    (threading.Lock object) as the nodes run on several threads.
+    Returns a tuple (duration of the query in seconds, number of retries).
+    """
+    unit = connections.unit_of_work(connections.getconn(), **retry_settings)
+    with running_lock:
+        running[node['name']] = unit.conn
+    start = time.perf_counter()
+    try:
+        if node.get('checkpoint'):
+            unit.run([node['query'], node['checkpoint']], [node['name'], f"checkpoint_{node['name']}"],
+                     before_commit=node.get('before_commit'))
+        else:
+            unit.run([node['query']], [node['name']], before_commit=node.get('before_commit'))
+    finally:
+        with running_lock:
+            del running[node['name']]
+        connections.putconn(unit.conn)
+    return time.perf_counter() - start, unit.retry_count
+
+
+def run_dag(connections, nodes, workers=DEFAULT_DAG_WORKERS, retry_settings=None):
+    """
+    Runs the query nodes in 'nodes' on connections of 'connections' (ConnectionManager object), starting each
+    node as soon as the nodes it depends on are done, with at most 'workers' (int) concurrent
+    statements. Each node is committed on its own, transient errors being retried according to
+    retry_settings (dictionary, see unit_of_work.get_retry_settings()).
+    If a node fails, the running nodes are cancelled, no new node is started and the
+    first error is raised.
+    Returns a dictionary mapping each node name to its duration in seconds.
+    """
+    retry_settings = retry_settings or {}
+    dependencies = build_dependencies(nodes)
+    pending = topological_order(nodes, dependencies)
+    by_name = {node['name']: node for node in nodes}
+    workers = max(1, min(workers, len(nodes)))
+    running = {}
+    running_lock = threading.Lock()
+    in_flight = {}
+    done = {}
+    retry_count = 0
+    first_error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if first_error is None:
+                for name in [name for name in pending if dependencies[name] <= done.keys()]:
+                    pending.remove(name)
+                    in_flight[executor.submit(run_node, connections, by_name[name], running, running_lock,
+                                              retry_settings)] = name
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = in_flight.pop(future)
+                try:
+                    done[name], retries = future.result()
+                    retry_count += retries
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+                        with running_lock:
+                            running_conns = list(running.values())
+                        for conn in running_conns:
+                            conn.cancel()
+
+    if first_error is not None:
+        raise first_error
+    print(f"{len(done)} statement(s) run, {retry_count} retry(ies).")
+    return done
+
+
+def main():
+    """
+    Parses the command line. With option --plan, prints the plan of the 'etl' stage.
+    """
+    parser = argparse.ArgumentParser(description="Dependency-aware scheduler for the Sparkify queries.")
+    parser.add_argument('--plan', action='store_true',
+                        help="print the critical path and expected speedup of each stage")
+    args = parser.parse_args()
+
+    if not args.plan:
+        parser.print_help()
+        return
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    workers = get_dag_workers(config)
+    stages = {'etl': sql_queries.etl_nodes}
+    for stage_name, nodes in stages.items():
+        print_plan(stage_name, nodes, get_node_costs(config, nodes), workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+This module generates synthetic Sparkify data, in the same shapes as the Udacity S3 data loaded into
+staging_events and staging_songs:
+- song files: one JSON record per file, under song_data/<A>/<B>/<C>/<song_id>.json,
+- log files: one JSON record per line, one file per day under log_data/<year>/<month>/<date>-events.json.
+Events are streamed to disk so that memory stays flat whatever the scale (10k to 100M events). A controllable
+share of the events and songs is written twice, to exercise the deduplication of the pipeline.
+Contains the following functions:
+- random_id()
+- generate_songs()
+- generate_users()
+- generate_events()
+- write_song_files()
+- write_log_files()
+- generate_dataset()
+- main()
+
+Run 'python data_generator.py --events 100000 --output data' to generate a dataset.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import string
+
+FIRST_NAMES = ['Lily', 'Jacob', 'Ava', 'Kevin', 'Chloe', 'Aleena', 'Tegan', 'Jayden', 'Matthew', 'Layla', 'Ryan',
+               'Emily', 'Noah', 'Sara', 'Theodore', 'Kate', 'Mohammad', 'Hannah', 'Wyatt', 'Jordan']
+LAST_NAMES = ['Koch', 'Klein', 'Levine', 'Arellano', 'Cuevas', 'Kirby', 'Smith', 'Fox', 'Griffin', 'Porter',
+              'Rodriguez', 'Harrell', 'Larson', 'Jones', 'Scott', 'Lynch', 'Stewart', 'Daniels', 'Bell', 'Cook']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Lansing-East Lansing, MI', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA', 'Tampa-St. Petersburg, FL',
+             'Portland-South Portland, ME', 'Houston-The Woodlands-Sugar Land, TX']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Safari/537.78.2"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/36.0 Safari/537.36"']
+WORDS = ['Love', 'Night', 'Dream', 'Fire', 'Heart', 'Rain', 'Blue', 'City', 'Dance', 'Light', 'Road', 'Home',
+         'Shadow', 'River', 'Gold', 'Summer', 'Train', 'Moon', 'Wild', 'Sound']
+# Pages of the log and their share of the events. Only 'NextSong' events are song plays.
+PAGES = [('NextSong', 0.82), ('Home', 0.06), ('Logout', 0.03), ('Login', 0.03), ('Settings', 0.02),
+         ('Upgrade', 0.01), ('Downgrade', 0.01), ('Help', 0.01), ('About', 0.01)]
+
+DEFAULT_START_DATE = datetime.datetime(2018, 11, 1)
+
+
+def random_id(prefix, rng):
+    """
+    Returns an 18 character id starting with 'prefix' (string), e.g. 'SOABCDEF12345678AB'.
+    """
+    return prefix + ''.join(rng.choices(string.ascii_uppercase + string.digits, k=18 - len(prefix)))
+
+
+def generate_songs(n_songs, n_artists, rng):
+    """
+    Returns a list of n_songs song records (dictionaries with the staging_songs fields), by n_artists artists.
+    As in the Udacity data, an artist_id is credited under several names: a share of the songs of each artist
+    carries a featuring credit ('<name> feat. <guest>') instead of the artist's own name.
+    """
+    artists = []
+    for _ in range(n_artists):
+        located = rng.random() < 0.4
+        artists.append({
+            'artist_id': random_id('AR', rng),
+            'artist_name': ' '.join(rng.sample(WORDS, 2)),
+            'artist_location': rng.choice(LOCATIONS) if located else '',
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+            'artist_longitude': round(rng.uniform(-120, 120), 5) if located else None,
+        })
+    songs = []
+    for _ in range(n_songs):
+        artist = dict(rng.choice(artists))
+        if rng.random() < 0.2:
+            artist['artist_name'] += f" feat. {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        songs.append({'num_songs': 1, **artist, 'song_id': random_id('SO', rng),
+                      'title': ' '.join(rng.sample(WORDS, rng.randint(1, 3))),
+                      'duration': round(rng.uniform(90, 480), 5),
+                      'year': rng.choice([0] + list(range(1960, 2019)))})
+    return songs
+
+
+def generate_users(n_users, rng):
+    """
+    Returns a list of n_users user records (dictionaries with user id, names, gender, level, location, agent).
+    """
+    return [{'userId': str(user_id), 'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+             'gender': rng.choice('MF'), 'level': rng.choice(['free', 'free', 'paid']),
+             'location': rng.choice(LOCATIONS), 'userAgent': rng.choice(USER_AGENTS),
+             'registration': float(rng.randint(1_530_000_000_000, 1_540_000_000_000))}
+            for user_id in range(1, n_users + 1)]
+
+
+def generate_events(n_events, songs, users, rng, start_date=DEFAULT_START_DATE, events_per_day=10000,
+                    match_rate=0.9):
+    """
+    Yields n_events log records (dictionaries with the fields of LOG_JSONPATH), in time order, about
+    events_per_day (int) per day from start_date (datetime).
+    'match_rate' (float) is the share of 'NextSong' events playing a song of 'songs'; the others play
+    songs unknown to the song data, as in the Udacity data.
+    """
+    pages, weights = zip(*PAGES)
+    epoch = datetime.datetime(1970, 1, 1)
+    ts = int((start_date - epoch).total_seconds() * 1000)
+    step = 86_400_000 // max(1, events_per_day)
+    session_id = 0
+    user, item_in_session = None, 0
+    for _ in range(n_events):
+        # Start a new session from time to time, for a random user.
+        if user is None or rng.random() < 0.05:
+            session_id += 1
+            user, item_in_session = rng.choice(users), 0
+            # Users sometimes change level between sessions.
+            if rng.random() < 0.02:
+                user['level'] = 'paid' if user['level'] == 'free' else 'free'
+        ts += rng.randint(1, 2 * step)
+        page = rng.choices(pages, weights)[0]
+        event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                 'itemInSession': item_in_session, 'lastName': user['lastName'], 'length': None,
+                 'level': user['level'], 'location': user['location'], 'method': 'GET', 'page': page,
+                 'registration': user['registration'], 'sessionId': session_id, 'song': None, 'status': 200,
+                 'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId']}
+        if page == 'NextSong':
+            song = rng.choice(songs) if rng.random() < match_rate else \
+                {'artist_name': ' '.join(rng.sample(WORDS, 3)), 'title': ' '.join(rng.sample(WORDS, 4)),
+                 'duration': round(rng.uniform(90, 480), 5)}
+            event.update({'artist': song['artist_name'], 'song': song['title'], 'length': song['duration'],
+                          'method': 'PUT'})
+        item_in_session += 1
+        yield event
+
+
+def write_song_files(songs, output_dir, duplicate_rate, rng):
+    """
+    Writes one JSON file per song under output_dir/song_data/<A>/<B>/<C>/, a share 'duplicate_rate'
+    (float) of the songs being written a second time in another file.
+    Returns the number of files written.
+    """
+    count = 0
+    for song in songs:
+        copies = 2 if rng.random() < duplicate_rate else 1
+        for copy in range(copies):
+            directory = os.path.join(output_dir, 'song_data', *song['song_id'][2:5])
+            os.makedirs(directory, exist_ok=True)
+            suffix = f"-{copy}" if copy else ''
+            with open(os.path.join(directory, f"{song['song_id']}{suffix}.json"), 'w') as song_file:
+                json.dump(song, song_file)
+            count += 1
+    return count
+
+
+def write_log_files(events, output_dir, duplicate_rate, rng):
+    """
+    Writes the records of 'events' (iterable) one per line, in one file per day under
+    output_dir/log_data/<year>/<month>/, a share 'duplicate_rate' (float) of the events being written twice.
+    Returns the number of lines written.
+    """
+    count = 0
+    epoch = datetime.datetime(1970, 1, 1)
+    current_day, log_file = None, None
+    try:
+        for event in events:
+            day = (epoch + datetime.timedelta(milliseconds=event['ts'])).date()
+            if day != current_day:
+                if log_file:
+                    log_file.close()
+                directory = os.path.join(output_dir, 'log_data', str(day.year), f"{day.month:02d}")
+                os.makedirs(directory, exist_ok=True)
+                log_file = open(os.path.join(directory, f"{day.isoformat()}-events.json"), 'w')
+                current_day = day
+            line = json.dumps(event) + '\n'
+            log_file.write(line)
+            count += 1
+            if rng.random() < duplicate_rate:
+                log_file.write(line)
+                count += 1
+    finally:
+        if log_file:
+            log_file.close()
+    return count
+
+
+def generate_dataset(output_dir, n_events, n_songs=None, n_users=None, duplicate_rate=0.0, seed=0,
+                     events_per_day=10000):
+    """
+    Generates a dataset of n_events events (int) under output_dir (string): output_dir/log_data and
+    output_dir/song_data. By default the song catalog has one song per 10 events (between 100 and 1M) and
+    there is one user per 1000 events (at least 100).
+    Returns a dictionary describing the dataset (counts of songs, song files, users, events and log lines).
+    """
+    rng = random.Random(seed)
+    n_songs = n_songs or min(max(100, n_events // 10), 1_000_000)
+    n_users = n_users or max(100, n_events // 1000)
+    songs = generate_songs(n_songs, max(1, n_songs // 4), rng)
+    users = generate_users(n_users, rng)
+    song_files = write_song_files(songs, output_dir, duplicate_rate, rng)
+    events = generate_events(n_events, songs, users, rng, events_per_day=events_per_day)
+    log_lines = write_log_files(events, output_dir, duplicate_rate, rng)
+    return {'songs': n_songs, 'song_files': song_files, 'users': n_users, 'events': n_events,
+            'log_lines': log_lines, 'duplicate_rate': duplicate_rate, 'seed': seed}
+
+
+def main():
+    """
+    Parses the command line and generates a dataset.
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song and log data.")
+    parser.add_argument('--events', type=int, default=10000, help="number of log events (default 10000)")
+    parser.add_argument('--songs', type=int, default=None, help="number of songs (default events / 10)")
+    parser.add_argument('--users', type=int, default=None, help="number of users (default events / 1000)")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help="share of events and songs written twice (default 0)")
+    parser.add_argument('--events-per-day', type=int, default=10000, help="average events per day, i.e. per log file (default 10000)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default 0)")
+    parser.add_argument('--output', default='data', help="output directory (default 'data')")
+    args = parser.parse_args()
+
+    summary = generate_dataset(args.output, args.events, args.songs, args.users, args.duplicate_rate, args.seed,
+                               args.events_per_day)
+    print(f"Dataset generated in '{args.output}': {summary}")
+
+
+if __name__ == "__main__":
+    main()
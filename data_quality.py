@@ -0,0 +1,223 @@
+"""
+This module checks the data loaded into the star schema. The checks are declared per table in CHECKS: minimum
+row count, null rate of the columns which should never be null, uniqueness of the keys, coverage of the
+references to other tables (e.g. songplays.song_key against songs) and range of timestamp columns.
+The checks of a table are compiled into a single aggregated query, so that each table is scanned once (a
+reference adds a join to the distinct keys of the referenced table), and the tables are checked in parallel,
+each on its own connection. The results are a list of dictionaries (table, check, column, value, threshold,
+passed), printed and written as JSON; etl.py fails the run if a check fails.
+Contains the following functions:
+- get_quality_settings()
+- compile_table_query()
+- evaluate_table()
+- run_checks()
+- check_tables()
+- print_results()
+- write_results()
+- main()
+
+Run 'python data_quality.py' to check the tables of the cluster ('--local' for the local backend).
+"""
+import argparse
+import configparser
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DEFAULT_SETTINGS = {'max_null_rate': 0.0, 'min_coverage': 1.0, 'min_time': '2018-01-01', 'max_time': '',
+                    'workers': 5, 'output': 'quality.json', 'fail_on_error': True}
+
+CHECKS = {
+    'songplays': {'min_rows': 1,
+                  'not_null': ['start_time', 'user_id', 'level', 'song_key', 'artist_key', 'session_id'],
+                  'unique': ['songplay_id'],
+                  'references': [('song_key', 'songs', 'song_key'), ('artist_key', 'artists', 'artist_key')]},
+    'users': {'min_rows': 1, 'not_null': ['user_id', 'first_name', 'last_name', 'level'], 'unique': ['user_id']},
+    'songs': {'min_rows': 1, 'not_null': ['song_key', 'song_id', 'title', 'artist_key'],
+              'unique': ['song_key', 'song_id']},
+    'artists': {'min_rows': 1, 'not_null': ['artist_key', 'artist_id', 'name'], 'unique': ['artist_key', 'artist_id']},
+    'time': {'min_rows': 1, 'not_null': ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+             'unique': ['start_time'], 'range': ['start_time']},
+}
+
+
+def get_quality_settings(config):
+    """
+    Returns the settings of section 'QUALITY' of config (ConfigParser object) as a dictionary: max_null_rate,
+    min_coverage (floats), min_time, max_time (datetimes, max_time being the current time if empty), workers
+    (int), output (string, empty for no file) and fail_on_error (bool).
+    """
+    max_time = config.get('QUALITY', 'max_time', fallback=DEFAULT_SETTINGS['max_time'])
+    return {
+        'max_null_rate': config.getfloat('QUALITY', 'max_null_rate', fallback=DEFAULT_SETTINGS['max_null_rate']),
+        'min_coverage': config.getfloat('QUALITY', 'min_coverage', fallback=DEFAULT_SETTINGS['min_coverage']),
+        'min_time': datetime.fromisoformat(config.get('QUALITY', 'min_time', fallback=DEFAULT_SETTINGS['min_time'])),
+        'max_time': datetime.fromisoformat(max_time) if max_time else datetime.now(),
+        'workers': max(1, config.getint('QUALITY', 'workers', fallback=DEFAULT_SETTINGS['workers'])),
+        'output': config.get('QUALITY', 'output', fallback=DEFAULT_SETTINGS['output']),
+        'fail_on_error': config.getboolean('QUALITY', 'fail_on_error', fallback=DEFAULT_SETTINGS['fail_on_error']),
+    }
+
+
+def compile_table_query(table, checks):
+    """
+    Returns a tuple (query, list of the names of its columns) computing all the measures needed by 'checks'
+    (dictionary, see CHECKS) of table 'table' (string) in a single scan: row count, nulls of each not_null
+    column, distinct values of each unique column, references not found in the referenced table, minimum and
+    maximum of each range column.
+    """
+    measures = [('row_count', "COUNT(*)")]
+    measures += [(f"nulls:{column}", f"COUNT(*) - COUNT(t.{column})") for column in checks.get('not_null', [])]
+    measures += [(f"duplicates:{column}", f"COUNT(t.{column}) - COUNT(DISTINCT t.{column})")
+                 for column in checks.get('unique', [])]
+    joins = []
+    for index, (column, ref_table, ref_column) in enumerate(checks.get('references', [])):
+        measures.append((f"referenced:{column}", f"COUNT(t.{column})"))
+        measures.append((f"orphans:{column}",
+                         f"SUM(CASE WHEN t.{column} IS NOT NULL AND r{index}.{ref_column} IS NULL THEN 1 ELSE 0 END)"))
+        # Distinct keys, so that duplicates in the referenced table can't multiply the rows counted:
+        joins.append(f"LEFT JOIN (SELECT DISTINCT {ref_column} FROM {ref_table}) AS r{index} "
+                     f"ON r{index}.{ref_column} = t.{column}")
+    for column in checks.get('range', []):
+        measures += [(f"min:{column}", f"MIN(t.{column})"), (f"max:{column}", f"MAX(t.{column})")]
+
+    select = ",\n       ".join(expression for _, expression in measures)
+    query = f"SELECT {select}\nFROM {table} AS t" + "".join(f"\n{join}" for join in joins) + ";"
+    return query, [name for name, _ in measures]
+
+
+def evaluate_table(table, checks, measures, settings):
+    """
+    Returns the results of 'checks' (dictionary, see CHECKS) of table 'table' (string) from 'measures'
+    (dictionary returned by the query of compile_table_query(), name -> value) and 'settings' (dictionary, see
+    get_quality_settings()): a list of dictionaries with keys table, check, column, value, threshold, passed.
+    """
+    rows = measures['row_count'] or 0
+    results = [{'table': table, 'check': 'row_count', 'column': None, 'value': rows,
+                'threshold': checks.get('min_rows', 0), 'passed': rows >= checks.get('min_rows', 0)}]
+    for column in checks.get('not_null', []):
+        rate = measures[f"nulls:{column}"] / rows if rows else 0.0
+        results.append({'table': table, 'check': 'null_rate', 'column': column, 'value': round(rate, 6),
+                        'threshold': settings['max_null_rate'], 'passed': rate <= settings['max_null_rate']})
+    for column in checks.get('unique', []):
+        duplicates = measures[f"duplicates:{column}"]
+        results.append({'table': table, 'check': 'duplicates', 'column': column, 'value': duplicates,
+                        'threshold': 0, 'passed': duplicates == 0})
+    for column, ref_table, ref_column in checks.get('references', []):
+        referenced = measures[f"referenced:{column}"]
+        coverage = 1 - (measures[f"orphans:{column}"] or 0) / referenced if referenced else 1.0
+        results.append({'table': table, 'check': f"coverage_in_{ref_table}.{ref_column}", 'column': column,
+                        'value': round(coverage, 6), 'threshold': settings['min_coverage'],
+                        'passed': coverage >= settings['min_coverage']})
+    for column in checks.get('range', []):
+        low, high = measures[f"min:{column}"], measures[f"max:{column}"]
+        passed = low is None or (low >= settings['min_time'] and high <= settings['max_time'])
+        results.append({'table': table, 'check': 'range', 'column': column,
+                        'value': [str(low), str(high)],
+                        'threshold': [str(settings['min_time']), str(settings['max_time'])], 'passed': passed})
+    return results
+
+
+def run_checks(run_query, settings, checks=CHECKS, workers=1):
+    """
+    Runs the query of each table of 'checks' (dictionary, see CHECKS) with run_query (function taking a query
+    and returning its rows, thread-safe if workers > 1), at most 'workers' (int) tables at a time.
+    Returns the list of results, see evaluate_table().
+    """
+    def check_table(table):
+        query, names = compile_table_query(table, checks[table])
+        return evaluate_table(table, checks[table], dict(zip(names, run_query(query)[0])), settings)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(checks)))) as executor:
+        return [result for results in executor.map(check_table, checks) for result in results]
+
+
+def check_tables(connections, config):
+    """
+    Runs the checks on the tables of the cluster, each table on its own connection of 'connections'
+    (ConnectionManager object), prints the results and writes them to the output file of section 'QUALITY' of
+    config (ConfigParser object).
+    Raises ValueError if a check failed and fail_on_error is set. Returns the results otherwise.
+    """
+    settings = get_quality_settings(config)
+
+    def run_query(query):
+        with connections.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    results = run_checks(run_query, settings, workers=settings['workers'])
+    print_results(results)
+    if settings['output']:
+        write_results(results, settings['output'])
+    failed = [result for result in results if not result['passed']]
+    if failed and settings['fail_on_error']:
+        raise ValueError(f"{len(failed)} data quality check(s) failed: " +
+                         ", ".join(f"{result['table']}.{result['check']}" +
+                                   (f"({result['column']})" if result['column'] else "") for result in failed))
+    return results
+
+
+def print_results(results):
+    """
+    Prints the failed checks and the number of checks passed.
+    """
+    failed = [result for result in results if not result['passed']]
+    print(f"\nData quality: {len(results) - len(failed)}/{len(results)} check(s) passed.")
+    for result in failed:
+        column = f".{result['column']}" if result['column'] else ""
+        print(f"\033[0;31m- {result['table']}{column} {result['check']}: {result['value']} "
+              f"(threshold {result['threshold']})\033[0m")
+
+
+def write_results(results, path):
+    """
+    Writes 'results' (list of dictionaries) to file 'path' (string) as JSON.
+    """
+    with open(path, 'w') as file:
+        json.dump({'checked_at': datetime.now().isoformat(timespec='seconds'),
+                   'passed': all(result['passed'] for result in results), 'results': results}, file, indent=2)
+
+
+def main():
+    """
+    Checks the tables of the cluster of dwh.cfg, or of the local backend with '--local'.
+    Exits with status 1 if a check failed.
+    """
+    parser = argparse.ArgumentParser(description="Data quality checks of the star schema.")
+    parser.add_argument('--local', action='store_true', help="check the local backend (section LOCAL)")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    settings = get_quality_settings(config)
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        try:
+            # One connection: the tables are checked one after the other.
+            results = run_checks(backend.execute, settings)
+        finally:
+            backend.close()
+        print_results(results)
+        if settings['output']:
+            write_results(results, settings['output'])
+        passed = all(result['passed'] for result in results)
+    else:
+        from connection_manager import ConnectionManager
+        connections = ConnectionManager.from_config(config)
+        try:
+            passed = all(result['passed'] for result in check_tables(connections, config))
+        except ValueError as e:
+            print(e)
+            passed = False
+        finally:
+            connections.closeall()
+    raise SystemExit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,100 @@
+import argparse
 import configparser
-import psycopg2 as pg
-from sql_queries import load_staging_table_queries, insert_table_queries, remove_duplicate_users_queries, \
-    remove_duplicate_artists_queries
+import checkpoints
+import data_quality
+import parallel_loader as pl
+import plan_guard
+import surrogate_keys
+import dag_scheduler as dag
+import instrumentation
+import maintenance
+from connection_manager import ConnectionManager
+from unit_of_work import get_retry_settings
+from sql_queries import load_staging_table_nodes, insert_table_nodes, songplay_count, nextsong_event_count
 
 
-def run_queries(cur, conn, query_list):
+def check_songplay_row_count(cur, songplays_before=0):
     """
-    Run queries in query_list,
-    arguments: psycopg2 cursor and connection objects, sql query lists (strings).
+    Sanity check of the songplays insert: each 'NextSong' event in staging_events can produce at most one
+    songplay, so the number of rows added to songplays (current count minus songplays_before, int) can't
+    exceed the number of 'NextSong' events.
+    Raises ValueError if it does (e.g. the join fans out). Returns the number of rows added otherwise.
     """
-    for query in query_list:
-        print(f"\nQuery being executed: {query}")
-        cur.execute(query)
-        conn.commit()
+    cur.execute(songplay_count)
+    added = cur.fetchone()[0] - songplays_before
+    cur.execute(nextsong_event_count)
+    events = cur.fetchone()[0]
+    if added > events:
+        raise ValueError(f"songplays received {added} rows from only {events} 'NextSong' events: "
+                         f"the songplays insert is fanning out. Aborting.")
+    print(f"songplays: {added} rows inserted from {events} 'NextSong' events.")
+    return added
 
 
-def main():
+def main(connections=None, plan=None, resume=False):
     """
+    Loads the staging tables then the fact and dimension tables, on connections of 'connections'
+    (ConnectionManager object shared by the stages of the run, one is created from dwh.cfg if None).
+    Each stage is committed with its checkpoint. The stages skipped by 'plan' (dictionary, see checkpoints.py)
+    aren't run; if None, a plan is made on the existing tables, skipping the stages already done if 'resume'
+    (bool).
     """
     config = configparser.ConfigParser()
     # TODO: find a way to remove local reference to 'dwh.cfg', 'CLUSTER', and all the sections:
     config.read('dwh.cfg')
+    instrumentation.configure_from_config(config)
+    own_connections = connections is None
+    if own_connections:
+        connections = ConnectionManager.from_config(config)
+    if plan is None:
+        plan = checkpoints.prepare_run(connections, config, resume, recreate_tables=False)
 
-    cl_values = list(config['CLUSTER'].values())
-    cl_keys = list(config['CLUSTER'].keys())
-    cl_dic = dict(zip(cl_keys, cl_values))
+    # load staging tables, each COPY running on its own pooled connection:
+    copy_nodes = [node for node in load_staging_table_nodes if not plan[node['name']]['skip']]
+    report = pl.load_staging_tables_parallel(connections, [node['query'] for node in copy_nodes],
+                                             pl.get_staging_workers(config),
+                                             {node['query']: [checkpoints.checkpoint_query(plan, node['name'])]
+                                              for node in copy_nodes})
+    pl.print_timing_report(report)
+    print("Staging tables loaded.")
 
-    conn = pg.connect(f"host={cl_dic['cl_endpoint']} dbname={cl_dic['cl_db_name']} \
-                      user={cl_dic['cl_user']} password={cl_dic['cl_password']} \
-                      port={cl_dic['cl_port']}")
-    cur = conn.cursor()
+    # Pre-flight check of the plans of the inserts, before they run (see plan_guard.py):
+    if config.getboolean('PLAN_GUARD', 'enabled', fallback=False):
+        plan_guard.check_plans(connections, config)
 
-    print("Connection established, cursor created.")
-    
-    # load staging tables:
-    run_queries(cur, conn, load_staging_table_queries)
-    print("Staging tables loaded.")
-    
-    # insert data from staging tables:
-    run_queries(cur, conn, insert_table_queries)
-    print("Table(s) inserted.")
+    # insert data from staging tables, independent tables being loaded concurrently.
+    # users and artists are upserted, i.e. deduplicated on their key while being loaded:
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(songplay_count)
+            songplays_before = cur.fetchone()[0]
+        conn.commit()
+    insert_nodes = [dict(node, checkpoint=checkpoints.checkpoint_query(plan, node['name']))
+                    for node in insert_table_nodes if not plan[node['name']]['skip']]
+    for node in insert_nodes:
+        if node['name'] == 'insert_songplays':
+            # The songplays are checked before they commit: a failed check rolls back the insert and its checkpoint.
+            node['before_commit'] = lambda cur: check_songplay_row_count(cur, songplays_before)
+    dag.run_dag(connections, insert_nodes, dag.get_dag_workers(config), get_retry_settings(config))
+    print("Table(s) inserted, users and artists upserted.")
+
+    # VACUUM/ANALYZE the tables over the thresholds (see maintenance.py):
+    if config.getboolean('MAINTENANCE', 'enabled', fallback=False):
+        maintenance.maintain_tables(connections, config)
 
-    # remove users and artists duplicates:
-    run_queries(cur, conn, remove_duplicate_users_queries)
-    run_queries(cur, conn, remove_duplicate_artists_queries)
-    print("User and artists duplicates removed.")
+    # Fails the run if the loaded tables don't pass the data quality checks:
+    if config.getboolean('QUALITY', 'enabled', fallback=True):
+        data_quality.check_tables(connections, config)
+    if config.getboolean('SURROGATE_KEYS', 'report', fallback=False):
+        with connections.connection() as conn:
+            surrogate_keys.report_on_connection(conn)
 
-    conn.close()
+    if own_connections:
+        connections.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Loads the staging, fact and dimension tables.")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the stages already done with the same inputs (see checkpoints.py)")
+    main(resume=parser.parse_args().resume)
\ No newline at end of file
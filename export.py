@@ -0,0 +1,220 @@
+"""
+This module exports the star schema to Parquet for the downstream teams, instead of row-by-row SELECTs
+through the leader node. On the cluster, each table is UNLOADed in parallel by the compute nodes to the S3
+prefix of section 'EXPORT' of dwh.cfg, with a manifest listing its files; songplays and time are partitioned by
+year and month (year=.../month=... prefixes, as the year and month of the time table).
+Locally, the tables are streamed from the local backend in record batches of fixed size (through a server-side
+cursor on Postgres) into the same layout of Parquet files under a local directory, with a manifest in the same
+format: memory stays flat whatever the size of the tables. pyarrow is needed for the local export only.
+Contains the following functions:
+- get_export_settings()
+- unload_query()
+- unload_table()
+- export_tables()
+- write_partitions()
+- export_local()
+- print_export_report()
+- main()
+
+Run 'python export.py' to export the tables of the cluster ('--local' for the local backend, '--tables' to
+choose the tables).
+"""
+import argparse
+import configparser
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+from sql_queries import table_unload
+
+# Query exporting each table and its partition columns. The year and month of songplays are computed from
+# start_time as in time_table_insert, rather than joined from time.
+EXPORT_TABLES = {
+    'songplays': {
+        'query': "SELECT songplay_id, start_time, user_id, level, song_key, artist_key, session_id, location, "
+                 "user_agent, loaded_at, "
+                 "CAST(date_part(year, (timestamp 'epoch' + ts * interval '1 second'/1000)) AS INT) AS year, "
+                 "CAST(date_part(month, (timestamp 'epoch' + ts * interval '1 second'/1000)) AS INT) AS month "
+                 "FROM (SELECT songplays.*, start_time AS ts FROM songplays) AS songplays_ts",
+        'partition_by': ['year', 'month'],
+    },
+    'users': {'query': "SELECT user_id, first_name, last_name, gender, level FROM users", 'partition_by': []},
+    'songs': {'query': "SELECT song_key, song_id, title, artist_key, artist_name, year, duration FROM songs",
+              'partition_by': []},
+    'artists': {'query': "SELECT artist_key, artist_id, name, location, latitude, longitude FROM artists",
+                'partition_by': []},
+    'time': {'query': "SELECT start_time, hour, day, week, month, year, weekday FROM time",
+             'partition_by': ['year', 'month']},
+}
+DEFAULT_SETTINGS = {'output': '', 'local_output': 'export', 'batch_rows': 100000, 'max_file_size': 256,
+                    'workers': 2}
+
+
+def get_export_settings(config):
+    """
+    Returns the settings of section 'EXPORT' of config (ConfigParser object) as a dictionary: output (S3 url of
+    the export), local_output (directory of the local export), batch_rows (int, rows of each record batch of the
+    local export), max_file_size (int, MB of each file UNLOADed) and workers (int, tables UNLOADed at a time).
+    """
+    return {
+        'output': config.get('EXPORT', 'output', fallback=DEFAULT_SETTINGS['output']).strip("'\"").rstrip('/'),
+        'local_output': config.get('EXPORT', 'local_output', fallback=DEFAULT_SETTINGS['local_output']),
+        'batch_rows': max(1, config.getint('EXPORT', 'batch_rows', fallback=DEFAULT_SETTINGS['batch_rows'])),
+        'max_file_size': config.getint('EXPORT', 'max_file_size', fallback=DEFAULT_SETTINGS['max_file_size']),
+        'workers': max(1, config.getint('EXPORT', 'workers', fallback=DEFAULT_SETTINGS['workers'])),
+    }
+
+
+def unload_query(table, settings):
+    """
+    Returns the UNLOAD statement exporting table 'table' (string, a key of EXPORT_TABLES) under the output of
+    'settings' (dictionary, see get_export_settings()).
+    """
+    spec = EXPORT_TABLES[table]
+    partition_by = f"PARTITION BY ({', '.join(spec['partition_by'])})" if spec['partition_by'] else ""
+    return table_unload.format(query=spec['query'].replace("'", "''"), target=f"{settings['output']}/{table}/",
+                               partition_by=partition_by, max_file_size=settings['max_file_size'])
+
+
+def unload_table(connections, table, settings):
+    """
+    UNLOADs table 'table' (string) on a connection of 'connections' (ConnectionManager object).
+    Returns a dictionary with the table, the url of its manifest and the duration in seconds.
+    """
+    start = time.perf_counter()
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            instrumentation.execute(cur, unload_query(table, settings), name=f"unload_{table}")
+        conn.commit()
+    return {'table': table, 'manifest': f"{settings['output']}/{table}/manifest",
+            'seconds': time.perf_counter() - start}
+
+
+def export_tables(connections, config, tables=None):
+    """
+    UNLOADs 'tables' (list of strings, all the tables of EXPORT_TABLES if None) concurrently, at most 'workers'
+    of section 'EXPORT' of config (ConfigParser object) at a time, each on its own connection of 'connections'
+    (ConnectionManager object).
+    Raises ValueError if no output is set. Returns the report: a list of dictionaries, see unload_table().
+    """
+    settings = get_export_settings(config)
+    if not settings['output'].startswith('s3://'):
+        raise ValueError("Set option 'output' of section 'EXPORT' in dwh.cfg to the S3 url of the export.")
+    tables = tables or list(EXPORT_TABLES)
+    with ThreadPoolExecutor(max_workers=min(settings['workers'], len(tables))) as executor:
+        return list(executor.map(lambda table: unload_table(connections, table, settings), tables))
+
+
+def write_partitions(batches, directory, partition_by, batch_rows):
+    """
+    Writes 'batches' (iterable of pyarrow RecordBatches) as Parquet files under 'directory' (string), one file
+    per value of the 'partition_by' columns (list of strings, in year=.../month=... directories, the columns
+    being dropped from the files), one row group per batch of at most 'batch_rows' (int) rows. The batches are
+    written as they come: only one is in memory at a time.
+    Returns the list of the files written, as dictionaries with keys path and rows.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writers = {}
+    files = {}
+    try:
+        for batch in batches:
+            data = pa.Table.from_batches([batch])
+            if partition_by:
+                groups = {}
+                for index, key in enumerate(zip(*(data.column(column).to_pylist() for column in partition_by))):
+                    groups.setdefault(key, []).append(index)
+                data = data.drop(partition_by)
+                parts = [(key, data.take(indices)) for key, indices in groups.items()]
+            else:
+                parts = [((), data)]
+            for key, part in parts:
+                if key not in writers:
+                    path = os.path.join(directory, *(f"{column}={value}" for column, value in zip(partition_by, key)),
+                                        'part-00000.parquet')
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writers[key] = pq.ParquetWriter(path, part.schema)
+                    files[key] = {'path': path, 'rows': 0}
+                writers[key].write_table(part, row_group_size=batch_rows)
+                files[key]['rows'] += part.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return list(files.values())
+
+
+def export_local(backend, settings, tables=None):
+    """
+    Exports 'tables' (list of strings, all the tables of EXPORT_TABLES if None) of 'backend' (DuckDbBackend or
+    PostgresBackend object, see local_backend.py) to Parquet files under local_output of 'settings' (dictionary,
+    see get_export_settings()), each table in its own directory (emptied first) with a manifest in the format of
+    UNLOAD MANIFEST VERBOSE.
+    Returns the report: a list of dictionaries with the table, the path of its manifest, its rows and the
+    duration in seconds.
+    """
+    report = []
+    for table in tables or list(EXPORT_TABLES):
+        start = time.perf_counter()
+        directory = os.path.join(settings['local_output'], table)
+        shutil.rmtree(directory, ignore_errors=True)
+        files = write_partitions(backend.stream_batches(EXPORT_TABLES[table]['query'], settings['batch_rows']),
+                                 directory, EXPORT_TABLES[table]['partition_by'], settings['batch_rows'])
+        entries = [{'url': os.path.abspath(file['path']),
+                    'meta': {'content_length': os.path.getsize(file['path']), 'record_count': file['rows']}}
+                   for file in files]
+        manifest = os.path.join(directory, 'manifest')
+        os.makedirs(directory, exist_ok=True)
+        with open(manifest, 'w') as manifest_file:
+            json.dump({'entries': entries,
+                       'meta': {'content_length': sum(entry['meta']['content_length'] for entry in entries),
+                                'record_count': sum(file['rows'] for file in files)}}, manifest_file, indent=2)
+        report.append({'table': table, 'manifest': manifest, 'rows': sum(file['rows'] for file in files),
+                       'seconds': time.perf_counter() - start})
+    return report
+
+
+def print_export_report(report):
+    """
+    Prints the report returned by export_tables() or export_local(), one line per table.
+    """
+    print("\nExport report:")
+    for entry in report:
+        rows = f"{entry['rows']} rows, " if 'rows' in entry else ""
+        print(f"- {entry['table']}: {rows}{entry['seconds']:.1f}s, manifest {entry['manifest']}")
+
+
+def main():
+    """
+    Exports the tables of the cluster of dwh.cfg, or of the local backend with '--local'.
+    """
+    parser = argparse.ArgumentParser(description="Exports the star schema to Parquet.")
+    parser.add_argument('--local', action='store_true', help="export the local backend (section LOCAL)")
+    parser.add_argument('--tables', nargs='+', choices=list(EXPORT_TABLES), help="tables to export (default: all)")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        try:
+            report = export_local(backend, get_export_settings(config), args.tables)
+        finally:
+            backend.close()
+    else:
+        from connection_manager import ConnectionManager
+        instrumentation.configure_from_config(config)
+        connections = ConnectionManager.from_config(config)
+        try:
+            report = export_tables(connections, config, args.tables)
+        finally:
+            connections.closeall()
+    print_export_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+This module loads only the S3 objects which have not been loaded yet, instead of dropping all the tables and
+re-loading the whole of LOG_DATA and SONG_DATA.
+The S3 keys already loaded are kept in table 'load_ledger' on the cluster. Each run lists the input prefixes,
+diffs them against the ledger, writes a COPY manifest covering only the new objects, loads them into the
+(truncated) staging tables and appends/merges them into the fact and dimension tables. The merges commit
+together with the new keys of the ledger, so a failed run leaves neither and is retried in full by the next.
+The full loads record nothing in the ledger: the first run after one copies every object again, the merges
+skipping the rows already loaded.
+All the functions take the boto3 S3 client as an argument so that they can run against a local S3 stand-in
+(e.g. moto).
+Contains the following functions:
+- split_s3_url()
+- list_prefix()
+- get_loaded_keys()
+- build_manifest()
+- upload_manifest()
+- record_loaded_keys()
+- load_new_objects()
+- main()
+"""
+import configparser
+import json
+import time
+
+import boto3
+from psycopg2.extras import execute_values
+
+import create_role_cluster as create_rc
+import etl
+import instrumentation
+import maintenance
+import parallel_loader as pl
+from connection_manager import ConnectionManager
+from unit_of_work import UnitOfWork, get_retry_settings
+from sql_queries import load_ledger_table_create, select_loaded_keys, insert_loaded_keys, \
+    staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, \
+    song_table_create, artist_table_create, time_table_create, staging_events_table_truncate, \
+    staging_songs_table_truncate, staging_events_manifest_copy, staging_songs_manifest_copy, \
+    incremental_merge_nodes, songplay_count, song_key_table_create, artist_key_table_create, \
+    daily_song_plays_table_create, hourly_level_plays_table_create, \
+    daily_user_plays_table_create, aggregate_watermark_table_create
+
+
+def split_s3_url(url):
+    """
+    Splits 's3://bucket/prefix' (string, quotes allowed as in dwh.cfg) into a tuple (bucket, prefix).
+    """
+    url = url.strip().strip("'\"")
+    if not url.startswith('s3://'):
+        raise ValueError(f"'{url}' is not an S3 url.")
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def list_prefix(s3_client, url):
+    """
+    Lists all the objects under S3 url 'url' (string) with s3_client (boto3 S3 client).
+    Returns a dictionary mapping each object key to its size in bytes.
+    """
+    bucket, prefix = split_s3_url(url)
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if not item['Key'].endswith('/'):
+                objects[item['Key']] = item['Size']
+    return objects
+
+
+def get_loaded_keys(cur, prefix):
+    """
+    Returns the set of S3 keys recorded in the load ledger for input prefix 'prefix' (string).
+    """
+    cur.execute(select_loaded_keys, (prefix,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def build_manifest(bucket, objects):
+    """
+    Returns the Redshift COPY manifest (dictionary) listing the objects in 'objects' (dictionary key -> size)
+    of bucket 'bucket' (string).
+    """
+    return {'entries': [{'url': f"s3://{bucket}/{key}", 'mandatory': True,
+                         'meta': {'content_length': size}}
+                        for key, size in sorted(objects.items())]}
+
+
+def upload_manifest(s3_client, manifest_prefix, name, manifest):
+    """
+    Writes 'manifest' (dictionary) as JSON under S3 url 'manifest_prefix' (string), in an object named after
+    'name' (string) and the current time.
+    Returns the S3 url of the manifest.
+    """
+    bucket, prefix = split_s3_url(manifest_prefix)
+    key = f"{prefix.rstrip('/')}/{name}-{time.strftime('%Y%m%dT%H%M%S')}.manifest".lstrip('/')
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    return f"s3://{bucket}/{key}"
+
+
+def record_loaded_keys(cur, prefix, objects):
+    """
+    Records the keys in 'objects' (dictionary key -> size) as loaded for input prefix 'prefix' (string), in the
+    current transaction of cursor 'cur': they are committed with the load of the objects.
+    """
+    execute_values(cur, insert_loaded_keys, [(key, prefix, size) for key, size in objects.items()],
+                   page_size=1000)
+
+
+def load_new_objects(s3_client, cur, conn, connections, config):
+    """
+    Runs one incremental load:
+    1. creates the schema, the tables and the load ledger if they don't exist (nothing is dropped), and grants
+       the readers access to them,
+    2. lists the LOG_DATA and SONG_DATA prefixes and diffs them against the ledger,
+    3. writes a manifest for each prefix with new objects and COPYs them into the truncated staging tables,
+    4. appends/merges the staging tables into the fact and dimension tables, checks the songplays added and
+       records the new keys in the ledger, all in a single transaction.
+    'cur' and 'conn' are a cursor and its connection, taken from 'connections' (ConnectionManager object)
+    which also provides the connections of the parallel stages.
+    Returns a dictionary mapping each input prefix to the number of new objects loaded.
+    """
+    UnitOfWork(conn, **get_retry_settings(config)).run(
+        connections.schema_statements() +
+        [load_ledger_table_create, staging_events_table_create, staging_songs_table_create, songplay_table_create,
+         user_table_create, song_table_create, artist_table_create, time_table_create, song_key_table_create,
+         artist_key_table_create,
+         daily_song_plays_table_create, hourly_level_plays_table_create, daily_user_plays_table_create,
+         aggregate_watermark_table_create] + connections.grant_statements())
+    # TRUNCATE commits implicitly on Redshift, so it can't be part of the unit of work above.
+    for query in [staging_events_table_truncate, staging_songs_table_truncate]:
+        cur.execute(query)
+        conn.commit()
+
+    inputs = [('LOG_DATA', 'staging_events', staging_events_manifest_copy),
+              ('SONG_DATA', 'staging_songs', staging_songs_manifest_copy)]
+    manifest_prefix = config.get('INCREMENTAL', 'manifest_prefix')
+    copy_queries = []
+    new_objects = {}
+    for option, table, copy_query in inputs:
+        prefix = config.get('S3', option).strip("'\"")
+        bucket, _ = split_s3_url(prefix)
+        objects = list_prefix(s3_client, prefix)
+        loaded = get_loaded_keys(cur, prefix)
+        new_objects[prefix] = {key: size for key, size in objects.items() if key not in loaded}
+        print(f"{prefix}: {len(objects)} objects, {len(new_objects[prefix])} not loaded yet.")
+        if new_objects[prefix]:
+            manifest_url = upload_manifest(s3_client, manifest_prefix, table,
+                                           build_manifest(bucket, new_objects[prefix]))
+            copy_queries.append(copy_query.format(manifest_url))
+
+    if not copy_queries:
+        print("No new objects to load.")
+        return {prefix: 0 for prefix in new_objects}
+
+    report = pl.load_staging_tables_parallel(connections, copy_queries, pl.get_staging_workers(config))
+    pl.print_timing_report(report)
+    cur.execute(songplay_count)
+    songplays_before = cur.fetchone()[0]
+    conn.commit()
+
+    def check_and_record(unit_cur):
+        etl.check_songplay_row_count(unit_cur, songplays_before)
+        for prefix, objects in new_objects.items():
+            if objects:
+                record_loaded_keys(unit_cur, prefix, objects)
+
+    # The merges, their check and the keys of the ledger commit together, the merges running one after the
+    # other in the order of incremental_merge_nodes: a failure appends nothing and records nothing, so the
+    # next run loads the same objects again instead of appending the merged rows twice.
+    UnitOfWork(conn, **get_retry_settings(config)).run([node['query'] for node in incremental_merge_nodes],
+                                                       [node['name'] for node in incremental_merge_nodes],
+                                                       before_commit=check_and_record)
+    return {prefix: len(objects) for prefix, objects in new_objects.items()}
+
+
+def main(connections=None):
+    """
+    Runs an incremental load on the cluster described in dwh.cfg, on connections of 'connections'
+    (ConnectionManager object shared by the stages of the run, one is created from dwh.cfg if None).
+    """
+    aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+    config = configparser.ConfigParser()
+    config.read(create_rc.CONFIG_FILE_NAME)
+    instrumentation.configure_from_config(config)
+    own_connections = connections is None
+    if own_connections:
+        connections = ConnectionManager.from_config(config)
+
+    s3 = boto3.client('s3',
+                      region_name=config.get('AWS', 'region'),
+                      aws_access_key_id=aws_cred.key,
+                      aws_secret_access_key=aws_cred.secret
+                      )
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            loaded = load_new_objects(s3, cur, conn, connections, config)
+    print(f"Incremental load done: {sum(loaded.values())} new object(s) loaded.")
+    if sum(loaded.values()) and config.getboolean('MAINTENANCE', 'enabled', fallback=False):
+        maintenance.maintain_tables(connections, config)
+
+    if own_connections:
+        connections.closeall()
+
+
+if __name__ == "__main__":
+    main()
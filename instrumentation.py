@@ -0,0 +1,121 @@
+"""
+This module instruments the execution of the SQL statements: every statement run through execute() is
+recorded with a stable query name, its wall time, cur.rowcount and, on Redshift, the query ID, the bytes
+loaded by a COPY and optionally the per-step statistics of the query (SVL_QUERY_SUMMARY).
+Records are emitted as JSON lines to a file and/or passed to a metrics callback, and a one-line summary is
+printed instead of the SQL text.
+Contains the following functions:
+- configure()
+- configure_from_config()
+- query_name()
+- execute()
+- emit()
+"""
+import datetime
+import json
+import re
+import threading
+import time
+
+import sql_queries
+
+# Settings set by configure(). The records of all the threads go to the same sink.
+settings = {'metrics_file': None, 'callback': None, 'redshift': False, 'query_stats': False, 'verbose': True}
+lock = threading.Lock()
+
+last_query_id = "SELECT PG_LAST_QUERY_ID();"
+last_copy_bytes = ("""
+    SELECT COALESCE(SUM(transfer_size), 0) FROM stl_s3client WHERE query = PG_LAST_COPY_ID();
+""")
+query_step_stats = ("""
+    SELECT stm, seg, step, label, rows, bytes, maxtime, is_diskbased
+    FROM svl_query_summary
+    WHERE query = %s
+    ORDER BY stm, seg, step;
+""")
+
+
+def configure(metrics_file=None, callback=None, redshift=False, query_stats=False, verbose=True):
+    """
+    Sets where the records go: 'metrics_file' (string, JSON lines appended to it), 'callback' (callable
+    receiving each record as a dictionary). 'redshift' (bool) fetches the query ID and COPY bytes from the
+    Redshift system functions and tables, 'query_stats' (bool) also fetches the per-step statistics.
+    'verbose' (bool) prints a one-line summary of each statement.
+    """
+    settings.update({'metrics_file': metrics_file, 'callback': callback, 'redshift': redshift,
+                     'query_stats': query_stats, 'verbose': verbose})
+
+
+def configure_from_config(config, callback=None):
+    """
+    Configures the instrumentation from section 'METRICS' of config (ConfigParser object): options
+    metrics_file, redshift, query_stats and verbose.
+    """
+    configure(metrics_file=config.get('METRICS', 'metrics_file', fallback=None) or None,
+              callback=callback,
+              redshift=config.getboolean('METRICS', 'redshift', fallback=False),
+              query_stats=config.getboolean('METRICS', 'query_stats', fallback=False),
+              verbose=config.getboolean('METRICS', 'verbose', fallback=True))
+
+
+def query_name(query):
+    """
+    Returns a stable name for 'query' (string): the name of the variable holding it in sql_queries.py
+    (e.g. 'songplay_table_insert'), or '<verb>_<table>' (e.g. 'copy_staging_events') for queries built
+    at run time.
+    """
+    for name, value in vars(sql_queries).items():
+        if isinstance(value, str) and value == query:
+            return name
+    match = re.match(r"\s*(\w+)\s+(?:INTO\s+|FROM\s+|TABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?)?(\w+)",
+                     query, re.IGNORECASE)
+    return f"{match.group(1)}_{match.group(2)}".lower() if match else 'query'
+
+
+def execute(cur, query, params=None, name=None):
+    """
+    Executes 'query' (string) with 'params' (optional) on cursor 'cur' and emits its record.
+    'name' (string) defaults to query_name(query).
+    Returns the record (dictionary). Errors are recorded then raised.
+    """
+    record = {'name': name or query_name(query),
+              'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')}
+    start = time.perf_counter()
+    try:
+        cur.execute(query, params)
+    except Exception as e:
+        record.update({'seconds': time.perf_counter() - start, 'status': 'error', 'error': str(e).strip()})
+        emit(record)
+        raise
+    record.update({'seconds': time.perf_counter() - start, 'status': 'ok', 'rowcount': cur.rowcount})
+
+    if settings['redshift']:
+        # On a cursor of its own, so that the result set of 'query' is left for the caller to fetch. The
+        # connection is the same: PG_LAST_QUERY_ID() is per session.
+        with cur.connection.cursor() as stats_cur:
+            stats_cur.execute(last_query_id)
+            record['query_id'] = stats_cur.fetchone()[0]
+            if record['name'].startswith('copy') or query.lstrip().upper().startswith('COPY'):
+                stats_cur.execute(last_copy_bytes)
+                record['bytes_loaded'] = stats_cur.fetchone()[0]
+            if settings['query_stats']:
+                stats_cur.execute(query_step_stats, (record['query_id'],))
+                columns = [column[0] for column in stats_cur.description]
+                record['steps'] = [dict(zip(columns, row)) for row in stats_cur.fetchall()]
+    emit(record)
+    return record
+
+
+def emit(record):
+    """
+    Sends 'record' (dictionary) to the metrics file and callback, and prints its summary if verbose.
+    """
+    with lock:
+        if settings['metrics_file']:
+            with open(settings['metrics_file'], 'a') as metrics_file:
+                metrics_file.write(json.dumps(record, default=str) + '\n')
+        if settings['callback']:
+            settings['callback'](record)
+        if settings['verbose']:
+            details = f"{record['rowcount']} row(s)" if record['status'] == 'ok' else f"failed: {record['error']}"
+            print(f"Query {record['name']} executed in {record['seconds']:.2f}s, {details}.")
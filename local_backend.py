@@ -0,0 +1,329 @@
+"""
+This module runs the whole pipeline (create_tables then etl) locally, on an embedded DuckDB database or a
+local Postgres, reading the JSON files from local directories instead of S3. It is meant to iterate on the
+transformations and profile them in seconds on a sample, without waiting for a Redshift cluster.
+The queries of sql_queries.py are translated into the local dialect: Redshift physical design (diststyle,
+distkey, sortkey) is dropped, IDENTITY columns become sequences/identity columns, the informational
+PRIMARY KEY of staging_songs is dropped (Redshift doesn't enforce it) and the COPY statements are replaced
+by a local load of the JSON directories.
+Contains the following functions:
+- translate_query()
+- arrow_type()
+- list_json_files()
+- read_json_file()
+- read_json_records()
+- to_row()
+- write_staging_csv()
+- get_backend()
+- run_pipeline()
+- main()
+and the following classes:
+- DuckDbBackend
+- PostgresBackend.
+
+Run 'python local_backend.py' to run the pipeline with the settings of section 'LOCAL' in dwh.cfg.
+"""
+import configparser
+import csv
+import glob
+import json
+import os
+import re
+import tempfile
+import time
+
+from sql_queries import drop_table_queries, create_table_queries, insert_table_nodes, songplay_count, \
+    nextsong_event_count
+
+# Mapping of the staging columns to the JSON fields, in column order (same as LOG_JSONPATH for the events).
+STAGING_COLUMNS = {
+    'staging_events': [('artist', 'artist'), ('auth', 'auth'), ('first_name', 'firstName'), ('gender', 'gender'),
+                       ('item_in_session', 'itemInSession'), ('last_name', 'lastName'), ('length', 'length'),
+                       ('level', 'level'), ('location', 'location'), ('method', 'method'), ('page', 'page'),
+                       ('registration', 'registration'), ('session_id', 'sessionId'), ('song', 'song'),
+                       ('status', 'status'), ('ts', 'ts'), ('user_agent', 'userAgent'), ('user_id', 'userId')],
+    'staging_songs': [('num_songs', 'num_songs'), ('artist_id', 'artist_id'),
+                      ('artist_latitude', 'artist_latitude'), ('artist_longitude', 'artist_longitude'),
+                      ('artist_location', 'artist_location'), ('artist_name', 'artist_name'),
+                      ('song_id', 'song_id'), ('title', 'title'), ('duration', 'duration'), ('year', 'year')],
+}
+# Staging table of the micro-batches of stream_ingest.py:
+STAGING_COLUMNS['staging_events_stream'] = STAGING_COLUMNS['staging_events']
+# Columns loaded as integers: Redshift COPY turns the empty strings of the logs (e.g. userId) into NULL.
+INTEGER_COLUMNS = ['item_in_session', 'registration', 'session_id', 'status', 'ts', 'user_id', 'num_songs', 'year']
+
+# Arrow type of the Postgres type OIDs of the star schema (see PostgresBackend.stream_batches()):
+POSTGRES_ARROW_TYPES = {16: 'bool_', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float32', 701: 'float64',
+                        1700: 'float64', 1114: 'timestamp', 1184: 'timestamp'}
+
+REDSHIFT_EPOCH_EXPRESSION = "(timestamp 'epoch' + ts * interval '1 second'/1000)"
+LOCAL_EPOCH_EXPRESSIONS = {'duckdb': "epoch_ms(ts)",
+                           'postgres': "(timestamp 'epoch' + ts * interval '1 millisecond')"}
+
+
+def translate_query(query, dialect):
+    """
+    Translates 'query' (string, Redshift SQL from sql_queries.py) into 'dialect' (string, 'duckdb' or
+    'postgres'). Returns the translated query.
+    """
+    query = re.sub(r"\)\s*diststyle\s+\w+", ")", query, flags=re.IGNORECASE)
+    query = re.sub(r"\s+(distkey|sortkey)\b", "", query, flags=re.IGNORECASE)
+    query = re.sub(r"\s+PRIMARY KEY\b", "", query, flags=re.IGNORECASE)
+    query = re.sub(r"GETDATE\(\)", "CURRENT_TIMESTAMP", query, flags=re.IGNORECASE)
+
+    identity = re.search(r"INT IDENTITY\((\d+),\s*(\d+)\)", query, flags=re.IGNORECASE)
+    if identity:
+        start, step = identity.groups()
+        if dialect == 'duckdb':
+            table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", query, flags=re.IGNORECASE).group(1)
+            sequence = f"{table}_identity_seq"
+            query = f"CREATE SEQUENCE IF NOT EXISTS {sequence} START {start} INCREMENT {step} MINVALUE {start};\n" + \
+                query.replace(identity.group(0), f"BIGINT DEFAULT nextval('{sequence}')")
+        else:
+            query = query.replace(identity.group(0), f"BIGINT GENERATED BY DEFAULT AS IDENTITY "
+                                                     f"(START {start} INCREMENT {step} MINVALUE {start})")
+
+    if REDSHIFT_EPOCH_EXPRESSION in query:
+        # DuckDB can't multiply an interval by a BIGINT, Postgres can't reference the start_time alias in
+        # the same SELECT, nor use the 'weekday' unit.
+        local_expression = LOCAL_EPOCH_EXPRESSIONS[dialect]
+        query = query.replace(REDSHIFT_EPOCH_EXPRESSION, local_expression)
+        if dialect == 'postgres':
+            query = re.sub(r"date_part\((\w+),\s*start_time\)",
+                           lambda match: f"date_part('{match.group(1)}', {local_expression})", query)
+            query = query.replace("date_part('weekday'", "date_part('dow'")
+    # Redshift accepts unquoted date parts, DuckDB and Postgres need a string.
+    query = re.sub(r"date_part\((\w+),", r"date_part('\1',", query)
+    if dialect == 'duckdb':
+        # DuckDB's OCTET_LENGTH only takes blobs.
+        query = re.sub(r"OCTET_LENGTH\(", "strlen(", query, flags=re.IGNORECASE)
+    return query
+
+
+def arrow_type(type_code):
+    """
+    Returns the pyarrow type of the Postgres type OID 'type_code' (int), string if it isn't in POSTGRES_ARROW_TYPES.
+    """
+    import pyarrow as pa
+    name = POSTGRES_ARROW_TYPES.get(type_code, 'string')
+    return pa.timestamp('us') if name == 'timestamp' else getattr(pa, name)()
+
+
+def list_json_files(directory):
+    """
+    Returns the sorted list of the .json files under 'directory' (string), recursively.
+    """
+    return sorted(glob.glob(os.path.join(directory, '**', '*.json'), recursive=True))
+
+
+def read_json_file(path):
+    """
+    Yields the JSON records (dictionaries) of file 'path' (string), which can hold one record per line
+    (log files) or a single record (song files).
+    """
+    with open(path) as json_file:
+        for line in json_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_json_records(directory, paths=None):
+    """
+    Yields the JSON records (dictionaries) of all the .json files under 'directory' (string), recursively, or
+    of the files 'paths' (list of strings) if given.
+    """
+    for path in list_json_files(directory) if paths is None else paths:
+        yield from read_json_file(path)
+
+
+def to_row(record, mapping):
+    """
+    Returns the values of 'record' (dictionary) in the order of 'mapping' (list of (column, field)),
+    the integer columns being cast to int (empty strings turned into None).
+    """
+    row = []
+    for column, field in mapping:
+        value = record.get(field)
+        if column in INTEGER_COLUMNS and value is not None:
+            value = int(float(value)) if value != '' else None
+        row.append(value)
+    return row
+
+
+def write_staging_csv(table, records, csv_file):
+    """
+    Writes 'records' (iterable of JSON records) as CSV rows for staging table 'table' (string) to
+    csv_file (text file object), NULL values being written as \\N. Records are streamed one at a time.
+    Returns the number of rows written.
+    """
+    mapping = STAGING_COLUMNS[table]
+    writer = csv.writer(csv_file, lineterminator='\n')
+    count = 0
+    for record in records:
+        writer.writerow(['\\N' if value is None else value for value in to_row(record, mapping)])
+        count += 1
+    csv_file.flush()
+    return count
+
+
+class DuckDbBackend:
+    """
+    Embedded DuckDB backend, the database being stored in file 'path' (string, ':memory:' by default).
+    """
+    dialect = 'duckdb'
+
+    def __init__(self, path=':memory:'):
+        import duckdb
+        self.conn = duckdb.connect(path)
+
+    def execute(self, query):
+        """
+        Runs 'query' (string, Redshift SQL) translated into DuckDB SQL.
+        Returns the rows of the last statement if any, None otherwise.
+        """
+        self.conn.execute(translate_query(query, self.dialect))
+        return self.conn.fetchall() if self.conn.description else None
+
+    def stream_batches(self, query, batch_rows):
+        """
+        Runs 'query' (string, Redshift SQL) translated into DuckDB SQL and yields its result as pyarrow
+        RecordBatches of at most 'batch_rows' (int) rows, fetched one at a time.
+        """
+        self.conn.execute(translate_query(query, self.dialect))
+        yield from self.conn.fetch_record_batch(batch_rows)
+
+    def load_staging(self, table, directory, paths=None):
+        """
+        Loads the JSON files under 'directory' (string), or the files 'paths' (list of strings) if given, into
+        staging table 'table' (string), through a temporary CSV file and COPY.
+        """
+        columns = ', '.join(column for column, _ in STAGING_COLUMNS[table])
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as csv_file:
+            write_staging_csv(table, read_json_records(directory, paths), csv_file)
+            self.conn.execute(f"COPY {table} ({columns}) FROM '{csv_file.name}' "
+                              f"(FORMAT csv, HEADER false, DELIMITER ',', QUOTE '\"', ESCAPE '\"', NULLSTR '\\N')")
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgresBackend:
+    """
+    Local Postgres backend, connecting to the database described by 'dsn' (string).
+    """
+    dialect = 'postgres'
+
+    def __init__(self, dsn):
+        import psycopg2 as pg
+        self.conn = pg.connect(dsn)
+        self.conn.autocommit = True
+
+    def execute(self, query):
+        """
+        Runs 'query' (string, Redshift SQL) translated into Postgres SQL.
+        Returns the rows of the last statement if any, None otherwise.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(translate_query(query, self.dialect))
+            return cur.fetchall() if cur.description else None
+
+    def stream_batches(self, query, batch_rows):
+        """
+        Runs 'query' (string, Redshift SQL) translated into Postgres SQL on a server-side cursor and yields its
+        result as pyarrow RecordBatches of at most 'batch_rows' (int) rows, fetched one at a time. The cursor
+        needs a transaction: autocommit is off for the duration.
+        """
+        import pyarrow as pa
+        self.conn.autocommit = False
+        try:
+            with self.conn.cursor(name='stream_batches') as cur:
+                cur.itersize = batch_rows
+                cur.execute(translate_query(query, self.dialect))
+                rows = cur.fetchmany(batch_rows)
+                # The description of a named cursor is only known once the first rows are fetched:
+                schema = pa.schema([(column.name, arrow_type(column.type_code)) for column in cur.description])
+                while rows:
+                    columns = []
+                    for values, field in zip(zip(*rows), schema):
+                        if pa.types.is_floating(field.type):
+                            # NUMERIC columns are fetched as Decimal.
+                            values = [None if value is None else float(value) for value in values]
+                        columns.append(pa.array(values, type=field.type))
+                    yield pa.RecordBatch.from_arrays(columns, schema=schema)
+                    rows = cur.fetchmany(batch_rows)
+            self.conn.commit()
+        finally:
+            self.conn.autocommit = True
+
+    def load_staging(self, table, directory, paths=None):
+        """
+        Loads the JSON files under 'directory' (string), or the files 'paths' (list of strings) if given, into
+        staging table 'table' (string), through a temporary CSV file streamed with COPY FROM STDIN.
+        """
+        columns = ', '.join(column for column, _ in STAGING_COLUMNS[table])
+        with tempfile.TemporaryFile('w+') as csv_file:
+            write_staging_csv(table, read_json_records(directory, paths), csv_file)
+            csv_file.seek(0)
+            with self.conn.cursor() as cur:
+                cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", csv_file)
+
+    def close(self):
+        self.conn.close()
+
+
+def get_backend(config):
+    """
+    Returns the backend set by option 'backend' of section 'LOCAL' in config (ConfigParser object):
+    'duckdb' (database file 'duckdb_path') or 'postgres' (connection string 'pg_dsn').
+    """
+    backend = config.get('LOCAL', 'backend', fallback='duckdb')
+    if backend == 'duckdb':
+        return DuckDbBackend(config.get('LOCAL', 'duckdb_path', fallback=':memory:'))
+    if backend == 'postgres':
+        return PostgresBackend(config.get('LOCAL', 'pg_dsn'))
+    raise ValueError(f"Unknown local backend '{backend}', use 'duckdb' or 'postgres'.")
+
+
+def run_pipeline(backend, log_dir, song_dir):
+    """
+    Runs create_tables then etl on 'backend' (DuckDbBackend or PostgresBackend object), loading the
+    staging tables from directories log_dir and song_dir (strings).
+    Prints and returns the duration of each step in seconds (dictionary step name -> seconds).
+    """
+    timings = {}
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        function(*args)
+        timings[name] = time.perf_counter() - start
+        print(f"{name}: {timings[name]:.2f}s")
+
+    timed('drop_tables', lambda: [backend.execute(query) for query in drop_table_queries])
+    timed('create_tables', lambda: [backend.execute(query) for query in create_table_queries])
+    timed('copy_staging_events', backend.load_staging, 'staging_events', log_dir)
+    timed('copy_staging_songs', backend.load_staging, 'staging_songs', song_dir)
+    for node in insert_table_nodes:
+        timed(node['name'], backend.execute, node['query'])
+
+    songplays, events = backend.execute(songplay_count)[0][0], backend.execute(nextsong_event_count)[0][0]
+    if songplays > events:
+        raise ValueError(f"songplays received {songplays} rows from only {events} 'NextSong' events. Aborting.")
+    print(f"songplays: {songplays} rows from {events} 'NextSong' events.")
+    return timings
+
+
+def main():
+    """
+    Runs the pipeline locally with the settings of section 'LOCAL' in dwh.cfg.
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    try:
+        run_pipeline(backend, config.get('LOCAL', 'log_data'), config.get('LOCAL', 'song_data'))
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,19 @@
+import argparse
+import configparser
+import boto3
+import blue_green
+import capacity_scheduler as capacity
+import checkpoints
 import create_role_cluster as create_rc
 import check_role_cluster as check_rc
 import create_tables
 import sys
-import time
 import etl
+import incremental_load
+import provisioning
+import stream_ingest
+from botocore.exceptions import WaiterError
+from connection_manager import ConnectionManager
 
 
 def advanced_input(authorised_input):
@@ -29,14 +39,19 @@ def advanced_input(authorised_input):
             return user_input
 
 
-def main():
-    """Launches all the steps required to create the data tables in redshift."""
+def main(resume=False):
+    """
+    Launches all the steps required to create the data tables in redshift.
+    With 'resume' (bool), a full load skips the stages already done with the same inputs by the previous
+    run, the tables being kept (see checkpoints.py).
+    """
 
     # Launches the creation of an IAM role and redshift clusters if they don't already exists:
     client, cluster_name = create_rc.main()
 
     # Check redshift cluster's availability. If available, create the tables:
-    cluster_status = check_rc.check_cluster_status(client, cluster_name)
+    cluster_state = check_rc.ClusterState(client, cluster_name)
+    cluster_status = cluster_state.status
 
     if cluster_status == 'creating':
         print(f"Cluster '{cluster_name}' is being created.\n" +
@@ -49,28 +64,68 @@ def main():
             sys.exit(0)
         elif waiting.lower() == 'w':
             print("Waiting...")
-            while cluster_status == 'creating':
-                time.sleep(20)
-                cluster_status = check_rc.check_cluster_status(client, cluster_name)
-                print(f"Waiting... cluster status: {cluster_status}.")
+            try:
+                provisioning.wait_until_available(client, cluster_name)
+            except WaiterError as e:
+                print(f"\033[0;31m{e}\033[0m")
+            cluster_state.refresh()
+            cluster_status = cluster_state.status
+
+    # TODO: remove local reference to 'dwh.cfg'.
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if cluster_status == 'paused':
+        # Paused by the capacity scheduler at the end of the previous load:
+        capacity.resume_if_paused(client, cluster_name, capacity.get_capacity_settings(config))
+        cluster_state.refresh()
+        cluster_status = cluster_state.status
 
     if cluster_status == 'available':
-        cluster = client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
-        # TODO: remove local reference to 'dwh.cfg'.
-        create_rc.update_section_key('dwh.cfg', 'CLUSTER', 'cl_endpoint', cluster['Endpoint']['Address'])
+        create_rc.update_section_key('dwh.cfg', 'CLUSTER', 'cl_endpoint', cluster_state.endpoint)
 
         # When cluster available ask the user if she wants to launch the etl process:
         print(f"Cluster '{cluster_name}' available.\n" +
-              "Do you want to create tables and launch the ETL process? Yes (Y), No (n)?\n" +
-              "This will drop existing tables, re-create them and load data.")
-        valid_choices = ['y', 'Y', 'n', 'N']
+              "Do you want to create tables and launch the ETL process? "
+              "Yes (Y), Blue/green (B), Incremental (I), Streaming (S), No (n)?\n" +
+              "Yes will drop existing tables, re-create them and load data" +
+              (" (with --resume: only the stages not done yet).\n" if resume else ".\n") +
+              "Blue/green will load the tables into a shadow schema and swap it with the live one once validated.\n" +
+              "Incremental will only load the S3 objects which haven't been loaded yet.\n" +
+              "Streaming will keep loading the new event logs in micro-batches until interrupted (Ctrl+C).")
+        valid_choices = ['y', 'Y', 'b', 'B', 'i', 'I', 's', 'S', 'n', 'N']
         launch_etl = advanced_input(valid_choices)
-        if launch_etl.lower() == 'y':
-            create_tables.main()
-            etl.main()
-        else:
+        if launch_etl.lower() not in ['y', 'b', 'i', 's']:
             sys.exit(0)
 
+        # One pool of connections for all the stages of the run:
+        connections = ConnectionManager.from_config(config)
+
+        def full_load():
+            if launch_etl.lower() == 'b':
+                # The live tables keep serving reads until the new ones are swapped in:
+                blue_green.deploy(connections, config, resume)
+                return
+            plan = checkpoints.prepare_run(connections, config, resume)
+            create_tables.main(connections, plan)
+            etl.main(connections, plan)
+
+        try:
+            if launch_etl.lower() in ['y', 'b'] and config.getboolean('CAPACITY', 'enabled', fallback=False):
+                # Resize the cluster for the data to load, and back (or pause it) once loaded:
+                aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+                s3 = boto3.client('s3', region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                                  aws_secret_access_key=aws_cred.secret)
+                capacity.run_with_capacity(client, s3, config, full_load)
+            elif launch_etl.lower() in ['y', 'b']:
+                full_load()
+            elif launch_etl.lower() == 's':
+                stream_ingest.main(connections)
+            else:
+                incremental_load.main(connections)
+        finally:
+            connections.print_summary()
+            connections.closeall()
+
     else:
         print(f"Cluster '{cluster_name}' current status: '{cluster_status}'.\n"
               "Please activate or repair the cluster and relaunch the program.\n"
@@ -81,4 +136,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Creates the cluster and the tables and loads the data.")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume the previous full load, skipping the stages already done with the same "
+                             "inputs (see checkpoints.py)")
+    main(resume=parser.parse_args().resume)
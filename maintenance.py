@@ -0,0 +1,230 @@
+"""
+This module maintains the tables after a load. The inserts leave unsorted regions in the sorted tables, the
+upserts delete rows that stay on disk until they are vacuumed, and the statistics of the planner go stale. The
+health of each loaded table is read (staleness of the statistics, unsorted and deleted rows, in percent) and
+only the tables over the thresholds of section 'MAINTENANCE' of dwh.cfg are maintained: VACUUM DELETE ONLY,
+VACUUM SORT ONLY (down to the unsorted threshold) then ANALYZE, the worst tables first, until the time budget
+is spent. The health of each table is printed before and after.
+The health readings and the maintenance statements are behind a small interface (read_health(), run() and
+attribute 'actions'), implemented for Redshift by RedshiftTableHealth and for the local backend by the
+stand-in LocalTableHealth.
+Contains the following functions:
+- get_maintenance_settings()
+- plan_maintenance()
+- run_maintenance()
+- print_health()
+- maintain_tables()
+- main()
+and the following classes:
+- RedshiftTableHealth
+- LocalTableHealth.
+
+Run 'python maintenance.py' to maintain the tables of the cluster ('--local' for the local backend).
+"""
+import argparse
+import configparser
+import time
+
+import instrumentation
+from sql_queries import table_health, table_analyze, table_vacuum_sort, table_vacuum_delete, aggregate_table_names
+
+MAINTAINED_TABLES = ['songplays', 'users', 'songs', 'artists', 'time', 'song_keys', 'artist_keys'] + \
+    aggregate_table_names
+# Order of the actions on a table: the statistics are computed once the table is vacuumed.
+ACTIONS = ['delete', 'sort', 'analyze']
+# Health measure and threshold setting of each action:
+ACTION_MEASURES = {'delete': ('deleted', 'max_deleted'), 'sort': ('unsorted', 'max_unsorted'),
+                   'analyze': ('stats_off', 'max_stats_off')}
+DEFAULT_SETTINGS = {'max_stats_off': 10.0, 'max_unsorted': 10.0, 'max_deleted': 10.0, 'time_budget': 1800}
+
+
+class RedshiftTableHealth:
+    """
+    Health readings and maintenance of the tables of the current schema of a Redshift cluster, on connection
+    'conn' (psycopg2 connection in autocommit mode: VACUUM can't run in a transaction).
+    """
+    actions = ACTIONS
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def read_health(self, tables):
+        """
+        Returns a dictionary mapping each table of 'tables' (list of strings) to a dictionary with keys rows,
+        stats_off, unsorted and deleted (floats, percent), read from svv_table_info. Empty tables are healthy.
+        """
+        health = {table: {'rows': 0, 'stats_off': 0.0, 'unsorted': 0.0, 'deleted': 0.0} for table in tables}
+        with self.conn.cursor() as cur:
+            cur.execute(table_health, (tuple(tables),))
+            for table, stats_off, unsorted, rows, visible_rows in cur.fetchall():
+                health[table.strip()] = {'rows': rows, 'stats_off': float(stats_off), 'unsorted': float(unsorted),
+                                         'deleted': 100.0 * (rows - visible_rows) / rows if rows else 0.0}
+        return health
+
+    def run(self, action, table, settings):
+        """
+        Runs 'action' (string, one of ACTIONS) on table 'table' (string), the sort going down to the
+        max_unsorted threshold of 'settings' (dictionary, see get_maintenance_settings()).
+        """
+        query = {'delete': table_vacuum_delete, 'sort': table_vacuum_sort, 'analyze': table_analyze}[action]
+        with self.conn.cursor() as cur:
+            instrumentation.execute(cur, query.format(table=table,
+                                                      threshold=int(100 - settings['max_unsorted'])))
+
+
+class LocalTableHealth:
+    """
+    Stand-in of RedshiftTableHealth for the local backend 'backend' (DuckDbBackend or PostgresBackend object,
+    see local_backend.py): the tables have no sort keys nor deleted rows to measure, and the staleness of the
+    statistics is the change of the row count of a table since it was last analyzed through this object
+    (100% if it wasn't). Only ANALYZE is run.
+    """
+    actions = ['analyze']
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.analyzed_rows = {}
+
+    def read_health(self, tables):
+        """
+        Returns the health of 'tables' (list of strings), see RedshiftTableHealth.read_health().
+        """
+        health = {}
+        for table in tables:
+            rows = self.backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0]
+            analyzed = self.analyzed_rows.get(table)
+            stats_off = 100.0 if analyzed is None else 100.0 * abs(rows - analyzed) / max(rows, analyzed, 1)
+            health[table] = {'rows': rows, 'stats_off': stats_off if rows else 0.0, 'unsorted': 0.0,
+                             'deleted': 0.0}
+        return health
+
+    def run(self, action, table, settings):
+        """
+        Runs 'action' (string, 'analyze') on table 'table' (string). 'settings' is unused.
+        """
+        self.backend.execute(table_analyze.format(table=table))
+        self.analyzed_rows[table] = self.backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0]
+
+
+def get_maintenance_settings(config):
+    """
+    Returns the settings of section 'MAINTENANCE' of config (ConfigParser object) as a dictionary:
+    max_stats_off, max_unsorted, max_deleted (floats, percent above which a table is analyzed, sorted, vacuumed)
+    and time_budget (float, seconds after which no new action is started).
+    """
+    settings = {key: config.getfloat('MAINTENANCE', key, fallback=default)
+                for key, default in DEFAULT_SETTINGS.items()}
+    for key in ['max_stats_off', 'max_unsorted', 'max_deleted']:
+        if not 0 <= settings[key] < 100:
+            raise ValueError(f"Invalid {key} {settings[key]}: expected a percentage from 0 to 100 (excluded).")
+    return settings
+
+
+def plan_maintenance(health, settings):
+    """
+    Returns the actions needed by the tables of 'health' (dictionary returned by read_health()) with
+    'settings' (dictionary, see get_maintenance_settings()): a list of dictionaries with keys table, action
+    and reason, the tables furthest over their thresholds first, the actions of a table in the order of ACTIONS.
+    """
+    needed = {}
+    for table, measures in health.items():
+        for action in ACTIONS:
+            measure, threshold = ACTION_MEASURES[action]
+            if measures['rows'] and measures[measure] > settings[threshold]:
+                needed.setdefault(table, []).append(
+                    {'table': table, 'action': action,
+                     'reason': f"{measure} {measures[measure]:.1f}% > {settings[threshold]:.1f}%",
+                     'excess': measures[measure] - settings[threshold]})
+    ordered = sorted(needed.values(), key=lambda actions: -max(action['excess'] for action in actions))
+    return [{key: value for key, value in action.items() if key != 'excess'}
+            for actions in ordered for action in actions]
+
+
+def run_maintenance(tables_health, settings, tables=MAINTAINED_TABLES):
+    """
+    Reads the health of 'tables' (list of strings) with 'tables_health' (RedshiftTableHealth or LocalTableHealth
+    object), runs the actions of plan_maintenance() supported by it until the time budget of 'settings'
+    (dictionary, see get_maintenance_settings()) is spent, reads the health again and prints both.
+    Returns a dictionary with keys before, after (health dictionaries) and actions (list of dictionaries, see
+    plan_maintenance(), with status 'done', 'unsupported' or 'over budget' and the duration in seconds).
+    """
+    start = time.perf_counter()
+    before = tables_health.read_health(tables)
+    actions = plan_maintenance(before, settings)
+    for action in actions:
+        if action['action'] not in tables_health.actions:
+            action['status'] = 'unsupported'
+        elif time.perf_counter() - start >= settings['time_budget']:
+            action['status'] = 'over budget'
+        else:
+            action_start = time.perf_counter()
+            tables_health.run(action['action'], action['table'], settings)
+            action.update({'status': 'done', 'seconds': round(time.perf_counter() - action_start, 3)})
+    after = tables_health.read_health(tables) if actions else before
+    print_health(before, after, actions)
+    return {'before': before, 'after': after, 'actions': actions}
+
+
+def print_health(before, after, actions):
+    """
+    Prints the health of each table before and after the maintenance, the actions run on it, and the actions
+    left undone.
+    """
+    done = [action for action in actions if action['status'] == 'done']
+    print(f"\nMaintenance: {len(done)}/{len(actions)} action(s) run.")
+    for table, measures in before.items():
+        table_actions = [action['action'] for action in done if action['table'] == table]
+        changes = ", ".join(f"{measure} {measures[measure]:.1f}% -> {after[table][measure]:.1f}%"
+                            for measure in ['stats_off', 'unsorted', 'deleted'])
+        print(f"- {table} ({after[table]['rows']} rows): {changes}"
+              + (f" ({', '.join(table_actions)})" if table_actions else ""))
+    for action in actions:
+        if action['status'] != 'done':
+            print(f"\033[0;33m- {action['action']} {action['table']} not run ({action['status']}): "
+                  f"{action['reason']}\033[0m")
+
+
+def maintain_tables(connections, config):
+    """
+    Maintains the loaded tables of the cluster on a connection of 'connections' (ConnectionManager object), put
+    in autocommit mode for the duration, with the settings of section 'MAINTENANCE' of config (ConfigParser
+    object). Returns the result of run_maintenance().
+    """
+    settings = get_maintenance_settings(config)
+    with connections.connection() as conn:
+        conn.autocommit = True
+        try:
+            return run_maintenance(RedshiftTableHealth(conn), settings)
+        finally:
+            conn.autocommit = False
+
+
+def main():
+    """
+    Maintains the tables of the cluster of dwh.cfg, or of the local backend with '--local'.
+    """
+    parser = argparse.ArgumentParser(description="Threshold-driven VACUUM/ANALYZE of the loaded tables.")
+    parser.add_argument('--local', action='store_true', help="maintain the local backend (section LOCAL)")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        try:
+            run_maintenance(LocalTableHealth(backend), get_maintenance_settings(config))
+        finally:
+            backend.close()
+    else:
+        from connection_manager import ConnectionManager
+        instrumentation.configure_from_config(config)
+        connections = ConnectionManager.from_config(config)
+        try:
+            maintain_tables(connections, config)
+        finally:
+            connections.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+This module loads the staging tables in parallel: each COPY statement runs on its own connection
+taken from the pool of the run (see connection_manager.py), so independent loads no longer wait for each other.
+If one COPY fails, the COPYs still running on the other connections are cancelled (fail-fast).
+Contains the following functions:
+- get_staging_workers()
+- get_copy_target()
+- run_copy()
+- load_staging_tables_parallel()
+- print_timing_report()
+"""
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+
+DEFAULT_STAGING_WORKERS = 2
+
+
+def get_staging_workers(config):
+    """
+    Returns the number of parallel staging workers set by option 'staging_workers' of
+    section 'ETL' in config (ConfigParser object).
+    Returns DEFAULT_STAGING_WORKERS if the section or option doesn't exist.
+    """
+    workers = config.getint('ETL', 'staging_workers', fallback=DEFAULT_STAGING_WORKERS)
+    return max(1, workers)
+
+
+def get_copy_target(query):
+    """
+    Returns the name of the table loaded by the COPY statement 'query' (string).
+    Returns the first line of the query if it is not a COPY statement.
+    """
+    match = re.search(r"COPY\s+(\w+)", query, re.IGNORECASE)
+    if match:
+        return match.group(1)
+    return query.strip().splitlines()[0]
+
+
+def run_copy(connections, query, running, running_lock, failed, commit_with=None):
+    """
+    Runs the COPY statement 'query' (string) on a connection taken from 'connections'
+    (ConnectionManager object) and commits it, with the statements of commit_with (list of strings,
+    optional, e.g. its checkpoint) in the same transaction.
+    'running' (dict) records the connection in use for each query so that it can be cancelled
+    by another worker, under 'running_lock' (threading.Lock object); 'failed' (threading.Event) is set as
+    soon as one of the workers fails.
+    Returns a dictionary with the table name, status and duration of the COPY.
+    """
+    table = get_copy_target(query)
+    if failed.is_set():
+        return {'table': table, 'status': 'skipped', 'seconds': 0.0}
+
+    conn = connections.getconn()
+    with running_lock:
+        running[table] = conn
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            instrumentation.execute(cur, query, name=f"copy_{table}")
+            for statement in commit_with or []:
+                instrumentation.execute(cur, statement, name=f"checkpoint_copy_{table}")
+        conn.commit()
+    except Exception:
+        failed.set()
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        with running_lock:
+            del running[table]
+        connections.putconn(conn)
+    return {'table': table, 'status': 'loaded', 'seconds': time.perf_counter() - start}
+
+
+def load_staging_tables_parallel(connections, query_list, workers=DEFAULT_STAGING_WORKERS, commit_with=None):
+    """
+    Runs the COPY statements in query_list (list of strings) concurrently, using at most
+    'workers' (int) connections of 'connections' (ConnectionManager object).
+    commit_with (dictionary, optional) maps a COPY statement to the statements committed with it.
+    If one COPY fails, the COPYs still running are cancelled and the first error is raised
+    once all the workers have stopped.
+    Returns the timing report: a list of dictionaries (table, status, seconds), one per query.
+    """
+    workers = max(1, min(workers, len(query_list)))
+    running = {}
+    running_lock = threading.Lock()
+    failed = threading.Event()
+    report = []
+    first_error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_copy, connections, query, running, running_lock, failed,
+                                   (commit_with or {}).get(query)): query
+                   for query in query_list}
+        for future in as_completed(futures):
+            try:
+                report.append(future.result())
+            except Exception as e:
+                message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+                report.append({'table': get_copy_target(futures[future]),
+                               'status': f"failed ({message})", 'seconds': None})
+                if first_error is None:
+                    first_error = e
+                    # Fail fast: cancel the COPYs still running on the other connections.
+                    with running_lock:
+                        running_conns = list(running.values())
+                    for conn in running_conns:
+                        conn.cancel()
+
+    if first_error is not None:
+        print_timing_report(report)
+        raise first_error
+    return report
+
+
+def print_timing_report(report):
+    """
+    Prints the timing report returned by load_staging_tables_parallel(), one line per table.
+    """
+    print("\nStaging load timing report:")
+    for entry in report:
+        seconds = f"{entry['seconds']:.1f}s" if entry['seconds'] is not None else '-'
+        print(f"- {entry['table']}: {entry['status']} ({seconds})")
@@ -0,0 +1,364 @@
+"""
+This module guards the transformation queries against plan regressions. Each statement of the insert nodes
+(including the dimension upserts, which deduplicate their source) and of the incremental merge nodes is
+EXPLAINed, and its plan parsed into a normalized tree: operator, relation, data movement (Redshift DS_* join
+strategy), cost and rows of each step. The trees are compared with baselines stored in a JSON file, and a
+statement regresses when the shape of its plan changes for the worse: it gains a nested loop, a broadcast or a
+redistribution of both sides of a join (DS_BCAST_INNER, DS_DIST_BOTH, DS_DIST_ALL_INNER). The cost only warns,
+when it grows more than max_cost_ratio times faster than the estimated rows: costs follow the data volume, which
+grows from run to run.
+The statements are planned in a transaction which is rolled back: the temporary tables of a node are created
+empty (LIMIT 0) so that its next statements can be planned, nothing is loaded. Redshift plans are parsed from
+the text of EXPLAIN, local Postgres plans from EXPLAIN (FORMAT JSON); each engine has its own baselines.
+etl.py runs the guard as a pre-flight check, once the staging tables are loaded and before the inserts.
+Contains the following functions:
+- get_guard_settings()
+- plan_nodes()
+- split_statements()
+- parse_redshift_plan()
+- parse_postgres_plan()
+- collect_plans()
+- flagged_steps()
+- compare_plans()
+- guard_plans()
+- format_tree()
+- load_baselines()
+- save_baselines()
+- print_findings()
+- review_plans()
+- check_plans()
+- main()
+
+Run 'python plan_guard.py' to check the plans on the cluster ('--local' for the local Postgres backend,
+'--update' to accept the current plans as the new baselines).
+"""
+import argparse
+import configparser
+import json
+import os
+import re
+from collections import Counter
+
+from sql_queries import insert_table_nodes, incremental_merge_nodes
+
+ENGINES = ['redshift', 'postgres']
+FLAGGED_DISTRIBUTIONS = ['DS_BCAST_INNER', 'DS_DIST_BOTH', 'DS_DIST_ALL_INNER']
+DEFAULT_SETTINGS = {'baseline_file': 'plan_baselines.json', 'max_cost_ratio': 2.0, 'fail_on_regression': False}
+
+# Redshift EXPLAIN step, e.g. '  ->  XN Hash Join DS_BCAST_INNER  (cost=0.12..1536.99 rows=65 width=86)':
+REDSHIFT_STEP = re.compile(r"^(?P<indent>\s*(?:->\s+)?)(?P<label>\S.*?)\s+"
+                           r"\(cost=(?P<startup>[\d.]+)\.\.(?P<cost>[\d.]+) rows=(?P<rows>\d+) width=\d+\)")
+TEMP_TABLE_CREATE = re.compile(r"^CREATE TEMP TABLE (\w+) AS\s+(.*)$", flags=re.IGNORECASE | re.DOTALL)
+EXPLAINED_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'DELETE', 'UPDATE')
+
+
+def get_guard_settings(config):
+    """
+    Returns the settings of section 'PLAN_GUARD' of config (ConfigParser object) as a dictionary: baseline_file
+    (string), max_cost_ratio (float, largest growth of the cost of a plan, relative to the growth of its rows,
+    over its baseline before a warning) and fail_on_regression (bool).
+    """
+    return {
+        'baseline_file': config.get('PLAN_GUARD', 'baseline_file', fallback=DEFAULT_SETTINGS['baseline_file']),
+        'max_cost_ratio': config.getfloat('PLAN_GUARD', 'max_cost_ratio',
+                                          fallback=DEFAULT_SETTINGS['max_cost_ratio']),
+        'fail_on_regression': config.getboolean('PLAN_GUARD', 'fail_on_regression',
+                                                fallback=DEFAULT_SETTINGS['fail_on_regression']),
+    }
+
+
+def plan_nodes():
+    """
+    Returns the nodes whose statements are checked: the insert nodes of etl, then the nodes of incremental_load
+    which aren't insert nodes (e.g. merge_songs).
+    """
+    names = {node['name'] for node in insert_table_nodes}
+    return insert_table_nodes + [node for node in incremental_merge_nodes if node['name'] not in names]
+
+
+def split_statements(query):
+    """
+    Returns the statements of 'query' (string, statements separated by ';'), stripped, as a list of strings.
+    The queries of sql_queries.py have no ';' in their literals.
+    """
+    return [statement.strip() for statement in query.split(';') if statement.strip()]
+
+
+def parse_redshift_plan(lines):
+    """
+    Parses the text of a Redshift EXPLAIN, 'lines' (list of strings, one per row of the result), into a
+    normalized tree: a dictionary with keys operator, relation, distribution (DS_* join strategy or None),
+    cost (total cost, float), rows (int) and children (list of trees). The detail lines (conditions, keys,
+    network steps) are dropped.
+    Raises ValueError if no step is found.
+    """
+    root = None
+    # (column of the label, node) of the current branch:
+    stack = []
+    for line in lines:
+        match = REDSHIFT_STEP.match(line)
+        if not match:
+            continue
+        label = re.sub(r"^(XN|LD)\s+", "", match.group('label'))
+        distribution = re.search(r"\bDS_[A-Z_]+\b", label)
+        relation = re.search(r"\s+on\s+(\w+)(?:\s+\w+)?$", label)
+        operator = label[:relation.start()] if relation else label
+        if distribution:
+            operator = operator.replace(distribution.group(0), "")
+        node = {'operator': ' '.join(operator.split()), 'relation': relation.group(1) if relation else None,
+                'distribution': distribution.group(0) if distribution else None,
+                'cost': float(match.group('cost')), 'rows': int(match.group('rows')), 'children': []}
+        column = len(match.group('indent'))
+        while stack and stack[-1][0] >= column:
+            stack.pop()
+        if stack:
+            stack[-1][1]['children'].append(node)
+        elif root is None:
+            root = node
+        stack.append((column, node))
+    if root is None:
+        raise ValueError("No step found in the Redshift plan.")
+    return root
+
+
+def parse_postgres_plan(plan):
+    """
+    Parses the result of a Postgres EXPLAIN (FORMAT JSON), 'plan' (JSON string or the list decoded by psycopg2),
+    into a normalized tree, see parse_redshift_plan(). Postgres doesn't move data: distribution is None.
+    """
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    def normalize(step):
+        operator = step['Node Type']
+        if operator == 'ModifyTable':
+            operator = step.get('Operation', operator)
+        elif step.get('Join Type') and step['Join Type'] != 'Inner':
+            operator = f"{operator} {step['Join Type']}"
+        return {'operator': operator, 'relation': step.get('Relation Name'), 'distribution': None,
+                'cost': float(step['Total Cost']), 'rows': int(step['Plan Rows']),
+                'children': [normalize(child) for child in step.get('Plans', [])]}
+
+    return normalize(plan[0]['Plan'])
+
+
+def collect_plans(run_query, engine, nodes=None):
+    """
+    EXPLAINs the statements of 'nodes' (list of dictionaries, see sql_queries.py, plan_nodes() if None) with
+    run_query (function taking a query and returning its rows, all in one transaction that the caller rolls
+    back: the temporary tables of the nodes are created, empty). 'engine' (string) is 'redshift' or 'postgres'.
+    Returns a dictionary mapping '<node name>:<statement index>' to a dictionary with keys statement (its
+    first words) and tree (see parse_redshift_plan()).
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', use one of: {', '.join(ENGINES)}.")
+    plans = {}
+    for node in plan_nodes() if nodes is None else nodes:
+        for index, statement in enumerate(split_statements(node['query'])):
+            temp_table = TEMP_TABLE_CREATE.match(statement)
+            if not temp_table and not statement.upper().startswith(EXPLAINED_STATEMENTS):
+                # DROP of a temporary table: nothing to plan, the rollback removes it.
+                continue
+            if engine == 'redshift':
+                tree = parse_redshift_plan([row[0] for row in run_query(f"EXPLAIN {statement};")])
+            else:
+                tree = parse_postgres_plan(run_query(f"EXPLAIN (FORMAT JSON) {statement};")[0][0])
+            plans[f"{node['name']}:{index}"] = {'statement': ' '.join(statement.split())[:80], 'tree': tree}
+            if temp_table:
+                run_query(f"CREATE TEMP TABLE {temp_table.group(1)} AS "
+                          f"SELECT * FROM ({temp_table.group(2)}) AS planned LIMIT 0;")
+    return plans
+
+
+def flagged_steps(tree):
+    """
+    Returns a Counter of the risky steps of 'tree' (see parse_redshift_plan()): the nested loops and the joins
+    with a distribution of FLAGGED_DISTRIBUTIONS, each described with the relations it reads.
+    """
+    def relations(node):
+        found = {node['relation']} if node['relation'] else set()
+        for child in node['children']:
+            found |= relations(child)
+        return found
+
+    steps = Counter()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        nodes += node['children']
+        if 'Nested Loop' in node['operator'] or node['distribution'] in FLAGGED_DISTRIBUTIONS:
+            description = ' '.join(part for part in [node['operator'], node['distribution']] if part)
+            steps[f"{description} over {', '.join(sorted(relations(node))) or 'subqueries'}"] += 1
+    return steps
+
+
+def compare_plans(baseline, current, max_cost_ratio):
+    """
+    Compares the plan 'current' of a statement with its 'baseline' (dictionaries with key tree, see
+    collect_plans()). Returns a tuple of lists of strings:
+    - the regressions: risky steps (see flagged_steps()) not in the baseline,
+    - the warnings: a cost growing more than 'max_cost_ratio' (float) times the growth of the estimated rows
+      (the rows shrinking count as no growth).
+    """
+    findings = [f"new {step}" for step in (flagged_steps(current['tree']) - flagged_steps(baseline['tree']))]
+    warnings = []
+    baseline_cost, cost = baseline['tree']['cost'], current['tree']['cost']
+    if baseline_cost > 0:
+        rows_ratio = max(1.0, current['tree']['rows'] / max(1, baseline['tree']['rows']))
+        if cost > max_cost_ratio * rows_ratio * baseline_cost:
+            warnings.append(f"cost {baseline_cost:.2f} -> {cost:.2f} (x{cost / baseline_cost:.1f}) for rows "
+                            f"{baseline['tree']['rows']} -> {current['tree']['rows']} (x{rows_ratio:.1f})")
+    return findings, warnings
+
+
+def guard_plans(plans, baselines, max_cost_ratio, update=False):
+    """
+    Compares 'plans' (dictionary returned by collect_plans()) with 'baselines' (dictionary in the same format,
+    for the same engine). Returns a tuple (dictionary mapping each regressed statement to its regressions,
+    dictionary mapping each statement with warnings to its warnings, see compare_plans(), new baselines): the
+    statements without baseline are added to the baselines, and all of them are replaced by the current plans
+    if 'update' (bool).
+    """
+    findings, warnings = {}, {}
+    for key, plan in plans.items():
+        if key in baselines and not update:
+            regressions, cost_warnings = compare_plans(baselines[key], plan, max_cost_ratio)
+            if regressions:
+                findings[key] = regressions
+            if cost_warnings:
+                warnings[key] = cost_warnings
+    new_baselines = dict(baselines)
+    new_baselines.update(plans if update else {key: plan for key, plan in plans.items() if key not in baselines})
+    return findings, warnings, new_baselines
+
+
+def format_tree(tree, depth=0):
+    """
+    Returns 'tree' (see parse_redshift_plan()) as indented text, one step per line.
+    """
+    parts = [tree['operator'], tree['distribution'], f"on {tree['relation']}" if tree['relation'] else None]
+    line = f"{'  ' * depth}{' '.join(part for part in parts if part)} (cost={tree['cost']:.2f} rows={tree['rows']})"
+    return "\n".join([line] + [format_tree(child, depth + 1) for child in tree['children']])
+
+
+def load_baselines(path, engine):
+    """
+    Returns the baselines of 'engine' (string) stored in JSON file 'path' (string), an empty dictionary if the
+    file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file).get(engine, {})
+
+
+def save_baselines(baselines, path, engine):
+    """
+    Writes 'baselines' (dictionary) of 'engine' (string) to JSON file 'path' (string), keeping the baselines
+    of the other engines.
+    """
+    stored = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            stored = json.load(file)
+    stored[engine] = baselines
+    with open(path, 'w') as file:
+        json.dump(stored, file, indent=2, sort_keys=True)
+
+
+def print_findings(findings, plans, checked, recorded, warnings=None):
+    """
+    Prints the number of statements checked and of baselines recorded, then each regressed statement with
+    its regressions and current plan ('plans', dictionary returned by collect_plans()), and the cost warnings
+    ('warnings', dictionary, optional).
+    """
+    print(f"\nPlan guard: {checked - len(findings)}/{checked} statement(s) without regression"
+          + (f", {recorded} baseline(s) recorded." if recorded else "."))
+    for key, regressions in findings.items():
+        print(f"\033[0;31m- {key} ({plans[key]['statement']}...): {'; '.join(regressions)}\033[0m")
+        print(format_tree(plans[key]['tree'], 2))
+    for key, cost_warnings in (warnings or {}).items():
+        print(f"\033[0;33m- warning: {key} ({plans[key]['statement']}...): {'; '.join(cost_warnings)}\033[0m")
+
+
+def review_plans(plans, engine, settings, update=False):
+    """
+    Compares 'plans' (dictionary returned by collect_plans()) of 'engine' (string) with the baselines of the
+    file of 'settings' (dictionary, see get_guard_settings()), updates the file (see guard_plans()) and prints
+    the regressions and the cost warnings. Returns the regressions.
+    """
+    baselines = load_baselines(settings['baseline_file'], engine)
+    findings, warnings, new_baselines = guard_plans(plans, baselines, settings['max_cost_ratio'], update)
+    save_baselines(new_baselines, settings['baseline_file'], engine)
+    print_findings(findings, plans, len(plans), len(plans) if update else len(new_baselines) - len(baselines),
+                   warnings)
+    return findings
+
+
+def check_plans(connections, config, update=False):
+    """
+    Plans the statements on a connection of 'connections' (ConnectionManager object), in a transaction rolled
+    back at the end, and compares them with the Redshift baselines of the file of section 'PLAN_GUARD' of config
+    (ConfigParser object), which is updated (see guard_plans()).
+    Raises ValueError if the shape of a plan regressed and fail_on_regression is set (cost growth only warns).
+    Returns the regressions otherwise.
+    """
+    settings = get_guard_settings(config)
+    with connections.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                def run_query(query):
+                    cur.execute(query)
+                    return cur.fetchall() if cur.description else None
+                plans = collect_plans(run_query, 'redshift')
+        finally:
+            conn.rollback()
+
+    findings = review_plans(plans, 'redshift', settings, update)
+    if findings and settings['fail_on_regression']:
+        raise ValueError(f"The plan of {len(findings)} statement(s) regressed: {', '.join(findings)}. "
+                         f"Fix the queries or the tables, or accept the plans with 'python plan_guard.py --update'.")
+    return findings
+
+
+def main():
+    """
+    Checks the plans on the cluster of dwh.cfg, or on the local Postgres backend with '--local'.
+    Exits with status 1 if the shape of a plan regressed.
+    """
+    parser = argparse.ArgumentParser(description="Plan regression guard of the transformation queries.")
+    parser.add_argument('--local', action='store_true', help="plan on the local Postgres backend (section LOCAL)")
+    parser.add_argument('--update', action='store_true', help="accept the current plans as the new baselines")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        if backend.dialect != 'postgres':
+            backend.close()
+            raise SystemExit("The plan guard needs the local Postgres backend: set backend = postgres in section "
+                             "LOCAL of dwh.cfg.")
+        backend.execute("BEGIN;")
+        try:
+            plans = collect_plans(backend.execute, 'postgres')
+        finally:
+            backend.execute("ROLLBACK;")
+            backend.close()
+        findings = review_plans(plans, 'postgres', get_guard_settings(config), args.update)
+    else:
+        from connection_manager import ConnectionManager
+        connections = ConnectionManager.from_config(config)
+        try:
+            findings = check_plans(connections, config, args.update)
+        except ValueError as e:
+            print(e)
+            findings = True
+        finally:
+            connections.closeall()
+    raise SystemExit(1 if findings else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+This module pre-processes the raw event and song JSON into compressed CSV files ready for a parallel COPY.
+JSON is the slowest COPY format and a single large input only loads on part of the cluster, so the raw files
+are streamed (one record at a time, constant memory) through a process pool into N compressed parts of the
+same input size, split on record boundaries. N is a multiple of the number of slices of the cluster (num_nodes
+x slices of node_type in dwh.cfg), so that every slice loads the same amount of data. A COPY manifest listing
+the parts is written along with them.
+Contains the following functions:
+- get_slice_count()
+- split_ranges()
+- read_json_range()
+- open_part()
+- convert_part()
+- preprocess()
+- write_manifest()
+- upload_parts()
+- build_copy_query()
+- main()
+
+Run 'python preprocess_logs.py --table staging_events --input data/log_data --output prep/events' to
+pre-process the log files.
+"""
+import argparse
+import configparser
+import gzip
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import local_backend
+from incremental_load import split_s3_url
+from sql_queries import staging_csv_copy
+
+# Number of slices per node, for each Redshift node type.
+SLICES_PER_NODE = {'dc2.large': 2, 'dc2.8xlarge': 16, 'ds2.xlarge': 2, 'ds2.8xlarge': 16, 'ra3.xlplus': 2,
+                   'ra3.4xlarge': 4, 'ra3.16xlarge': 16}
+COMPRESSIONS = {'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+
+
+def get_slice_count(config):
+    """
+    Returns the number of slices of the cluster described in section 'CLUSTER' of config (ConfigParser
+    object): num_nodes times the slices per node of node_type.
+    """
+    node_type = config.get('CLUSTER', 'node_type')
+    if node_type not in SLICES_PER_NODE:
+        raise ValueError(f"Unknown node type '{node_type}', add its number of slices to SLICES_PER_NODE.")
+    return config.getint('CLUSTER', 'num_nodes') * SLICES_PER_NODE[node_type]
+
+
+def split_ranges(paths, n_parts):
+    """
+    Splits the files in 'paths' (list of strings), seen as one continuous stream of bytes, into n_parts
+    (int) byte ranges of the same size, so that the parts are equal even with a few large files.
+    Returns the list of parts, each a list of (path, start, end) byte ranges, empty parts excluded.
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    part_size = max(1, -(-sum(sizes) // n_parts))
+    parts = [[] for _ in range(n_parts)]
+    offset = 0
+    for path, size in zip(paths, sizes):
+        start = 0
+        while start < size:
+            index = min((offset + start) // part_size, n_parts - 1)
+            end = min(size, (index + 1) * part_size - offset)
+            parts[index].append((path, start, end))
+            start = end
+        offset += size
+    return [part for part in parts if part]
+
+
+def read_json_range(path, start, end):
+    """
+    Yields the JSON records (one per line) of file 'path' (string) whose line starts between byte 'start'
+    and byte 'end' (int): a line cut by a range boundary belongs to the range it starts in.
+    """
+    with open(path, 'rb') as json_file:
+        if start > 0:
+            json_file.seek(start - 1)
+            json_file.readline()
+        while json_file.tell() < end:
+            line = json_file.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+def open_part(path, compression):
+    """
+    Opens the compressed part 'path' (string) for writing text, with 'compression' (string, 'gzip' or 'zstd').
+    The zstd compression requires the 'zstandard' package.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', newline='')
+    if compression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), newline='')
+    raise ValueError(f"Unknown compression '{compression}', use one of {', '.join(COMPRESSIONS)}.")
+
+
+def convert_part(table, ranges, part_path, compression):
+    """
+    Streams the JSON records of 'ranges' (list of (path, start, end) byte ranges) into the compressed CSV
+    part 'part_path' (string) for staging table 'table' (string). Runs in a worker process.
+    Returns a tuple (part_path, number of rows, size of the part in bytes).
+    """
+    records = (record for path, start, end in ranges for record in read_json_range(path, start, end))
+    with open_part(part_path, compression) as part:
+        rows = local_backend.write_staging_csv(table, records, part)
+    return part_path, rows, os.path.getsize(part_path)
+
+
+def preprocess(table, input_dir, output_dir, n_parts, compression='gzip', workers=None):
+    """
+    Converts the JSON files under input_dir (string) for staging table 'table' (string) into n_parts (int)
+    compressed CSV parts in output_dir (string), converted in parallel by 'workers' (int, default: number
+    of CPUs) processes.
+    Returns the list of (part path, number of rows, size in bytes) tuples.
+    """
+    groups = split_ranges(local_backend.list_json_files(input_dir), n_parts)
+    os.makedirs(output_dir, exist_ok=True)
+    part_paths = [os.path.join(output_dir, f"{table}-part{index:04d}{COMPRESSIONS[compression]}")
+                  for index in range(len(groups))]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(convert_part, [table] * len(groups), groups, part_paths,
+                                 [compression] * len(groups)))
+
+
+def write_manifest(parts, url_prefix, manifest_path):
+    """
+    Writes the COPY manifest of 'parts' (list returned by preprocess()) to manifest_path (string), the url
+    of each part being url_prefix (string, e.g. 's3://bucket/prefix') followed by the part file name.
+    Returns the manifest (dictionary).
+    """
+    manifest = {'entries': [{'url': f"{url_prefix.rstrip('/')}/{os.path.basename(path)}", 'mandatory': True,
+                             'meta': {'content_length': size}}
+                            for path, _, size in parts]}
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def upload_parts(s3_client, paths, url_prefix):
+    """
+    Uploads the files in 'paths' (list of strings, parts and manifest) under S3 url url_prefix (string)
+    with s3_client (boto3 S3 client).
+    """
+    bucket, prefix = split_s3_url(url_prefix)
+    for path in paths:
+        key = f"{prefix.rstrip('/')}/{os.path.basename(path)}".lstrip('/')
+        s3_client.upload_file(path, bucket, key)
+
+
+def build_copy_query(table, manifest_url, compression='gzip'):
+    """
+    Returns the COPY statement loading staging table 'table' (string) from the parts listed in the
+    manifest at manifest_url (string, S3 url), compressed with 'compression' (string).
+    """
+    return staging_csv_copy.format(table=table, manifest_url=manifest_url, compression=compression.upper())
+
+
+def main():
+    """
+    Parses the command line, pre-processes the JSON files into compressed parts, writes the manifest,
+    optionally uploads everything to S3 and prints the COPY statement to load them.
+    """
+    parser = argparse.ArgumentParser(description="Convert raw JSON into compressed, slice-aligned COPY input.")
+    parser.add_argument('--table', required=True, choices=sorted(local_backend.STAGING_COLUMNS),
+                        help="staging table the files are for")
+    parser.add_argument('--input', required=True, help="directory of the raw JSON files")
+    parser.add_argument('--output', required=True, help="directory of the compressed parts and manifest")
+    parser.add_argument('--compression', default='gzip', choices=sorted(COMPRESSIONS), help="default gzip")
+    parser.add_argument('--parts-per-slice', type=int, default=1,
+                        help="number of parts per slice of the cluster (default 1)")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: CPUs)")
+    parser.add_argument('--upload', default=None, help="S3 url to upload the parts and manifest to")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    n_parts = get_slice_count(config) * args.parts_per_slice
+    parts = preprocess(args.table, args.input, args.output, n_parts, args.compression, args.workers)
+    print(f"{sum(rows for _, rows, _ in parts)} rows written to {len(parts)} part(s) in '{args.output}' "
+          f"({n_parts} slice-aligned parts requested).")
+
+    url_prefix = args.upload or os.path.abspath(args.output)
+    manifest_name = f"{args.table}.manifest"
+    manifest_path = os.path.join(args.output, manifest_name)
+    write_manifest(parts, url_prefix, manifest_path)
+    if args.upload:
+        import boto3
+        import create_role_cluster as create_rc
+        aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+        s3 = boto3.client('s3', region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                          aws_secret_access_key=aws_cred.secret)
+        upload_parts(s3, [path for path, _, _ in parts] + [manifest_path], args.upload)
+        print(f"Parts and manifest uploaded to '{args.upload}'. Load them with:")
+        print(build_copy_query(args.table, f"{args.upload.rstrip('/')}/{manifest_name}", args.compression))
+
+
+if __name__ == "__main__":
+    main()
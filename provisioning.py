@@ -0,0 +1,255 @@
+"""
+This module orchestrates the provisioning of the role and the cluster. The calls which don't depend on each
+other run concurrently: the role setup (create if needed, read its arn, attach the S3 read policy and, when
+an export is configured, an inline policy letting the UNLOADs of export.py write under its prefix only), the
+cluster existence check and the snapshot lookup. A missing cluster is then restored from a snapshot when one is
+configured (a restore is faster than a fresh create), or created, and the boto3 'cluster_available' waiter
+waits for it, or the polling loop with exponential backoff and jitter of check_role_cluster.wait_for_cluster()
+(option waiter of section 'PROVISIONING'). The time spent in each step is reported.
+All the functions take the boto3 clients as arguments so that the whole flow can run under moto.
+Contains the following functions:
+- timed_step()
+- export_policy_document()
+- setup_role()
+- find_snapshot()
+- launch_cluster()
+- get_waiter_settings()
+- wait_until_available()
+- provision()
+- print_timings()
+- main()
+"""
+import configparser
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import WaiterError
+
+import check_role_cluster as crc
+import create_role_cluster as create_rc
+
+S3_READ_POLICY_ARN = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+EXPORT_POLICY_NAME = "sparkify-export-write"
+DEFAULT_WAITER_DELAY = 30
+DEFAULT_WAITER_MAX_ATTEMPTS = 60
+WAITERS = ['boto3', 'backoff']
+# First delay of the backoff waiter, in seconds: it doubles up to waiter_delay.
+BACKOFF_INITIAL_DELAY = 5.0
+
+
+def timed_step(timings, name, function, *args):
+    """
+    Runs function(*args), records its duration in seconds under 'name' (string) in 'timings' (dictionary)
+    and returns its result.
+    """
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def export_policy_document(output):
+    """
+    Returns the IAM policy document (JSON string) letting the UNLOADs of export.py write to S3 url 'output'
+    (string, option output of section 'EXPORT'): put and delete (CLEANPATH) the objects under its prefix, and
+    list that prefix of the bucket. Nothing else of the bucket is writable.
+    """
+    bucket, _, prefix = output.strip("'\"")[len('s3://'):].partition('/')
+    prefix = prefix.strip('/')
+    objects = f"arn:aws:s3:::{bucket}/{prefix}/*" if prefix else f"arn:aws:s3:::{bucket}/*"
+    return json.dumps({
+        'Version': '2012-10-17',
+        'Statement': [
+            {'Effect': 'Allow', 'Action': ['s3:PutObject', 's3:DeleteObject'], 'Resource': [objects]},
+            {'Effect': 'Allow', 'Action': ['s3:ListBucket'], 'Resource': [f"arn:aws:s3:::{bucket}"],
+             'Condition': {'StringLike': {'s3:prefix': [f"{prefix}/*" if prefix else "*"]}}},
+            {'Effect': 'Allow', 'Action': ['s3:GetBucketLocation'], 'Resource': [f"arn:aws:s3:::{bucket}"]},
+        ]
+    })
+
+
+def setup_role(iam_client, role_name, export_output=''):
+    """
+    Creates IAM role 'role_name' (string) if it doesn't exist and attaches the S3 read-only policy to it, and
+    if 'export_output' (S3 url, string) is set, the inline policy EXPORT_POLICY_NAME letting it write there (see
+    export_policy_document()).
+    Returns the arn of the role. Raises RuntimeError if the role can't be created.
+    """
+    if crc.check_role_exists(iam_client, role_name, print_details=False):
+        print(f"\033[0;33mRole '{role_name}' exists already, not creating a new role.\033[0m")
+        role_arn = iam_client.get_role(RoleName=role_name)['Role']['Arn']
+    else:
+        role_arn = create_rc.create_iam_role(iam_client, role_name)
+        if role_arn == 1:
+            raise RuntimeError(f"Role '{role_name}' could not be created.")
+    create_rc.attach_policy_to_role(iam_client, S3_READ_POLICY_ARN, role_name)
+    if export_output.startswith('s3://'):
+        iam_client.put_role_policy(RoleName=role_name, PolicyName=EXPORT_POLICY_NAME,
+                                   PolicyDocument=export_policy_document(export_output))
+        print(f"Export write access granted on '{export_output}'.")
+    return role_arn
+
+
+def find_snapshot(redshift_client, cluster_name, snapshot_id):
+    """
+    Returns the identifier of the snapshot to restore cluster 'cluster_name' (string) from: 'snapshot_id'
+    (string) itself, or the most recent available snapshot of the cluster if it is 'latest'.
+    Returns None if snapshot_id is empty or no snapshot is found.
+    """
+    if not snapshot_id:
+        return None
+    try:
+        if snapshot_id == 'latest':
+            snapshots = redshift_client.describe_cluster_snapshots(ClusterIdentifier=cluster_name)['Snapshots']
+        else:
+            snapshots = redshift_client.describe_cluster_snapshots(SnapshotIdentifier=snapshot_id)['Snapshots']
+    except redshift_client.exceptions.ClusterSnapshotNotFoundFault:
+        return None
+    snapshots = [snapshot for snapshot in snapshots if snapshot.get('Status', 'available') == 'available']
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])['SnapshotIdentifier']
+
+
+def launch_cluster(redshift_client, config, cluster_name, role_arn, snapshot_id=None):
+    """
+    Restores cluster 'cluster_name' (string) from snapshot 'snapshot_id' (string) if given, creates it from
+    the settings of section 'CLUSTER' of config (ConfigParser object) otherwise, with role role_arn (string).
+    Returns 'restored' or 'created'. Raises RuntimeError if the cluster can't be created.
+    """
+    if snapshot_id:
+        redshift_client.restore_from_cluster_snapshot(
+            ClusterIdentifier=cluster_name,
+            SnapshotIdentifier=snapshot_id,
+            NodeType=config.get('CLUSTER', 'node_type'),
+            NumberOfNodes=config.getint('CLUSTER', 'num_nodes'),
+            IamRoles=[role_arn]
+        )
+        print(f"Cluster '{cluster_name}' being restored from snapshot '{snapshot_id}'.")
+        return 'restored'
+    if create_rc.create_redshift_cluster(config, 'CLUSTER', redshift_client, cluster_name, role_arn) == 1:
+        raise RuntimeError(f"Cluster '{cluster_name}' could not be created.")
+    print(f"Cluster '{cluster_name}' being created.")
+    return 'created'
+
+
+def get_waiter_settings(config):
+    """
+    Returns the settings of the wait for the cluster in section 'PROVISIONING' of config (ConfigParser object)
+    as a dictionary: delay, max_attempts (ints, options waiter_delay and waiter_max_attempts) and waiter (one
+    of WAITERS, 'boto3' by default).
+    Raises ValueError if the waiter is unknown.
+    """
+    waiter = config.get('PROVISIONING', 'waiter', fallback='boto3').strip("'\"") or 'boto3'
+    if waiter not in WAITERS:
+        raise ValueError(f"Unknown waiter '{waiter}': option waiter of section 'PROVISIONING' must be one of "
+                         f"{', '.join(WAITERS)}.")
+    return {'delay': config.getint('PROVISIONING', 'waiter_delay', fallback=DEFAULT_WAITER_DELAY),
+            'max_attempts': config.getint('PROVISIONING', 'waiter_max_attempts',
+                                          fallback=DEFAULT_WAITER_MAX_ATTEMPTS),
+            'waiter': waiter}
+
+
+def wait_until_available(redshift_client, cluster_name, delay=DEFAULT_WAITER_DELAY,
+                         max_attempts=DEFAULT_WAITER_MAX_ATTEMPTS, waiter='boto3'):
+    """
+    Waits until cluster 'cluster_name' (string) is available, with waiter 'waiter' (string):
+    - 'boto3': the boto3 'cluster_available' waiter, checking every 'delay' seconds (int) at most max_attempts
+      (int) times,
+    - 'backoff': check_role_cluster.wait_for_cluster(), checking after BACKOFF_INITIAL_DELAY seconds then
+      doubling the delay (with jitter) up to 'delay', for at most delay * max_attempts seconds in all.
+    Returns the endpoint address of the cluster. Raises botocore.exceptions.WaiterError on timeout.
+    """
+    if waiter == 'backoff':
+        state = crc.ClusterState(redshift_client, cluster_name)
+        status = crc.wait_for_cluster(state, 'available', delay * max_attempts, min(BACKOFF_INITIAL_DELAY, delay),
+                                      delay)
+        if status != 'available':
+            raise WaiterError('cluster_available', f"cluster status still '{status}' after {delay * max_attempts}s",
+                              state.details or {})
+        return state.endpoint
+    waiter = redshift_client.get_waiter('cluster_available')
+    waiter.wait(ClusterIdentifier=cluster_name, WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+    return crc.ClusterState(redshift_client, cluster_name).endpoint
+
+
+def provision(iam_client, redshift_client, config, wait=True, config_file=None):
+    """
+    Provisions the role and the cluster described in config (ConfigParser object):
+    1. concurrently: sets up the role (with write access to the output of section 'EXPORT', if set), checks
+       whether the cluster exists and looks for the snapshot to restore (option snapshot_identifier of section
+       'PROVISIONING', a snapshot id or 'latest'),
+    2. restores or creates the cluster if it doesn't exist,
+    3. if 'wait' (bool), waits for the cluster to be available.
+    The role arn and the endpoint are written to config_file (string, optional).
+    Returns a dictionary: role_arn, cluster ('existing', 'restored' or 'created'), endpoint (None if not
+    waited for and not available yet), timings (dictionary step -> seconds).
+    """
+    role_name = config.get('IAM_ROLE', 'iam_role_name')
+    cluster_name = config.get('CLUSTER', 'cl_identifier')
+    snapshot_setting = config.get('PROVISIONING', 'snapshot_identifier', fallback='').strip("'\"")
+    export_output = config.get('EXPORT', 'output', fallback='').strip("'\"")
+    timings = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        role_future = executor.submit(timed_step, timings, 'setup_role', setup_role, iam_client, role_name,
+                                      export_output)
+        state = crc.ClusterState(redshift_client, cluster_name)
+        exists_future = executor.submit(timed_step, timings, 'check_cluster', lambda: state.exists)
+        snapshot_future = executor.submit(timed_step, timings, 'find_snapshot', find_snapshot, redshift_client,
+                                          cluster_name, snapshot_setting)
+        role_arn, exists, snapshot_id = role_future.result(), exists_future.result(), snapshot_future.result()
+    timings['concurrent_checks'] = time.perf_counter() - start
+    if config_file:
+        create_rc.update_section_key(config_file, 'IAM_ROLE', 'arn', role_arn)
+
+    if exists:
+        print(f"\033[0;33mCluster '{cluster_name}' exists already, not creating a new cluster.\033[0m")
+        cluster = 'existing'
+    else:
+        if snapshot_setting and not snapshot_id:
+            print(f"\033[0;33mNo snapshot '{snapshot_setting}' found, creating a new cluster.\033[0m")
+        cluster = timed_step(timings, 'launch_cluster', launch_cluster, redshift_client, config, cluster_name,
+                             role_arn, snapshot_id)
+
+    endpoint = state.endpoint if exists and state.status == 'available' else None
+    if wait:
+        waiter_settings = get_waiter_settings(config)
+        endpoint = timed_step(timings, 'wait_available', wait_until_available, redshift_client, cluster_name,
+                              waiter_settings['delay'], waiter_settings['max_attempts'], waiter_settings['waiter'])
+    if config_file and endpoint:
+        create_rc.update_section_key(config_file, 'CLUSTER', 'cl_endpoint', endpoint)
+    timings['total'] = time.perf_counter() - start
+    return {'role_arn': role_arn, 'cluster': cluster, 'endpoint': endpoint, 'timings': timings}
+
+
+def print_timings(timings):
+    """
+    Prints the time spent in each provisioning step ('timings', dictionary step -> seconds).
+    """
+    print("\nProvisioning timing report:")
+    for step, seconds in timings.items():
+        print(f"- {step}: {seconds:.1f}s")
+
+
+def main(wait=True):
+    """
+    Provisions the role and cluster described in dwh.cfg, waiting for the cluster to be available if
+    'wait' (bool). Returns a tuple (redshift client, cluster name).
+    """
+    aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+    config = configparser.ConfigParser()
+    config.read(create_rc.CONFIG_FILE_NAME)
+    clients = [boto3.client(service, region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                            aws_secret_access_key=aws_cred.secret) for service in ['iam', 'redshift']]
+    result = provision(*clients, config, wait=wait, config_file=create_rc.CONFIG_FILE_NAME)
+    print_timings(result['timings'])
+    return clients[1], config.get('CLUSTER', 'cl_identifier')
+
+
+if __name__ == "__main__":
+    main()
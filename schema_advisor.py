@@ -0,0 +1,501 @@
+"""
+This module advises the physical design of the tables from the data actually loaded: it profiles the staging
+tables (row counts, cardinality, skew of the candidate distribution keys, byte lengths of the strings) and the
+join columns of insert_table_queries, then generates CREATE TABLE statements with distribution and sort keys,
+right-sized VARCHARs and column encodings, along with a report estimating the data redistributed by the joins
+and the storage of each table, for the current and the advised design.
+The target tables are profiled from the staging columns they are loaded from (COLUMN_SOURCES), each source
+being scanned once. Estimates use typical compression ratios and the average row widths: they are meant to
+compare the designs, not to predict the exact sizes.
+Contains the following functions:
+- parse_create_table()
+- extract_join_columns()
+- cursor_runner()
+- profile_sources()
+- measure_skew()
+- profile_tables()
+- varchar_size()
+- choose_encoding()
+- advise()
+- build_create_table()
+- row_width()
+- storage_bytes()
+- redistributed_bytes()
+- build_report()
+- print_report()
+- main()
+
+Run 'python schema_advisor.py' once the staging tables are loaded ('--local' to profile the local backend).
+"""
+import argparse
+import configparser
+import datetime
+import json
+import math
+import re
+
+import preprocess_logs
+from connection_manager import connect
+from sql_queries import create_table_queries, insert_table_queries
+
+STAGING_TABLES = ['staging_events', 'staging_songs']
+FACT_TABLE = 'songplays'
+FACT_SORT_COLUMN = 'start_time'
+DIMENSION_KEYS = {'users': 'user_id', 'songs': 'song_key', 'artists': 'artist_key', 'time': 'start_time'}
+# The aggregate tables are derived from songplays and small: they keep their design.
+ADVISED_TABLES = STAGING_TABLES + [FACT_TABLE] + list(DIMENSION_KEYS)
+# Joins of the star schema, fact column -> dimension key. songplays.start_time (epoch milliseconds) and
+# time.start_time (TIMESTAMP) hash differently, so they can't be colocated and time is left out.
+STAR_JOINS = [('song_key', 'songs'), ('artist_key', 'artists'), ('user_id', 'users')]
+
+NEXTSONG = "page = 'NextSong'"
+# Staging source (table, expression, filter) of the columns of the star schema to profile. The surrogate keys
+# map one to one to the natural ids, so they are profiled from them.
+COLUMN_SOURCES = {
+    'songplays': {'start_time': ('staging_events', 'ts', NEXTSONG),
+                  'user_id': ('staging_events', 'user_id', NEXTSONG),
+                  'level': ('staging_events', 'level', NEXTSONG),
+                  'song_key': ('staging_songs', 'song_id', None),
+                  'artist_key': ('staging_songs', 'artist_id', None),
+                  'location': ('staging_events', 'location', NEXTSONG),
+                  'user_agent': ('staging_events', 'user_agent', NEXTSONG)},
+    'users': {'user_id': ('staging_events', 'user_id', None),
+              'first_name': ('staging_events', 'first_name', None),
+              'last_name': ('staging_events', 'last_name', None),
+              'gender': ('staging_events', 'gender', None),
+              'level': ('staging_events', 'level', None)},
+    'songs': {'song_key': ('staging_songs', 'song_id', None),
+              'song_id': ('staging_songs', 'song_id', None),
+              'title': ('staging_songs', 'title', None),
+              'artist_key': ('staging_songs', 'artist_id', None)},
+    'artists': {'artist_key': ('staging_songs', 'artist_id', None),
+                'artist_id': ('staging_songs', 'artist_id', None),
+                'name': ('staging_songs', 'artist_name', None),
+                'location': ('staging_songs', 'artist_location', None),
+                'latitude': ('staging_songs', 'artist_latitude', None),
+                'longitude': ('staging_songs', 'artist_longitude', None)},
+    'time': {'start_time': ('staging_events', 'ts', None)},
+}
+# The plays of a song or an artist are counted on the event side of the songplays join.
+SKEW_SOURCES = {('songplays', 'song_key'): ('staging_events', 'song', NEXTSONG),
+                ('songplays', 'artist_key'): ('staging_events', 'artist', NEXTSONG)}
+# Number of rows of each table of the star schema: COUNT(*) ('*') or COUNT(DISTINCT expression) of a source.
+TABLE_ROWS = {'songplays': ('staging_events', NEXTSONG, '*'), 'users': ('staging_events', None, 'user_id'),
+              'songs': ('staging_songs', None, '*'), 'artists': ('staging_songs', None, 'artist_id'),
+              'time': ('staging_events', None, '*')}
+
+STRING_TYPES = ('TEXT', 'VARCHAR', 'CHAR')
+# Stored width in bytes of the fixed width types. TEXT is a VARCHAR(256) on Redshift.
+TYPE_WIDTHS = {'SMALLINT': 2, 'INT': 4, 'INTEGER': 4, 'BIGINT': 8, 'FLOAT': 8, 'REAL': 4, 'NUMERIC': 8,
+               'DECIMAL': 8, 'TIMESTAMP': 8, 'DATE': 4, 'BOOLEAN': 1, 'TEXT': 256}
+AZ64_TYPES = ('SMALLINT', 'INT', 'INTEGER', 'BIGINT', 'NUMERIC', 'DECIMAL', 'TIMESTAMP', 'DATE')
+# Typical compression ratio of each encoding, used to compare the designs.
+ENCODING_RATIOS = {'RAW': 1.0, 'AZ64': 0.4, 'LZO': 0.45, 'ZSTD': 0.3, 'BYTEDICT': 0.15}
+BYTEDICT_MAX_DISTINCT = 255
+
+DEFAULT_SETTINGS = {'all_max_rows': 1_000_000, 'max_skew': 1.5, 'varchar_headroom': 1.25}
+
+
+def parse_create_table(query):
+    """
+    Parses 'query' (string, CREATE TABLE statement of sql_queries.py).
+    Returns a dictionary: 'table', 'columns' (list of dictionaries 'name', 'type', 'attributes' such as
+    NOT NULL or IDENTITY(0,1)), 'diststyle' ('AUTO' if not set), 'distkey' and 'sortkey' (column names or None).
+    """
+    table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)\s*\(", query, re.IGNORECASE).group(1)
+    body = query[query.index('(') + 1:query.rindex(')')]
+    design = {'table': table, 'columns': [], 'diststyle': 'AUTO', 'distkey': None, 'sortkey': None}
+    for line in body.splitlines():
+        match = re.match(r"\s*(\w+)\s+(\w+(?:\s*\([\d,\s]+\))?)(.*?),?\s*$", line)
+        if not match:
+            continue
+        name, column_type, attributes = match.groups()
+        if re.search(r"\bdistkey\b", attributes, re.IGNORECASE):
+            design.update({'diststyle': 'KEY', 'distkey': name})
+        if re.search(r"\bsortkey\b", attributes, re.IGNORECASE):
+            design['sortkey'] = name
+        attributes = re.sub(r"\b(distkey|sortkey)\b", "", attributes, flags=re.IGNORECASE)
+        design['columns'].append({'name': name, 'type': column_type.upper(),
+                                  'attributes': ' '.join(attributes.split())})
+    diststyle = re.search(r"\)\s*diststyle\s+(\w+)", query, re.IGNORECASE)
+    if diststyle:
+        design['diststyle'] = diststyle.group(1).upper()
+    return design
+
+
+def extract_join_columns(query_list, tables):
+    """
+    Returns the join predicates of the queries in query_list (list of strings) between two different tables
+    of 'tables' (list of strings), as a list of ((table, column), (table, column)) tuples, aliases resolved.
+    """
+    joins = []
+    for query in query_list:
+        aliases = {table: table for table in tables}
+        for table, alias in re.findall(r"(?:FROM|JOIN)\s+(\w+)\s+AS\s+(\w+)", query, re.IGNORECASE):
+            aliases[alias] = table
+        # Alias of a sub-query reading a single table, e.g. '(SELECT ... FROM staging_songs) AS ss'.
+        for table, alias in re.findall(r"FROM\s+(\w+)[^()]*\)\s*AS\s+(\w+)", query, re.IGNORECASE):
+            aliases[alias] = table
+        for left_alias, left_column, right_alias, right_column in \
+                re.findall(r"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", query):
+            left, right = aliases.get(left_alias), aliases.get(right_alias)
+            if left in tables and right in tables and left != right:
+                joins.append(((left, left_column), (right, right_column)))
+    return joins
+
+
+def cursor_runner(cur):
+    """
+    Returns a function running a query on cursor 'cur' (psycopg2 cursor) and returning all its rows.
+    """
+    def run_query(query):
+        cur.execute(query)
+        return cur.fetchall()
+    return run_query
+
+
+def profile_sources(run_query, sources, string_columns):
+    """
+    Profiles the expressions of each source in one scan: 'sources' (dictionary (table, filter) -> set of
+    expressions), string_columns (set of (table, column)) telling which expressions get their byte lengths.
+    'run_query' (function) runs a query and returns its rows.
+    Returns a dictionary (table, filter) -> {'rows': int, 'columns': {expression: {'distinct', 'max_length',
+    'avg_length'}}}.
+    """
+    profiles = {}
+    for (table, where), expressions in sources.items():
+        expressions = sorted(expressions)
+        selects = ['COUNT(*)']
+        for expression in expressions:
+            selects.append(f"COUNT(DISTINCT {expression})")
+            if (table, expression) in string_columns:
+                selects += [f"MAX(OCTET_LENGTH({expression}))", f"AVG(OCTET_LENGTH({expression}))"]
+        query = f"SELECT {', '.join(selects)} FROM {table}" + (f" WHERE {where}" if where else "") + ";"
+        values = list(run_query(query)[0])
+        profile = {'rows': values.pop(0), 'columns': {}}
+        for expression in expressions:
+            stats = {'distinct': values.pop(0), 'max_length': None, 'avg_length': None}
+            if (table, expression) in string_columns:
+                max_length, avg_length = values.pop(0), values.pop(0)
+                stats.update({'max_length': max_length, 'avg_length': float(avg_length or 0)})
+            profile['columns'][expression] = stats
+        profiles[(table, where)] = profile
+    return profiles
+
+
+def measure_skew(run_query, table, expression, where, rows, distinct, slices):
+    """
+    Returns the skew of a distribution on 'expression' (string) of 'table' (string, rows filtered by 'where'):
+    the rows of the most loaded slice over the average rows per slice, out of 'slices' (int). The most frequent
+    value (NULL included) lands on a single slice, and there can't be more loaded slices than values.
+    """
+    if not rows:
+        return 1.0
+    where = f" WHERE {where}" if where else ""
+    query = f"SELECT MAX(value_rows) FROM (SELECT {expression}, COUNT(*) AS value_rows FROM {table}{where} " \
+            f"GROUP BY {expression}) AS value_counts;"
+    top_value_rows = run_query(query)[0][0] or 0
+    return max(1.0, top_value_rows * slices / rows, slices / max(1, distinct))
+
+
+def profile_tables(run_query, designs, slices, staging_joins):
+    """
+    Profiles the staging tables and, from them, the tables of the star schema described by 'designs'
+    (dictionary table -> parse_create_table() result), and measures the skew of the candidate distribution
+    keys over 'slices' (int): the fact columns of STAR_JOINS and the staging columns of staging_joins.
+    Returns a dictionary table -> {'rows', 'columns': {column: stats}, 'skew': {column: ratio}}.
+    """
+    string_columns = {(table, column['name']) for table in STAGING_TABLES for column in designs[table]['columns']
+                      if column['type'].startswith(STRING_TYPES)}
+    sources = {(table, None): {column['name'] for column in designs[table]['columns']} for table in STAGING_TABLES}
+    for table, columns in COLUMN_SOURCES.items():
+        for source_table, expression, where in columns.values():
+            sources.setdefault((source_table, where), set()).add(expression)
+    for source_table, where, expression in TABLE_ROWS.values():
+        if expression != '*':
+            sources.setdefault((source_table, where), set()).add(expression)
+    for source_table, expression, where in SKEW_SOURCES.values():
+        sources.setdefault((source_table, where), set()).add(expression)
+    source_profiles = profile_sources(run_query, sources, string_columns)
+
+    profiles = {table: {'rows': source_profiles[(table, None)]['rows'],
+                        'columns': source_profiles[(table, None)]['columns'], 'skew': {}}
+                for table in STAGING_TABLES}
+    for table, (source_table, where, expression) in TABLE_ROWS.items():
+        source = source_profiles[(source_table, where)]
+        rows = source['rows'] if expression == '*' else source['columns'][expression]['distinct']
+        profiles[table] = {'rows': rows, 'skew': {},
+                           'columns': {column: source_profiles[(source_table, column_where)]['columns'][expression]
+                                       for column, (source_table, expression, column_where)
+                                       in COLUMN_SOURCES[table].items()}}
+
+    candidates = [(FACT_TABLE, column) for column, _ in STAR_JOINS] + \
+        [side for join in staging_joins for side in join]
+    for table, column in dict.fromkeys(candidates):
+        source_table, expression, where = SKEW_SOURCES.get((table, column)) or \
+            COLUMN_SOURCES.get(table, {}).get(column) or (table, column, None)
+        source = source_profiles[(source_table, where)]
+        profiles[table]['skew'][column] = measure_skew(run_query, source_table, expression, where, source['rows'],
+                                                       source['columns'][expression]['distinct'], slices)
+    return profiles
+
+
+def varchar_size(max_length, headroom):
+    """
+    Returns the VARCHAR size (bytes) for strings of at most max_length (int) bytes, with 'headroom' (float)
+    for longer values to come, rounded up to a multiple of 8 above 8 bytes.
+    """
+    size = max(1, math.ceil(max_length * headroom))
+    return min(65535, size if size <= 8 else -(-size // 8) * 8)
+
+
+def choose_encoding(column_type, distinct, sortkey=False):
+    """
+    Returns the encoding of a column of type column_type (string) with 'distinct' (int) values: RAW for the
+    sort key (so that range restricted scans stay effective), BYTEDICT for low cardinality strings, ZSTD for
+    the other strings and the floats, AZ64 for the integers, decimals and dates.
+    """
+    if sortkey or column_type.startswith('BOOLEAN'):
+        return 'RAW'
+    if column_type.startswith(STRING_TYPES):
+        return 'BYTEDICT' if distinct is not None and distinct <= BYTEDICT_MAX_DISTINCT else 'ZSTD'
+    if column_type.startswith(AZ64_TYPES):
+        return 'AZ64'
+    return 'ZSTD'
+
+
+def advise(designs, profiles, staging_joins, settings=None):
+    """
+    Advises the design of each table of 'designs' (dictionary table -> parse_create_table() result) from
+    'profiles' (profile_tables() result) and staging_joins (extract_join_columns() result):
+    - dimensions of at most 'all_max_rows' rows are copied to every node (DISTSTYLE ALL), the others are
+      distributed and sorted on their key,
+    - the fact table is distributed on its join column to the largest distributed dimension and sorted on
+      start_time, or distributed evenly if every candidate is skewed above 'max_skew',
+    - the staging tables are distributed on the least skewed pair of columns they are joined on,
+    - strings are sized to their longest value times 'varchar_headroom' and columns get an encoding.
+    'settings' (dictionary) overrides DEFAULT_SETTINGS. Returns a dictionary table -> advised design.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    advised = {}
+    for table, key in DIMENSION_KEYS.items():
+        if profiles[table]['rows'] <= settings['all_max_rows']:
+            advised[table] = {'diststyle': 'ALL', 'distkey': None, 'sortkey': key}
+        else:
+            advised[table] = {'diststyle': 'KEY', 'distkey': key, 'sortkey': key}
+
+    fact_skew = profiles[FACT_TABLE]['skew']
+    candidates = [(profiles[dimension]['rows'], column) for column, dimension in STAR_JOINS
+                  if advised[dimension]['diststyle'] == 'KEY' and fact_skew[column] <= settings['max_skew']]
+    distkey = max(candidates)[1] if candidates else None
+    advised[FACT_TABLE] = {'diststyle': 'KEY' if distkey else 'EVEN', 'distkey': distkey, 'sortkey': FACT_SORT_COLUMN}
+
+    for table in STAGING_TABLES:
+        advised[table] = {'diststyle': 'EVEN', 'distkey': None, 'sortkey': None}
+    pairs = [(max(profiles[left]['skew'][left_column], profiles[right]['skew'][right_column]), (left, left_column),
+              (right, right_column)) for (left, left_column), (right, right_column) in staging_joins]
+    pairs = [pair for pair in pairs if pair[0] <= settings['max_skew']]
+    if pairs:
+        for table, column in min(pairs)[1:]:
+            advised[table].update({'diststyle': 'KEY', 'distkey': column})
+
+    for table, design in advised.items():
+        design['table'] = table
+        design['columns'] = []
+        for column in designs[table]['columns']:
+            stats = profiles[table]['columns'].get(column['name'], {})
+            column_type = column['type']
+            if column_type.startswith(STRING_TYPES) and stats.get('max_length'):
+                column_type = f"VARCHAR({varchar_size(stats['max_length'], settings['varchar_headroom'])})"
+            design['columns'].append({**column, 'type': column_type, 'encoding': choose_encoding(
+                column_type, stats.get('distinct'), column['name'] == design['sortkey'])})
+    return advised
+
+
+def build_create_table(design):
+    """
+    Returns the CREATE TABLE statement (string) of 'design' (advise() result for one table).
+    """
+    columns = ',\n'.join(f"        {column['name']} {column['type']}"
+                         f"{' ' + column['attributes'] if column['attributes'] else ''} ENCODE {column['encoding']}"
+                         for column in design['columns'])
+    options = f" diststyle {design['diststyle'].lower()}"
+    if design['distkey']:
+        options += f" distkey({design['distkey']})"
+    if design['sortkey']:
+        options += f" sortkey({design['sortkey']})"
+    return f"CREATE TABLE IF NOT EXISTS {design['table']}(\n{columns}\n){options};"
+
+
+def row_width(design, profile, declared=False):
+    """
+    Returns the width in bytes of a row of 'design' with 'profile': the average stored width, or the declared
+    width (VARCHAR sizes, used for the memory of the hash and sort steps) if 'declared' (bool).
+    """
+    width = 0
+    for column in design['columns']:
+        base_type = column['type'].split('(')[0]
+        size = re.search(r"\((\d+)", column['type'])
+        stats = profile['columns'].get(column['name'], {})
+        if base_type in STRING_TYPES and (declared or stats.get('avg_length') is None):
+            width += int(size.group(1)) if size else TYPE_WIDTHS['TEXT']
+        elif base_type in STRING_TYPES:
+            width += stats['avg_length'] + 4
+        else:
+            width += TYPE_WIDTHS.get(base_type, 8)
+    return width
+
+
+def storage_bytes(design, profile, nodes):
+    """
+    Returns the estimated compressed storage in bytes of 'design' with 'profile', tables distributed with
+    DISTSTYLE ALL being stored once per node out of 'nodes' (int). Columns without an encoding get the one
+    Redshift assigns by default (RAW for the sort key, the floats and the booleans, AZ64 for the other fixed
+    width types, LZO for the strings).
+    """
+    total = 0
+    for column in design['columns']:
+        encoding = column.get('encoding')
+        if encoding is None:
+            base_type = column['type'].split('(')[0]
+            encoding = 'RAW' if column['name'] == design['sortkey'] or base_type in ('FLOAT', 'REAL', 'BOOLEAN') \
+                else 'LZO' if base_type in STRING_TYPES else 'AZ64'
+        total += row_width({'columns': [column]}, profile) * ENCODING_RATIOS[encoding]
+    return total * profile['rows'] * (nodes if design['diststyle'] == 'ALL' else 1)
+
+
+def redistributed_bytes(left, right, column_pairs, sizes, slices):
+    """
+    Returns the bytes moved between the nodes to join 'left' with 'right' (designs) on column_pairs (list of
+    (left column, right column)), 'sizes' (dictionary table -> bytes) giving the size of each table: nothing
+    if one side is copied to every node or both are distributed on the same pair of join columns, otherwise
+    the cheapest of redistributing the side which isn't distributed on a join column, redistributing both
+    and broadcasting the smaller one to the 'slices' (int).
+    """
+    if 'ALL' in (left['diststyle'], right['diststyle']):
+        return 0
+    if (left['distkey'], right['distkey']) in column_pairs:
+        return 0
+    left_keyed = left['distkey'] in [left_column for left_column, _ in column_pairs]
+    right_keyed = right['distkey'] in [right_column for _, right_column in column_pairs]
+    left_size, right_size = sizes[left['table']], sizes[right['table']]
+    broadcast = min(left_size, right_size) * slices
+    if left_keyed and not right_keyed:
+        return min(right_size, broadcast)
+    if right_keyed and not left_keyed:
+        return min(left_size, broadcast)
+    return min(left_size + right_size, broadcast)
+
+
+def build_report(current, advised, profiles, staging_joins, slices, nodes):
+    """
+    Returns the report (dictionary) comparing the current and advised designs (dictionaries table -> design):
+    for each table its design, declared row width and storage, for each join the bytes redistributed.
+    """
+    report = {'slices': slices, 'tables': {}, 'joins': [], 'totals': {}}
+    sizes = {}
+    for name, designs in [('current', current), ('advised', advised)]:
+        sizes[name] = {table: profiles[table]['rows'] * row_width(design, profiles[table])
+                       for table, design in designs.items()}
+    for table in advised:
+        report['tables'][table] = {'rows': profiles[table]['rows'], 'skew': profiles[table]['skew']}
+        for name, designs in [('current', current), ('advised', advised)]:
+            design = designs[table]
+            report['tables'][table][name] = {
+                'diststyle': design['diststyle'], 'distkey': design['distkey'], 'sortkey': design['sortkey'],
+                'declared_row_width': row_width(design, profiles[table], declared=True),
+                'storage_bytes': storage_bytes(design, profiles[table], nodes)}
+
+    # The predicates of a join are grouped: the join is colocated if the tables are distributed on any pair.
+    joins = {}
+    for (left, left_column), (right, right_column) in \
+            [((FACT_TABLE, column), (dimension, DIMENSION_KEYS[dimension])) for column, dimension in STAR_JOINS] + \
+            staging_joins:
+        joins.setdefault((left, right), []).append((left_column, right_column))
+    for (left, right), column_pairs in joins.items():
+        report['joins'].append({
+            'join': ' AND '.join(f"{left}.{left_column} = {right}.{right_column}"
+                                 for left_column, right_column in column_pairs),
+            **{name: redistributed_bytes(designs[left], designs[right], column_pairs, sizes[name], slices)
+               for name, designs in [('current', current), ('advised', advised)]}})
+    for name in ['current', 'advised']:
+        report['totals'][name] = {
+            'storage_bytes': sum(table[name]['storage_bytes'] for table in report['tables'].values()),
+            'redistributed_bytes': sum(join[name] for join in report['joins'])}
+    return report
+
+
+def print_report(report):
+    """
+    Prints 'report' (build_report() result).
+    """
+    def megabytes(size):
+        return f"{size / 1024 ** 2:.1f} MB"
+
+    def design_text(design):
+        return f"{design['diststyle']}{'(' + design['distkey'] + ')' if design['distkey'] else ''} " \
+               f"sortkey({design['sortkey'] or '-'})"
+
+    print(f"\nDesign advice ({report['slices']} slices):")
+    for table, item in report['tables'].items():
+        current, advised = item['current'], item['advised']
+        print(f"- {table} ({item['rows']} rows): {design_text(current)} -> {design_text(advised)}, "
+              f"declared row width {current['declared_row_width']:.0f} -> {advised['declared_row_width']:.0f} "
+              f"bytes, storage {megabytes(current['storage_bytes'])} -> {megabytes(advised['storage_bytes'])}")
+    print("Data redistributed by the joins:")
+    for join in report['joins']:
+        print(f"- {join['join']}: {megabytes(join['current'])} -> {megabytes(join['advised'])}")
+    current, advised = report['totals']['current'], report['totals']['advised']
+    print(f"Total: storage {megabytes(current['storage_bytes'])} -> {megabytes(advised['storage_bytes'])}, "
+          f"redistributed {megabytes(current['redistributed_bytes'])} -> "
+          f"{megabytes(advised['redistributed_bytes'])}.")
+
+
+def main():
+    """
+    Profiles the loaded staging tables (on the cluster of dwh.cfg, or on the local backend with '--local'),
+    writes the advised CREATE TABLE statements to a file and prints the report.
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser(description="Advise distribution, sort keys and encodings from the data.")
+    parser.add_argument('--local', action='store_true', help="profile the local backend (section LOCAL)")
+    parser.add_argument('--output', default=config.get('ADVISOR', 'output', fallback='schema_advice.sql'),
+                        help="file of the advised CREATE TABLE statements")
+    parser.add_argument('--report', default=None, help="JSON file to write the report to")
+    args = parser.parse_args()
+
+    settings = {option: config.getfloat('ADVISOR', option, fallback=default)
+                for option, default in DEFAULT_SETTINGS.items()}
+    slices, nodes = preprocess_logs.get_slice_count(config), config.getint('CLUSTER', 'num_nodes')
+    current = {design['table']: design for design in map(parse_create_table, create_table_queries)
+               if design['table'] in ADVISED_TABLES}
+    staging_joins = extract_join_columns(insert_table_queries, STAGING_TABLES)
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        run_query, close = backend.execute, backend.close
+    else:
+        conn = connect(config)
+        run_query, close = cursor_runner(conn.cursor()), conn.close
+    try:
+        profiles = profile_tables(run_query, current, slices, staging_joins)
+    finally:
+        close()
+
+    advised = advise(current, profiles, staging_joins, settings)
+    with open(args.output, 'w') as output_file:
+        output_file.write(f"-- Generated by schema_advisor.py on {datetime.date.today().isoformat()}, "
+                          f"{slices} slices.\n\n")
+        output_file.write('\n\n'.join(build_create_table(advised[table]) for table in current) + '\n')
+    report = build_report(current, advised, profiles, staging_joins, slices, nodes)
+    print_report(report)
+    print(f"\nAdvised CREATE TABLE statements written to '{args.output}'.")
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,10 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
 song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
 artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+daily_song_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_song_plays CASCADE"
+hourly_level_plays_table_drop = "DROP TABLE IF EXISTS agg_hourly_level_plays CASCADE"
+daily_user_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_user_plays CASCADE"
+aggregate_watermark_table_drop = "DROP TABLE IF EXISTS aggregate_watermark CASCADE"
 
 # CREATE TABLES
 
@@ -62,12 +66,13 @@ songplay_table_create = ("""
         start_time BIGINT NOT NULL,
         user_id INT NOT NULL,
         level TEXT,
-        song_id TEXT sortkey,
-        artist_id TEXT,
+        song_key BIGINT sortkey distkey,
+        artist_key BIGINT,
         session_id INT NOT NULL,
         location TEXT,
-        user_agent TEXT
-    ) diststyle even;
+        user_agent TEXT,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    );
 """)
 
 
@@ -77,25 +82,29 @@ user_table_create = ("""
         first_name TEXT NOT NULL,
         last_name TEXT NOT NULL,
         gender VARCHAR(1),
-        level TEXT
+        level TEXT,
+        last_event_ts BIGINT
     ) diststyle all;
 """)
 
 
 song_table_create = ("""
     CREATE TABLE IF NOT EXISTS songs(
-        song_id TEXT distkey,
+        song_key BIGINT NOT NULL distkey,
+        song_id TEXT NOT NULL,
         title TEXT NOT NULL,
-        artist_id TEXT NOT NULL sortkey,
+        artist_key BIGINT NOT NULL sortkey,
+        artist_name TEXT,
         year INT,
-        duration NUMERIC
+        duration FLOAT
     );
 """)
 
 
 artist_table_create = ("""
     CREATE TABLE IF NOT EXISTS artists(
-        artist_id TEXT sortkey distkey,
+        artist_key BIGINT NOT NULL sortkey distkey,
+        artist_id TEXT NOT NULL,
         name TEXT NOT NULL,
         location TEXT,
         latitude TEXT,
@@ -117,6 +126,65 @@ time_table_create = ("""
 """)
 
 
+# KEY MAPS
+# Integer surrogate key of each natural song and artist id, assigned once and kept across runs: the key
+# maps are created if needed but never dropped with the other tables (see surrogate_keys.py).
+
+song_key_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_keys(
+        song_key BIGINT NOT NULL,
+        song_id TEXT NOT NULL sortkey
+    ) diststyle all;
+""")
+
+
+artist_key_table_create = ("""
+    CREATE TABLE IF NOT EXISTS artist_keys(
+        artist_key BIGINT NOT NULL,
+        artist_id TEXT NOT NULL sortkey
+    ) diststyle all;
+""")
+
+
+# AGGREGATE TABLES
+# Maintained incrementally from the new songplays by aggregate_refresh (see aggregates.py). The plays are
+# additive, so the daily active users are counted from the plays per (day, user, level).
+
+daily_song_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_song_plays(
+        play_day TIMESTAMP NOT NULL sortkey,
+        song_key BIGINT NOT NULL distkey,
+        plays BIGINT NOT NULL
+    );
+""")
+
+
+hourly_level_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_hourly_level_plays(
+        play_hour TIMESTAMP NOT NULL sortkey,
+        level TEXT NOT NULL,
+        plays BIGINT NOT NULL
+    ) diststyle all;
+""")
+
+
+daily_user_plays_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_user_plays(
+        play_day TIMESTAMP NOT NULL sortkey,
+        user_id INT NOT NULL distkey,
+        level TEXT NOT NULL,
+        plays BIGINT NOT NULL
+    );
+""")
+
+
+aggregate_watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS aggregate_watermark(
+        loaded_at TIMESTAMP NOT NULL
+    ) diststyle all;
+""")
+
+
 # STAGING TABLES
 
 staging_events_copy = ("""
@@ -139,51 +207,151 @@ staging_songs_copy = ("""
 """).format(config["S3"]["song_data"], config["IAM_ROLE"]["arn"])
 
 
+# STAGING TABLES, INCREMENTAL LOADS
+# Same as above but reading a COPY manifest listing only the S3 objects not loaded yet.
+# The manifest url is formatted in by incremental_load.py.
+
+staging_events_manifest_copy = ("""
+    COPY staging_events
+    FROM '{{}}'
+    iam_role '{}'
+    region 'us-west-2'
+    COMPUPDATE OFF
+    JSON {}
+    MANIFEST;
+""").format(config["IAM_ROLE"]["arn"], config["S3"]["LOG_JSONPATH"])
+
+
+staging_songs_manifest_copy = ("""
+    COPY staging_songs
+    FROM '{{}}'
+    iam_role '{}'
+    region 'us-west-2'
+    COMPUPDATE OFF
+    FORMAT AS json 'auto'
+    MANIFEST;
+""").format(config["IAM_ROLE"]["arn"])
+
+
+# STAGING TABLES, PRE-PROCESSED INPUT
+# Loads the compressed CSV parts written by preprocess_logs.py, listed in a manifest.
+# Table, manifest url and compression (GZIP or ZSTD) are formatted in by preprocess_logs.py.
+
+staging_csv_copy = ("""
+    COPY {{table}}
+    FROM '{{manifest_url}}'
+    iam_role '{}'
+    region 'us-west-2'
+    COMPUPDATE OFF
+    CSV {{compression}}
+    NULL AS '\\\\N'
+    MANIFEST;
+""").format(config["IAM_ROLE"]["arn"])
+
+
+# EXPORT
+# Parallel UNLOAD of a table to Parquet, with a manifest listing the files (see export.py). The query (its
+# quotes doubled), target url, PARTITION BY clause and maximum file size are formatted in by export.py.
+
+table_unload = ("""
+    UNLOAD ('{{query}}')
+    TO '{{target}}'
+    iam_role '{}'
+    FORMAT AS PARQUET
+    {{partition_by}}
+    MAXFILESIZE {{max_file_size}} MB
+    PARALLEL ON
+    MANIFEST VERBOSE
+    CLEANPATH;
+""").format(config["IAM_ROLE"]["arn"])
+
+
 # FINAL TABLES
 
 songplay_table_insert = ("""
-    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    INSERT INTO songplays (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
     SELECT se.ts AS start_time,
             se.user_id AS user_id,
             se.level AS level,
-            ss.song_id AS song_id,
-            ss.artist_id AS artist_id,
+            sa.song_key AS song_key,
+            sa.artist_key AS artist_key,
             se.session_id AS session_id,
             se.location AS location,
             se.user_agent AS user_agent
-    FROM staging_songs AS ss
-    INNER JOIN staging_events AS se ON ss.title = se.song
-    INNER JOIN staging_events AS se2 ON se2.artist = ss.artist_name;
+    FROM staging_events AS se
+    INNER JOIN (
+        -- One song per (title, artist, duration), so that a play can't match several songs. The songs are those
+        -- of the dimension, not of staging_songs which only holds the songs of the current load, and the artist
+        -- is the name the song is credited to: artists keeps a single name per artist_id.
+        SELECT song_key, artist_key, title, artist_name, duration,
+               ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS song_rank
+        FROM songs
+    ) AS sa ON sa.title = se.song
+           AND sa.artist_name = se.artist
+           AND sa.duration = se.length
+           AND sa.song_rank = 1
+    WHERE se.page = 'NextSong';
 """)
 
 
-user_table_insert = ("""
-    INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT se.user_id,
-           se.first_name,
-           se.last_name,
-           se.gender,
-           se.level
-    FROM staging_events AS se
-    WHERE se.first_name IS NOT NULL;
+# Incremental songplays insert: a play is identified by its time, user and session, and the plays already in
+# songplays aren't added again. The objects loaded by a full load aren't recorded in load_ledger, so the first
+# incremental load after it copies them again.
+songplay_table_merge = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT se.ts AS start_time,
+            se.user_id AS user_id,
+            se.level AS level,
+            sa.song_key AS song_key,
+            sa.artist_key AS artist_key,
+            se.session_id AS session_id,
+            se.location AS location,
+            se.user_agent AS user_agent
+    FROM (
+        SELECT ts, user_id, level, session_id, location, user_agent, song, artist, length,
+               ROW_NUMBER() OVER (PARTITION BY ts, user_id, session_id ORDER BY item_in_session) AS event_rank
+        FROM staging_events
+        WHERE page = 'NextSong'
+    ) AS se
+    INNER JOIN (
+        -- The songs of the dimension, as in songplay_table_insert.
+        SELECT song_key, artist_key, title, artist_name, duration,
+               ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS song_rank
+        FROM songs
+    ) AS sa ON sa.title = se.song
+           AND sa.artist_name = se.artist
+           AND sa.duration = se.length
+           AND sa.song_rank = 1
+    WHERE se.event_rank = 1
+      AND NOT EXISTS (SELECT 1 FROM songplays AS sp
+                      WHERE sp.start_time = se.ts AND sp.user_id = se.user_id AND sp.session_id = se.session_id);
 """)
 
 
-song_table_insert = ("""
-    INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT song_id, title, artist_id, year, duration
-    FROM staging_songs;
+songplay_count = ("""
+    SELECT COUNT(*) FROM songplays;
 """)
 
 
-artist_table_insert = ("""
-    INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT artist_id,
-            artist_name AS name,
-            artist_location AS location,
-            artist_latitude AS latitude,
-            artist_longitude AS longitude
-    FROM staging_songs;
+nextsong_event_count = ("""
+    SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong';
+""")
+
+
+# songs and time are deduplicated: staging_songs may hold a song several times and staging_events has many events
+# per timestamp, and a row already in the table (loaded by a previous incremental run) is not added again.
+
+song_table_insert = ("""
+    INSERT INTO songs (song_key, song_id, title, artist_key, artist_name, year, duration)
+    SELECT song_key, song_id, title, artist_key, artist_name, year, duration FROM (
+        SELECT sk.song_key, ss.song_id, ss.title, ak.artist_key, ss.artist_name, ss.year, ss.duration,
+               ROW_NUMBER() OVER (PARTITION BY ss.song_id ORDER BY ss.year DESC NULLS LAST) AS song_rank
+        FROM staging_songs AS ss
+        INNER JOIN song_keys AS sk ON sk.song_id = ss.song_id
+        INNER JOIN artist_keys AS ak ON ak.artist_id = ss.artist_id
+    ) AS ranked
+    WHERE song_rank = 1
+      AND NOT EXISTS (SELECT 1 FROM songs AS s WHERE s.song_key = ranked.song_key);
 """)
 
 
@@ -196,60 +364,418 @@ time_table_insert = ("""
             date_part(month, start_time) AS month,
             date_part(year, start_time) AS year,
             date_part(weekday, start_time) AS weekday
-    FROM staging_events
+    FROM (SELECT DISTINCT ts FROM staging_events WHERE ts IS NOT NULL) AS new_events
+    WHERE NOT EXISTS (SELECT 1 FROM time WHERE time.start_time = (timestamp 'epoch' + ts * interval '1 second'/1000));
 """)
 
 
-temp_user_table_create = ("""
-    CREATE TABLE IF NOT EXISTS temp_users(
-        user_id INT sortkey,
-        first_name TEXT NOT NULL,
-        last_name TEXT NOT NULL,
-        gender VARCHAR(1),
-        level TEXT
-    )
-    diststyle all;
+# KEY ASSIGNMENT
+# The natural ids not mapped yet get the next keys, after the largest key assigned so far. Plain SQL instead of an
+# IDENTITY column, so that the maps can be copied with their keys (see blue_green.py) and run locally.
+
+key_assign_template = ("""
+    INSERT INTO {entity}_keys ({entity}_key, {entity}_id)
+    SELECT (SELECT COALESCE(MAX({entity}_key), 0) FROM {entity}_keys) + ROW_NUMBER() OVER (ORDER BY {entity}_id),
+           {entity}_id
+    FROM (SELECT DISTINCT {entity}_id FROM staging_songs WHERE {entity}_id IS NOT NULL) AS natural_ids
+    WHERE NOT EXISTS (SELECT 1 FROM {entity}_keys AS mapped WHERE mapped.{entity}_id = natural_ids.{entity}_id);
 """)
 
 
-temp_artist_table_create = ("""
-    CREATE TABLE IF NOT EXISTS temp_artists(
-        artist_id TEXT sortkey distkey,
-        name TEXT NOT NULL,
-        location TEXT,
-        latitude TEXT,
-        longitude TEXT
-    );
+song_key_assign = key_assign_template.format(entity='song')
+artist_key_assign = key_assign_template.format(entity='artist')
+
+
+key_map_copy = ("""
+    INSERT INTO {target_schema}.{table} SELECT * FROM {source_schema}.{table};
+""")
+
+
+# DIMENSION UPSERTS
+# Generic staged upsert for the dimension tables: the source rows are deduplicated on the natural key,
+# the latest row (by 'order_by') winning, then the matching rows of the dimension are deleted and the
+# deduplicated rows inserted. All the statements run in a single execute, hence in a single transaction.
+# A dimension with a 'version' column (stored in the table) only has its rows replaced by newer source rows:
+# a late batch of older events doesn't overwrite a newer row.
+# To upsert another dimension, add its specification to dimension_upserts.
+
+dimension_upsert_template = ("""
+    CREATE TEMP TABLE {table}_upsert AS
+    SELECT {columns} FROM (
+        SELECT {columns},
+               ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {order_by} DESC NULLS LAST) AS row_rank
+        FROM ({source}) AS source
+        WHERE {key} IS NOT NULL
+    ) AS ranked
+    WHERE row_rank = 1;
+{newer_only}
+    DELETE FROM {table} USING {table}_upsert WHERE {table}.{key} = {table}_upsert.{key};
+
+    INSERT INTO {table} ({columns})
+    SELECT {columns} FROM {table}_upsert;
+
+    DROP TABLE {table}_upsert;
 """)
 
 
-load_temp_users = ("""
-    INSERT INTO temp_users
-        SELECT DISTINCT(user_id), first_name, last_name, gender, level FROM users;
+dimension_upsert_newer_only = ("""
+    DELETE FROM {table}_upsert USING {table}
+    WHERE {table}_upsert.{key} = {table}.{key} AND {table}.{version} >= {table}_upsert.{version};
+""")
+
+
+dimension_upserts = {
+    # A user's level changes over time: the row of their latest event wins, within the batch and against the
+    # row already stored (the ts of its event is kept in last_event_ts).
+    'users': {
+        'key': 'user_id',
+        'columns': 'user_id, first_name, last_name, gender, level, last_event_ts',
+        'order_by': 'last_event_ts',
+        'version': 'last_event_ts',
+        'source': """SELECT user_id, first_name, last_name, gender, level, ts AS last_event_ts
+                     FROM staging_events
+                     WHERE first_name IS NOT NULL"""
+    },
+    # staging_songs has no timestamp: the artist details of their most recent song win.
+    'artists': {
+        'key': 'artist_key',
+        'columns': 'artist_key, artist_id, name, location, latitude, longitude',
+        'order_by': 'year',
+        'source': """SELECT ak.artist_key,
+                            ss.artist_id,
+                            ss.artist_name AS name,
+                            ss.artist_location AS location,
+                            ss.artist_latitude AS latitude,
+                            ss.artist_longitude AS longitude,
+                            ss.year
+                     FROM staging_songs AS ss
+                     INNER JOIN artist_keys AS ak ON ak.artist_id = ss.artist_id"""
+    },
+}
+
+
+# AGGREGATE REFRESH
+# The songplays loaded since the watermark (loaded_at of the last refresh) are copied into a temporary delta
+# table; each aggregate adds the counts of the delta to its existing rows (delete and re-insert of the keys
+# found in the delta), then the watermark moves to the newest row of the delta. All the statements run in a
+# single execute, hence in a single transaction. To maintain another aggregate, add it to aggregate_tables.
+
+aggregate_delta_create = ("""
+    CREATE TEMP TABLE songplays_delta AS
+    SELECT start_time AS ts, user_id, COALESCE(level, 'unknown') AS level, song_key, loaded_at
+    FROM songplays
+    WHERE loaded_at > (SELECT COALESCE(MAX(loaded_at), TIMESTAMP '1900-01-01') FROM aggregate_watermark);
+""")
+
+
+aggregate_merge_template = ("""
+    CREATE TEMP TABLE {table}_merge AS
+    SELECT {key_select}, COALESCE(existing.plays, 0) + delta.plays AS plays
+    FROM (
+        SELECT {keys}, COUNT(*) AS plays
+        FROM (SELECT {key_expressions} FROM songplays_delta) AS keyed
+        WHERE {not_null}
+        GROUP BY {keys}
+    ) AS delta
+    LEFT JOIN {table} AS existing ON {key_join};
+
+    DELETE FROM {table} USING {table}_merge WHERE {delete_join};
+
+    INSERT INTO {table} ({keys}, plays)
+    SELECT {keys}, plays FROM {table}_merge;
+
+    DROP TABLE {table}_merge;
+""")
+
+
+aggregate_watermark_update = ("""
+    INSERT INTO aggregate_watermark (loaded_at)
+    SELECT MAX(loaded_at) FROM songplays_delta HAVING COUNT(*) > 0;
+
+    DELETE FROM aggregate_watermark WHERE loaded_at < (SELECT MAX(loaded_at) FROM aggregate_watermark);
+
+    DROP TABLE songplays_delta;
+""")
+
+
+aggregate_tables = {
+    'agg_daily_song_plays': {
+        'keys': ['play_day', 'song_key'],
+        'key_expressions': "DATE_TRUNC('day', (timestamp 'epoch' + ts * interval '1 second'/1000)) AS play_day, "
+                           "song_key",
+    },
+    'agg_hourly_level_plays': {
+        'keys': ['play_hour', 'level'],
+        'key_expressions': "DATE_TRUNC('hour', (timestamp 'epoch' + ts * interval '1 second'/1000)) AS play_hour, "
+                           "level",
+    },
+    'agg_daily_user_plays': {
+        'keys': ['play_day', 'user_id', 'level'],
+        'key_expressions': "DATE_TRUNC('day', (timestamp 'epoch' + ts * interval '1 second'/1000)) AS play_day, "
+                           "user_id, level",
+    },
+}
+
+
+def build_aggregate_merge(table, keys, key_expressions):
+    """
+    Returns the statements merging the counts of songplays_delta into aggregate 'table' (string), grouped by
+    'keys' (list of strings) computed by key_expressions (string, SELECT list over songplays_delta).
+    """
+    return aggregate_merge_template.format(
+        table=table,
+        keys=', '.join(keys),
+        key_select=', '.join(f"delta.{key}" for key in keys),
+        key_expressions=key_expressions,
+        not_null=' AND '.join(f"{key} IS NOT NULL" for key in keys),
+        key_join=' AND '.join(f"existing.{key} = delta.{key}" for key in keys),
+        delete_join=' AND '.join(f"{table}.{key} = {table}_merge.{key}" for key in keys))
+
+
+aggregate_refresh = aggregate_delta_create + \
+    ''.join(build_aggregate_merge(table, **spec) for table, spec in aggregate_tables.items()) + \
+    aggregate_watermark_update
+
+
+def build_dimension_upsert(table, key, columns, order_by, source, version=None):
+    """
+    Returns the statements upserting dimension 'table' (string) from the rows of 'source' (string, SELECT
+    returning 'columns'), deduplicated on 'key' by 'order_by' (strings). With 'version' (string, a column of
+    the table), a stored row is only replaced by a source row with a greater version.
+    """
+    newer_only = dimension_upsert_newer_only.format(table=table, key=key, version=version) if version else ""
+    return dimension_upsert_template.format(table=table, key=key, columns=columns, order_by=order_by,
+                                            source=source, newer_only=newer_only)
+
+
+user_table_upsert = build_dimension_upsert('users', **dimension_upserts['users'])
+artist_table_upsert = build_dimension_upsert('artists', **dimension_upserts['artists'])
+stream_user_upsert = build_dimension_upsert(
+    'users', **dict(dimension_upserts['users'],
+                    source=dimension_upserts['users']['source'].replace("staging_events", "staging_events_stream")))
+
+
+# INCREMENTAL LOADS
+
+load_ledger_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_ledger(
+        s3_key VARCHAR(1024) NOT NULL sortkey,
+        prefix VARCHAR(256) NOT NULL,
+        size BIGINT,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    ) diststyle all;
+""")
+
+
+select_loaded_keys = ("""
+    SELECT s3_key FROM load_ledger WHERE prefix = %s;
+""")
+
+
+insert_loaded_keys = ("""
+    INSERT INTO load_ledger (s3_key, prefix, size) VALUES %s;
+""")
+
+
+staging_events_table_truncate = "TRUNCATE staging_events"
+staging_songs_table_truncate = "TRUNCATE staging_songs"
+
+
+# The staging tables only hold the new objects, so songplays are appended to, users and artists are upserted
+# and new songs and timestamps are added (song_table_insert and time_table_insert skip the rows already loaded).
+# The new plays are matched against all the songs loaded so far, once the new songs are merged.
+
+
+# STREAMING INGESTION
+# Each micro-batch of new log objects is COPYed into its own staging table, emptied with a DELETE (TRUNCATE would
+# commit) so that the COPY and the merges of a batch commit at once (see stream_ingest.py). The merges are
+# idempotent: a batch loaded again (e.g. after a failure before its keys were recorded in the ledger) adds no
+# songplays nor time rows twice, and a play logged twice in a batch is inserted once.
+
+staging_events_stream_table_create = staging_events_table_create.replace("staging_events", "staging_events_stream")
+
+
+staging_events_stream_delete = ("""
+    DELETE FROM staging_events_stream;
+""")
+
+
+staging_events_stream_manifest_copy = staging_events_manifest_copy.replace("COPY staging_events",
+                                                                           "COPY staging_events_stream")
+
+
+staging_events_stream_count = ("""
+    SELECT COUNT(*) FROM staging_events_stream;
+""")
+
+
+# The stream merges the songplays of its batch like an incremental load:
+stream_songplay_insert = songplay_table_merge.replace("FROM staging_events\n", "FROM staging_events_stream\n")
+
+
+stream_time_insert = time_table_insert.replace("staging_events", "staging_events_stream")
+
+
+# PIPELINE CHECKPOINTS
+# One row per stage completed on the current generation of the tables (see checkpoints.py). Each row is
+# written in the same transaction as its stage, so a committed stage always has its checkpoint.
+# Stage names and fingerprints (hexadecimal digests) are formatted in by checkpoints.py.
+
+checkpoint_table_create = ("""
+    CREATE TABLE IF NOT EXISTS pipeline_checkpoints(
+        stage VARCHAR(64) NOT NULL sortkey,
+        input_fingerprint CHAR(64) NOT NULL,
+        output_fingerprint CHAR(64) NOT NULL,
+        completed_at TIMESTAMP DEFAULT GETDATE()
+    ) diststyle all;
+""")
+
+
+select_checkpoints = ("""
+    SELECT stage, input_fingerprint, output_fingerprint FROM pipeline_checkpoints;
+""")
+
+
+checkpoint_upsert = ("""
+    DELETE FROM pipeline_checkpoints WHERE stage = '{stage}';
+    INSERT INTO pipeline_checkpoints (stage, input_fingerprint, output_fingerprint)
+    VALUES ('{stage}', '{input_fingerprint}', '{output_fingerprint}');
+""")
+
+
+checkpoints_delete = ("""
+    DELETE FROM pipeline_checkpoints;
+""")
+
+
+# SCHEMAS
+# The schema of the tables (option cl_schema of section 'CLUSTER'), created if needed and granted to the readers
+# by connection_manager.py, and the schemas of the blue/green reloads, checked and formatted in by blue_green.py.
+
+schema_exists = ("""
+    SELECT COUNT(*) FROM pg_namespace WHERE nspname = %s;
+""")
+
+
+schema_drop = ("""
+    DROP SCHEMA IF EXISTS {schema} CASCADE;
+""")
+
+
+schema_create = ("""
+    CREATE SCHEMA {schema};
+""")
+
+
+schema_create_if_missing = ("""
+    CREATE SCHEMA IF NOT EXISTS {schema};
+""")
+
+
+schema_grant_usage = ("""
+    GRANT USAGE ON SCHEMA {schema} TO {grantee};
+""")
+
+
+schema_grant_select = ("""
+    GRANT SELECT ON ALL TABLES IN SCHEMA {schema} TO {grantee};
+""")
+
+
+schema_rename = ("""
+    ALTER SCHEMA {schema} RENAME TO {new_name};
+""")
+
+
+table_exists = ("""
+    SELECT COUNT(*) FROM pg_tables WHERE schemaname = %s AND tablename = %s;
+""")
+
+
+schema_table_count = ("""
+    SELECT '{table}', COUNT(*) FROM {schema}.{table}
+""")
+
+
+# TABLE MAINTENANCE
+# Health of the tables of the current schema (see maintenance.py): staleness of the statistics, unsorted and
+# deleted rows, in percent. Empty tables aren't listed by svv_table_info. Table names are formatted in by
+# maintenance.py.
+
+table_health = ("""
+    SELECT "table", COALESCE(stats_off, 100), COALESCE(unsorted, 0), tbl_rows,
+           COALESCE(estimated_visible_rows, tbl_rows)
+    FROM svv_table_info
+    WHERE schema = CURRENT_SCHEMA() AND "table" IN %s;
 """)
 
 
-load_temp_artists = ("""
-    INSERT INTO temp_artists
-        SELECT DISTINCT(artist_id), name, location, latitude, longitude FROM artists;
+table_analyze = ("""
+    ANALYZE {table};
 """)
 
 
-rename_temp_user = ("""
-    ALTER TABLE temp_users RENAME TO users
+table_vacuum_sort = ("""
+    VACUUM SORT ONLY {table} TO {threshold} PERCENT;
 """)
 
 
-rename_temp_artist = ("""
-    ALTER TABLE temp_artists RENAME TO artists
+table_vacuum_delete = ("""
+    VACUUM DELETE ONLY {table};
 """)
 
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, song_key_table_create, artist_key_table_create, daily_song_plays_table_create, hourly_level_plays_table_create, daily_user_plays_table_create, aggregate_watermark_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, daily_song_plays_table_drop, hourly_level_plays_table_drop, daily_user_plays_table_drop, aggregate_watermark_table_drop]
 load_staging_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
-remove_duplicate_users_queries = [temp_user_table_create, load_temp_users, user_table_drop, rename_temp_user]
-remove_duplicate_artists_queries = [temp_artist_table_create, load_temp_artists, artist_table_drop, rename_temp_artist]
\ No newline at end of file
+stream_merge_queries = [stream_songplay_insert, stream_user_upsert, stream_time_insert, aggregate_refresh]
+
+# QUERY NODES
+# Each statement is declared with the tables it reads (inputs) and writes (outputs), so that
+# dag_scheduler.py can work out which statements depend on each other and which can run concurrently.
+
+aggregate_table_names = list(aggregate_tables) + ['aggregate_watermark']
+
+load_staging_table_nodes = [
+    {'name': 'copy_staging_events', 'query': staging_events_copy, 'inputs': [], 'outputs': ['staging_events']},
+    {'name': 'copy_staging_songs', 'query': staging_songs_copy, 'inputs': [], 'outputs': ['staging_songs']},
+]
+
+insert_table_nodes = [
+    {'name': 'assign_song_keys', 'query': song_key_assign, 'inputs': ['staging_songs', 'song_keys'],
+     'outputs': ['song_keys']},
+    {'name': 'assign_artist_keys', 'query': artist_key_assign, 'inputs': ['staging_songs', 'artist_keys'],
+     'outputs': ['artist_keys']},
+    {'name': 'upsert_users', 'query': user_table_upsert, 'inputs': ['staging_events', 'users'], 'outputs': ['users']},
+    {'name': 'insert_songs', 'query': song_table_insert,
+     'inputs': ['staging_songs', 'songs', 'song_keys', 'artist_keys'], 'outputs': ['songs']},
+    {'name': 'upsert_artists', 'query': artist_table_upsert, 'inputs': ['staging_songs', 'artists', 'artist_keys'],
+     'outputs': ['artists']},
+    {'name': 'insert_songplays', 'query': songplay_table_insert, 'inputs': ['staging_events', 'songs'],
+     'outputs': ['songplays']},
+    {'name': 'insert_time', 'query': time_table_insert, 'inputs': ['staging_events', 'time'], 'outputs': ['time']},
+    {'name': 'refresh_aggregates', 'query': aggregate_refresh, 'inputs': ['songplays'] + aggregate_table_names,
+     'outputs': aggregate_table_names},
+]
+
+insert_table_queries = [node['query'] for node in insert_table_nodes]
+etl_nodes = load_staging_table_nodes + insert_table_nodes
+
+incremental_merge_nodes = [
+    {'name': 'assign_song_keys', 'query': song_key_assign, 'inputs': ['staging_songs', 'song_keys'],
+     'outputs': ['song_keys']},
+    {'name': 'assign_artist_keys', 'query': artist_key_assign, 'inputs': ['staging_songs', 'artist_keys'],
+     'outputs': ['artist_keys']},
+    {'name': 'upsert_users', 'query': user_table_upsert, 'inputs': ['staging_events', 'users'], 'outputs': ['users']},
+    {'name': 'merge_songs', 'query': song_table_insert,
+     'inputs': ['staging_songs', 'songs', 'song_keys', 'artist_keys'], 'outputs': ['songs']},
+    {'name': 'upsert_artists', 'query': artist_table_upsert, 'inputs': ['staging_songs', 'artists', 'artist_keys'],
+     'outputs': ['artists']},
+    {'name': 'merge_songplays', 'query': songplay_table_merge, 'inputs': ['staging_events', 'songs'],
+     'outputs': ['songplays']},
+    {'name': 'insert_time', 'query': time_table_insert, 'inputs': ['staging_events', 'time'], 'outputs': ['time']},
+    {'name': 'refresh_aggregates', 'query': aggregate_refresh, 'inputs': ['songplays'] + aggregate_table_names,
+     'outputs': aggregate_table_names},
+]
@@ -0,0 +1,291 @@
+"""
+This module ingests the event logs as they arrive, in micro-batches, so that the plays show up within minutes
+instead of after the next full or incremental load. It watches the LOG_DATA prefix (or a local directory with
+--local) and collects the new objects into a batch until the batch holds max_batch_mb or its oldest object has
+waited max_batch_seconds (section 'STREAM' of dwh.cfg). Each batch is COPYed into staging table
+staging_events_stream and merged into songplays, users and time (then the aggregates are refreshed) in a single
+transaction. The merges are idempotent (see sql_queries.py): a batch is never counted twice, even when it is
+loaded again.
+On the cluster, the keys of each batch are recorded in the load ledger shared with incremental_load.py, so
+neither loads them again. Locally, the files already ingested are only remembered until the process stops.
+The watching and the loading are behind a small interface (list_new() and ingest()), implemented by
+S3LogIngestor and LocalLogIngestor. Each batch reports its lag (from the arrival of its oldest object to the
+commit) and its throughput.
+Contains the following functions:
+- get_stream_settings()
+- take_batch()
+- print_batch_report()
+- run_stream()
+- main()
+- main_local()
+and the following classes:
+- S3LogIngestor
+- LocalLogIngestor.
+
+Run 'python stream_ingest.py' to ingest into the cluster, until interrupted ('--local' for the local backend,
+'--max-batches' to stop after a number of batches).
+"""
+import argparse
+import configparser
+import os
+import time
+
+import boto3
+
+import create_role_cluster as create_rc
+import incremental_load
+import instrumentation
+from connection_manager import ConnectionManager
+from unit_of_work import UnitOfWork, get_retry_settings
+from sql_queries import create_table_queries, load_ledger_table_create, staging_events_stream_table_create, \
+    staging_events_stream_delete, staging_events_stream_manifest_copy, staging_events_stream_count, \
+    stream_merge_queries, songplay_count
+
+DEFAULT_SETTINGS = {'poll_seconds': 10.0, 'max_batch_seconds': 60.0, 'max_batch_mb': 128.0}
+
+
+class S3LogIngestor:
+    """
+    Watches the LOG_DATA prefix of config (ConfigParser object) with s3_client (boto3 S3 client) and ingests the
+    batches into the cluster, on connections of 'connections' (ConnectionManager object). The schema, the tables,
+    the load ledger and the stream staging table are created if they don't exist, and granted to the readers.
+    """
+    def __init__(self, connections, s3_client, config):
+        self.connections = connections
+        self.s3_client = s3_client
+        self.prefix = config.get('S3', 'log_data').strip("'\"")
+        self.manifest_prefix = config.get('INCREMENTAL', 'manifest_prefix')
+        self.retry_settings = get_retry_settings(config)
+        with connections.connection() as conn:
+            UnitOfWork(conn, **self.retry_settings).run(
+                connections.schema_statements() + create_table_queries +
+                [load_ledger_table_create, staging_events_stream_table_create] + connections.grant_statements())
+            with conn.cursor() as cur:
+                self.loaded = incremental_load.get_loaded_keys(cur, self.prefix)
+            conn.commit()
+
+    def list_new(self):
+        """
+        Returns a dictionary mapping the key of each object of the prefix not loaded yet to a tuple (size in
+        bytes, arrival time as a Unix timestamp, its last modification).
+        """
+        bucket, prefix = incremental_load.split_s3_url(self.prefix)
+        objects = {}
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if not item['Key'].endswith('/') and item['Key'] not in self.loaded:
+                    objects[item['Key']] = (item['Size'], item['LastModified'].timestamp())
+        return objects
+
+    def ingest(self, objects):
+        """
+        COPYs 'objects' (dictionary key -> size) through a manifest into staging_events_stream, merges them and
+        records them in the load ledger, in a single transaction.
+        Returns a dictionary with the number of events loaded and of songplays added.
+        """
+        bucket, _ = incremental_load.split_s3_url(self.prefix)
+        manifest_url = incremental_load.upload_manifest(self.s3_client, self.manifest_prefix, 'staging_events_stream',
+                                                        incremental_load.build_manifest(bucket, objects))
+        unit = self.connections.unit_of_work(self.connections.getconn(), **self.retry_settings)
+        try:
+            with unit.conn.cursor() as cur:
+                cur.execute(songplay_count)
+                songplays_before = cur.fetchone()[0]
+            unit.conn.commit()
+            counts = {}
+
+            def count_and_record(cur):
+                cur.execute(staging_events_stream_count)
+                counts['events'] = cur.fetchone()[0]
+                cur.execute(songplay_count)
+                counts['songplays'] = cur.fetchone()[0] - songplays_before
+                # Recorded with the merges: a batch which failed is loaded again (idempotently) by the next one.
+                incremental_load.record_loaded_keys(cur, self.prefix, objects)
+
+            unit.run([staging_events_stream_delete, staging_events_stream_manifest_copy.format(manifest_url)]
+                     + stream_merge_queries, before_commit=count_and_record)
+        finally:
+            self.connections.putconn(unit.conn)
+        self.loaded.update(objects)
+        return counts
+
+
+class LocalLogIngestor:
+    """
+    Stand-in of S3LogIngestor for the local backend 'backend' (DuckDbBackend or PostgresBackend object, see
+    local_backend.py), watching the .json files under 'directory' (string). The files ingested are remembered
+    in memory only: after a restart, they are ingested again, without adding anything.
+    """
+    def __init__(self, backend, directory):
+        self.backend = backend
+        self.directory = directory
+        self.loaded = set()
+        for query in create_table_queries + [staging_events_stream_table_create]:
+            backend.execute(query)
+
+    def list_new(self):
+        """
+        Returns a dictionary mapping the path of each file not ingested yet to a tuple (size in bytes, arrival
+        time as a Unix timestamp, its last modification).
+        """
+        import local_backend
+        objects = {}
+        for path in local_backend.list_json_files(self.directory):
+            if path not in self.loaded:
+                stat = os.stat(path)
+                objects[path] = (stat.st_size, stat.st_mtime)
+        return objects
+
+    def ingest(self, objects):
+        """
+        Loads the files of 'objects' (dictionary path -> size) into staging_events_stream and merges them, in a
+        single transaction. Returns a dictionary with the number of events loaded and of songplays added.
+        """
+        songplays_before = self.backend.execute(songplay_count)[0][0]
+        self.backend.execute("BEGIN TRANSACTION;")
+        try:
+            self.backend.execute(staging_events_stream_delete)
+            self.backend.load_staging('staging_events_stream', self.directory, sorted(objects))
+            for query in stream_merge_queries:
+                self.backend.execute(query)
+            self.backend.execute("COMMIT;")
+        except Exception:
+            self.backend.execute("ROLLBACK;")
+            raise
+        self.loaded.update(objects)
+        return {'events': self.backend.execute(staging_events_stream_count)[0][0],
+                'songplays': self.backend.execute(songplay_count)[0][0] - songplays_before}
+
+
+def get_stream_settings(config):
+    """
+    Returns the settings of section 'STREAM' of config (ConfigParser object) as a dictionary: poll_seconds
+    (float, wait between two listings), max_batch_seconds (float, longest wait of an object before its batch is
+    loaded) and max_batch_bytes (int, size from which a batch is loaded, from option max_batch_mb).
+    """
+    settings = {key: config.getfloat('STREAM', key, fallback=default) for key, default in DEFAULT_SETTINGS.items()}
+    settings['max_batch_bytes'] = int(settings.pop('max_batch_mb') * 1024 ** 2)
+    return settings
+
+
+def take_batch(pending, now, max_batch_bytes, max_batch_seconds):
+    """
+    Returns the next batch of 'pending' (dictionary key -> (size, arrival time)) at time 'now' (Unix timestamp),
+    as a dictionary in the same format: the oldest objects, up to max_batch_bytes (int, at least one object),
+    once they add up to max_batch_bytes or the oldest one has waited max_batch_seconds (float).
+    Returns an empty dictionary if no batch is due yet.
+    """
+    if not pending:
+        return {}
+    if sum(size for size, _ in pending.values()) < max_batch_bytes and \
+            now - min(arrival for _, arrival in pending.values()) < max_batch_seconds:
+        return {}
+    batch = {}
+    batch_bytes = 0
+    for key, (size, arrival) in sorted(pending.items(), key=lambda item: item[1][1]):
+        if batch and batch_bytes + size > max_batch_bytes:
+            break
+        batch[key] = (size, arrival)
+        batch_bytes += size
+    return batch
+
+
+def print_batch_report(report):
+    """
+    Prints the report of a batch (dictionary, see run_stream()) on one line.
+    """
+    print(f"Batch {report['batch']}: {report['objects']} object(s), {report['bytes'] / 1024 ** 2:.1f} MB, "
+          f"{report['events']} events -> {report['songplays']} songplays in {report['seconds']:.1f}s "
+          f"({report['events_per_second']:.0f} events/s, {report['mb_per_second']:.2f} MB/s), "
+          f"lag {report['lag_seconds']:.0f}s.")
+
+
+def run_stream(ingestor, settings, max_batches=None):
+    """
+    Lists the new objects with 'ingestor' (S3LogIngestor or LocalLogIngestor object) every poll_seconds of
+    'settings' (dictionary, see get_stream_settings()) and ingests them in batches (see take_batch()), until
+    'max_batches' (int, optional) batches are ingested or the process is interrupted.
+    Returns the reports of the batches: a list of dictionaries with keys batch, objects, bytes, events,
+    songplays, seconds, lag_seconds, events_per_second and mb_per_second.
+    """
+    pending = {}
+    reports = []
+    try:
+        while max_batches is None or len(reports) < max_batches:
+            for key, info in ingestor.list_new().items():
+                pending.setdefault(key, info)
+            batch = take_batch(pending, time.time(), settings['max_batch_bytes'], settings['max_batch_seconds'])
+            if not batch:
+                time.sleep(settings['poll_seconds'])
+                continue
+
+            start = time.perf_counter()
+            result = ingestor.ingest({key: size for key, (size, _) in batch.items()})
+            seconds = time.perf_counter() - start
+            batch_bytes = sum(size for size, _ in batch.values())
+            report = dict(result, batch=len(reports) + 1, objects=len(batch), bytes=batch_bytes, seconds=seconds,
+                          lag_seconds=time.time() - min(arrival for _, arrival in batch.values()),
+                          events_per_second=result['events'] / seconds if seconds else 0.0,
+                          mb_per_second=batch_bytes / 1024 ** 2 / seconds if seconds else 0.0)
+            print_batch_report(report)
+            reports.append(report)
+            for key in batch:
+                del pending[key]
+    except KeyboardInterrupt:
+        print(f"Stopped: {len(pending)} object(s) pending.")
+    return reports
+
+
+def main(connections=None, max_batches=None):
+    """
+    Ingests the new objects of LOG_DATA into the cluster described in dwh.cfg, on connections of 'connections'
+    (ConnectionManager object, one is created from dwh.cfg if None), until 'max_batches' (int, optional)
+    batches are ingested or the process is interrupted.
+    """
+    aws_cred = create_rc.AwsCredentials(create_rc.CONFIG_SECRET_FILE_NAME)
+    config = configparser.ConfigParser()
+    config.read(create_rc.CONFIG_FILE_NAME)
+    instrumentation.configure_from_config(config)
+    own_connections = connections is None
+    if own_connections:
+        connections = ConnectionManager.from_config(config)
+
+    s3 = boto3.client('s3', region_name=config.get('AWS', 'region'), aws_access_key_id=aws_cred.key,
+                      aws_secret_access_key=aws_cred.secret)
+    try:
+        reports = run_stream(S3LogIngestor(connections, s3, config), get_stream_settings(config), max_batches)
+    finally:
+        if own_connections:
+            connections.closeall()
+    print(f"Streaming ingestion done: {len(reports)} batch(es), "
+          f"{sum(report['songplays'] for report in reports)} songplays added.")
+
+
+def main_local(max_batches=None, directory=None):
+    """
+    Ingests the new files of 'directory' (string, option log_data of section 'LOCAL' of dwh.cfg if None) into the
+    local backend, until 'max_batches' (int, optional) batches are ingested or the process is interrupted.
+    """
+    import local_backend
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = local_backend.get_backend(config)
+    try:
+        ingestor = LocalLogIngestor(backend, directory or config.get('LOCAL', 'log_data'))
+        reports = run_stream(ingestor, get_stream_settings(config), max_batches)
+    finally:
+        backend.close()
+    print(f"Streaming ingestion done: {len(reports)} batch(es), "
+          f"{sum(report['songplays'] for report in reports)} songplays added.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingests the new event logs in micro-batches.")
+    parser.add_argument('--local', action='store_true', help="ingest into the local backend (section LOCAL)")
+    parser.add_argument('--directory', help="local directory to watch (default: log_data of section LOCAL)")
+    parser.add_argument('--max-batches', type=int, help="stop after this number of batches")
+    args = parser.parse_args()
+    if args.local:
+        main_local(args.max_batches, args.directory)
+    else:
+        main(max_batches=args.max_batches)
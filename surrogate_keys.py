@@ -0,0 +1,188 @@
+"""
+This module reports what the integer surrogate keys of songs and artists save. The keys are assigned by the
+assign_song_keys and assign_artist_keys nodes of etl and incremental_load (see sql_queries.py): each new natural
+id gets the next key of its key map (song_keys, artist_keys), and keeps it across runs since the key maps are
+never dropped. songplays, songs and artists store and join on the 8-byte keys instead of the TEXT ids, and
+songplays and songs are distributed on song_key.
+The report compares, on the loaded tables:
+- the bytes of the key columns of songplays with those of the natural ids they replace,
+- the time of the star join on the keys with the same join on the natural ids, the fact table being rebuilt
+  with the natural ids in a temporary table.
+Contains the following functions:
+- measure_storage()
+- time_query()
+- measure_joins()
+- build_report()
+- print_report()
+- report_on_connection()
+- main()
+
+Run 'python surrogate_keys.py' to report on the cluster ('--local' for the local backend).
+"""
+import argparse
+import configparser
+import time
+
+KEY_BYTES = 8
+# Redshift stores a VARCHAR as its bytes plus a 4-byte length.
+VARCHAR_OVERHEAD = 4
+DEFAULT_REPEATS = 3
+
+STORAGE_QUERY = """
+    SELECT COUNT(*), SUM(OCTET_LENGTH(sk.song_id)), SUM(OCTET_LENGTH(ak.artist_id))
+    FROM songplays AS sp
+    LEFT JOIN song_keys AS sk ON sk.song_key = sp.song_key
+    LEFT JOIN artist_keys AS ak ON ak.artist_key = sp.artist_key;
+"""
+NATURAL_FACT_CREATE = """
+    CREATE TEMP TABLE songplays_natural AS
+    SELECT sp.songplay_id, sp.start_time, sp.user_id, sk.song_id, ak.artist_id
+    FROM songplays AS sp
+    LEFT JOIN song_keys AS sk ON sk.song_key = sp.song_key
+    LEFT JOIN artist_keys AS ak ON ak.artist_key = sp.artist_key;
+"""
+NATURAL_FACT_DROP = "DROP TABLE songplays_natural;"
+RESULT_CACHE_OFF = "SET enable_result_cache_for_session TO off;"
+RESULT_CACHE_ON = "SET enable_result_cache_for_session TO on;"
+JOIN_QUERIES = {
+    'keys': """
+        SELECT s.year, COUNT(*), COUNT(DISTINCT a.name)
+        FROM songplays AS sp
+        JOIN songs AS s ON s.song_key = sp.song_key
+        JOIN artists AS a ON a.artist_key = sp.artist_key
+        GROUP BY s.year;
+    """,
+    'natural_ids': """
+        SELECT s.year, COUNT(*), COUNT(DISTINCT a.name)
+        FROM songplays_natural AS sp
+        JOIN songs AS s ON s.song_id = sp.song_id
+        JOIN artists AS a ON a.artist_id = sp.artist_id
+        GROUP BY s.year;
+    """,
+}
+
+
+def measure_storage(run_query):
+    """
+    Returns a dictionary with the number of rows of songplays and the bytes of its key columns (keys_bytes)
+    and of the natural ids they replace (natural_bytes), uncompressed, with run_query (function taking a query
+    and returning its rows).
+    """
+    rows, song_id_bytes, artist_id_bytes = run_query(STORAGE_QUERY)[0]
+    return {'rows': rows, 'keys_bytes': 2 * KEY_BYTES * rows,
+            'natural_bytes': (song_id_bytes or 0) + (artist_id_bytes or 0) + 2 * VARCHAR_OVERHEAD * rows}
+
+
+def time_query(run_query, query, repeats=DEFAULT_REPEATS):
+    """
+    Runs 'query' (string) 'repeats' (int) times with run_query and returns the shortest duration in seconds
+    (the first run also compiles the query on Redshift).
+    """
+    durations = []
+    for _ in range(max(1, repeats)):
+        start = time.perf_counter()
+        run_query(query)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def measure_joins(run_query, repeats=DEFAULT_REPEATS):
+    """
+    Returns a dictionary mapping 'keys' and 'natural_ids' to the duration in seconds of the star join on the
+    surrogate keys and on the natural ids. run_query must run all the queries in the same session (temporary
+    table).
+    """
+    run_query(NATURAL_FACT_CREATE)
+    try:
+        return {name: time_query(run_query, query, repeats) for name, query in JOIN_QUERIES.items()}
+    finally:
+        run_query(NATURAL_FACT_DROP)
+
+
+def build_report(run_query, repeats=DEFAULT_REPEATS):
+    """
+    Returns the report of the savings of the surrogate keys: the result of measure_storage() plus
+    storage_saving (fraction of the key bytes saved) and the join timings of measure_joins() plus join_saving
+    (fraction of the join time saved).
+    """
+    report = measure_storage(run_query)
+    natural = report['natural_bytes']
+    report['storage_saving'] = 1 - report['keys_bytes'] / natural if natural else 0.0
+    report['joins'] = measure_joins(run_query, repeats)
+    natural = report['joins']['natural_ids']
+    report['join_saving'] = 1 - report['joins']['keys'] / natural if natural else 0.0
+    return report
+
+
+def print_report(report):
+    """
+    Prints the report returned by build_report().
+    """
+    print(f"\nSurrogate keys, songplays ({report['rows']} rows):")
+    print(f"- key columns: {report['natural_bytes'] / 1024 ** 2:.1f} MB of natural ids -> "
+          f"{report['keys_bytes'] / 1024 ** 2:.1f} MB of keys ({report['storage_saving']:.0%} smaller, "
+          f"uncompressed)")
+    print(f"- star join: {report['joins']['natural_ids']:.3f}s on the natural ids -> "
+          f"{report['joins']['keys']:.3f}s on the keys ({report['join_saving']:.0%} faster)")
+
+
+def report_on_connection(conn, repeats=DEFAULT_REPEATS):
+    """
+    Builds and prints the report on psycopg2 connection 'conn' (e.g. lent by the ConnectionManager of the run),
+    then commits. The result cache is off while the joins are timed, and back on afterwards since the connection
+    goes back to the pool. Returns the report.
+    """
+    with conn.cursor() as cur:
+        def run_query(query):
+            cur.execute(query)
+            return cur.fetchall() if cur.description else None
+        # Time the joins, not the result cache:
+        run_query(RESULT_CACHE_OFF)
+        try:
+            report = build_report(run_query, repeats)
+        except Exception:
+            # The failed transaction has to end before the cache can be turned back on.
+            conn.rollback()
+            raise
+        finally:
+            run_query(RESULT_CACHE_ON)
+    conn.commit()
+    print_report(report)
+    return report
+
+
+def main():
+    """
+    Prints the report on the tables of the cluster of dwh.cfg, or of the local backend with '--local'.
+    """
+    parser = argparse.ArgumentParser(description="Storage and join time saved by the surrogate keys.")
+    parser.add_argument('--local', action='store_true', help="report on the local backend (section LOCAL)")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help="runs of each join timed")
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.local:
+        import local_backend
+        backend = local_backend.get_backend(config)
+        run_query, close = backend.execute, backend.close
+    else:
+        from connection_manager import connect
+        conn = connect(config)
+        conn.autocommit = True
+
+        def run_query(query):
+            with conn.cursor() as cur:
+                cur.execute(query)
+                return cur.fetchall() if cur.description else None
+        # Time the joins, not the result cache:
+        run_query(RESULT_CACHE_OFF)
+        close = conn.close
+    try:
+        print_report(build_report(run_query, args.repeats))
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Shared set-up of the tests: the modules of the repository are imported from its root, which is also the working
+directory (sql_queries.py reads 'dwh.cfg' from it at import), and the AWS calls go to moto.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+REGION = 'us-west-2'
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """
+    Runs the test against moto, with fake credentials so that nothing can reach a real account.
+    """
+    from moto import mock_aws
+    for variable, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                            ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', REGION)]:
+        monkeypatch.setenv(variable, value)
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def config():
+    """
+    Returns the configuration of dwh.cfg (ConfigParser object), to be changed by the test.
+    """
+    import configparser
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'dwh.cfg'))
+    return config
@@ -0,0 +1,106 @@
+"""
+Tests of capacity_scheduler.run_with_capacity against a moto S3 and Redshift: the cluster is resized for the
+bytes under the LOG_DATA and SONG_DATA prefixes before the run, and resized back or paused after it, even if the
+run fails. moto only implements the classic resize.
+"""
+import boto3
+import pytest
+
+import capacity_scheduler
+from conftest import REGION
+
+INPUT_BUCKET = 'sparkify-input'
+CLUSTER_NAME = 'cl-sparkify'
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def clients(aws):
+    redshift, s3 = boto3.client('redshift', region_name=REGION), boto3.client('s3', region_name=REGION)
+    s3.create_bucket(Bucket=INPUT_BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+    redshift.create_cluster(ClusterIdentifier=CLUSTER_NAME, NodeType='dc2.large', MasterUsername='cl_user',
+                            MasterUserPassword='Passw0rd', ClusterType='multi-node', NumberOfNodes=2)
+    return redshift, s3
+
+
+@pytest.fixture
+def capacity_config(config):
+    """
+    Configuration where each node loads 1 MB per minute: the load must finish within one minute.
+    """
+    config['CLUSTER']['cl_identifier'] = CLUSTER_NAME
+    config['CLUSTER']['num_nodes'] = '2'
+    config['S3']['log_data'] = f"'s3://{INPUT_BUCKET}/log_data'"
+    config['S3']['song_data'] = f"'s3://{INPUT_BUCKET}/song_data'"
+    config['CAPACITY']['mb_per_second_per_node'] = str(1 / 60)
+    config['CAPACITY']['target_minutes'] = '1'
+    config['CAPACITY']['resize_method'] = 'classic'
+    config['PROVISIONING']['waiter_delay'] = '1'
+    config['PROVISIONING']['waiter_max_attempts'] = '2'
+    return config
+
+
+def put_data(s3, megabytes):
+    """
+    Writes 'megabytes' (int) MB of log and song data, half under each prefix.
+    """
+    for prefix in ['log_data', 'song_data']:
+        s3.put_object(Bucket=INPUT_BUCKET, Key=f"{prefix}/part.json", Body=b'x' * (megabytes * MB // 2))
+
+
+def cluster_state(redshift):
+    cluster = redshift.describe_clusters(ClusterIdentifier=CLUSTER_NAME)['Clusters'][0]
+    return cluster['ClusterStatus'], cluster['NumberOfNodes']
+
+
+def test_resizes_for_the_load_and_back(clients, capacity_config):
+    redshift, s3 = clients
+    put_data(s3, 6)
+    during_run = []
+
+    report = capacity_scheduler.run_with_capacity(redshift, s3, capacity_config,
+                                                  lambda: during_run.append(cluster_state(redshift)))
+
+    assert report['pending_bytes'] == 6 * MB
+    assert (report['nodes_before'], report['nodes']) == (2, 6)
+    assert during_run == [('available', 6)]
+    assert report['after_load'] == 'resized'
+    assert cluster_state(redshift) == ('available', 2)
+
+
+def test_small_load_keeps_the_cluster(clients, capacity_config):
+    redshift, s3 = clients
+    put_data(s3, 1)
+
+    report = capacity_scheduler.run_with_capacity(redshift, s3, capacity_config, lambda: None)
+
+    assert (report['nodes_before'], report['nodes']) == (2, 2)
+    assert report['after_load'] is None
+    assert cluster_state(redshift) == ('available', 2)
+
+
+def test_capacity_is_released_when_the_run_fails(clients, capacity_config):
+    redshift, s3 = clients
+    put_data(s3, 6)
+
+    def failing_run():
+        raise RuntimeError("load failed")
+
+    with pytest.raises(RuntimeError):
+        capacity_scheduler.run_with_capacity(redshift, s3, capacity_config, failing_run)
+    assert cluster_state(redshift) == ('available', 2)
+
+
+def test_paused_after_the_load_and_resumed_by_the_next(clients, capacity_config):
+    redshift, s3 = clients
+    put_data(s3, 1)
+    capacity_config['CAPACITY']['after_load'] = 'pause'
+
+    report = capacity_scheduler.run_with_capacity(redshift, s3, capacity_config, lambda: None)
+    assert report['after_load'] == 'paused'
+    assert cluster_state(redshift)[0] == 'paused'
+
+    during_run = []
+    capacity_scheduler.run_with_capacity(redshift, s3, capacity_config,
+                                         lambda: during_run.append(cluster_state(redshift)))
+    assert during_run == [('available', 2)]
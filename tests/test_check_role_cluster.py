@@ -0,0 +1,127 @@
+"""
+Tests of check_role_cluster.ClusterState against a moto Redshift: a single describe_clusters snapshot serves
+every attribute until its ttl expires. wait_for_cluster polls with a growing delay until the cluster is available or
+the timeout is reached, time.sleep being replaced so that the tests don't wait.
+"""
+import boto3
+import pytest
+
+import check_role_cluster as crc
+from conftest import REGION
+
+CLUSTER_NAME = 'cl-sparkify'
+
+
+class CountingClient:
+    """
+    Redshift client 'client' (botocore.client.Redshift object) counting its describe_clusters calls.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.describe_calls = 0
+
+    def describe_clusters(self, **kwargs):
+        self.describe_calls += 1
+        return self.client.describe_clusters(**kwargs)
+
+
+@pytest.fixture
+def redshift(aws):
+    return CountingClient(boto3.client('redshift', region_name=REGION))
+
+
+def create_cluster(redshift):
+    redshift.client.create_cluster(ClusterIdentifier=CLUSTER_NAME, NodeType='dc2.large', MasterUsername='cl_user',
+                                   MasterUserPassword='Passw0rd', DBName='sparkify', ClusterType='single-node')
+
+
+def test_missing_cluster(redshift):
+    state = crc.ClusterState(redshift, CLUSTER_NAME)
+
+    assert not state.exists
+    assert state.status is None
+    assert state.endpoint is None
+    assert state.create_time is None
+    assert redshift.describe_calls == 1
+
+
+def test_attributes_are_read_from_one_snapshot(redshift):
+    create_cluster(redshift)
+    state = crc.ClusterState(redshift, CLUSTER_NAME)
+
+    assert state.exists
+    assert state.status == 'available'
+    assert state.endpoint.startswith(CLUSTER_NAME)
+    assert state.create_time is not None
+    assert state.details['DBName'] == 'sparkify'
+    assert redshift.describe_calls == 1
+
+
+def test_snapshot_is_kept_until_refreshed(redshift):
+    create_cluster(redshift)
+    state = crc.ClusterState(redshift, CLUSTER_NAME, ttl=3600)
+    assert state.exists
+    redshift.client.delete_cluster(ClusterIdentifier=CLUSTER_NAME, SkipFinalClusterSnapshot=True)
+
+    assert state.exists
+    assert state.refresh() is None
+    assert not state.exists
+    assert redshift.describe_calls == 2
+
+
+def test_expired_snapshot_is_taken_again(redshift):
+    create_cluster(redshift)
+    state = crc.ClusterState(redshift, CLUSTER_NAME, ttl=0)
+
+    state.details
+    state.details
+    assert redshift.describe_calls == 2
+
+
+def test_check_functions(redshift, capsys):
+    assert crc.check_cluster_status(redshift.client, CLUSTER_NAME) == 1
+    assert crc.is_cluster_available(redshift.client, CLUSTER_NAME) == 1
+    create_cluster(redshift)
+
+    assert crc.check_cluster_exists(redshift.client, CLUSTER_NAME, details=True)
+    assert f"Cluster {CLUSTER_NAME} exists" in capsys.readouterr().out
+    assert crc.is_cluster_available(redshift.client, CLUSTER_NAME) is True
+    assert crc.check_cluster_status(redshift.client, CLUSTER_NAME) == 'available'
+
+
+def test_wait_for_an_available_cluster_does_not_sleep(redshift, monkeypatch):
+    create_cluster(redshift)
+    sleeps = []
+    monkeypatch.setattr(crc.time, 'sleep', sleeps.append)
+
+    assert crc.wait_for_cluster(crc.ClusterState(redshift, CLUSTER_NAME), timeout=60) == 'available'
+    assert sleeps == []
+
+
+def test_wait_for_cluster_backs_off_until_available(redshift, monkeypatch, capsys):
+    create_cluster(redshift)
+    redshift.client.pause_cluster(ClusterIdentifier=CLUSTER_NAME)
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 4:
+            redshift.client.resume_cluster(ClusterIdentifier=CLUSTER_NAME)
+
+    monkeypatch.setattr(crc.time, 'sleep', sleep)
+
+    status = crc.wait_for_cluster(crc.ClusterState(redshift, CLUSTER_NAME), timeout=600, initial_delay=1.0,
+                                  max_delay=4.0)
+
+    assert status == 'available'
+    assert "cluster status: available" in capsys.readouterr().out
+    # The delay doubles up to max_delay, each sleep being jittered by +/- 50%:
+    assert len(sleeps) == 4
+    for seconds, delay in zip(sleeps, [1.0, 2.0, 4.0, 4.0]):
+        assert 0.5 * delay <= seconds <= 1.5 * delay
+
+
+def test_wait_for_cluster_times_out(redshift, monkeypatch):
+    monkeypatch.setattr(crc.time, 'sleep', lambda seconds: None)
+
+    assert crc.wait_for_cluster(crc.ClusterState(redshift, CLUSTER_NAME), timeout=0) is None
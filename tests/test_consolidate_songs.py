@@ -0,0 +1,86 @@
+"""
+Tests of consolidate_songs.py against a moto S3: the song files are packed, whole and in key order, into objects
+closed as soon as they reach the target size, and a rerun only consolidates the files missing from the index.
+"""
+import json
+
+import boto3
+import pytest
+
+import consolidate_songs
+from conftest import REGION
+
+SOURCE_BUCKET = 'sparkify-input'
+OUTPUT_BUCKET = 'sparkify-etl'
+INDEX_KEY = 'consolidation/song_data.index.json'
+
+
+@pytest.fixture
+def s3(aws):
+    client = boto3.client('s3', region_name=REGION)
+    for bucket in [SOURCE_BUCKET, OUTPUT_BUCKET]:
+        client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': REGION})
+    return client
+
+
+def put_song(s3, song_id, size):
+    """
+    Writes the song file of 'song_id' (string) under song_data/<A>/<B>/, a JSON record of 'size' (int) bytes
+    without a trailing newline.
+    """
+    record = json.dumps({'song_id': song_id, 'title': ''})
+    record = json.dumps({'song_id': song_id, 'title': 'x' * (size - len(record))})
+    s3.put_object(Bucket=SOURCE_BUCKET, Key=f"song_data/{song_id[2]}/{song_id[3]}/{song_id}.json",
+                  Body=record.encode('utf-8'))
+
+
+def run_consolidate(s3, target_bytes):
+    return consolidate_songs.consolidate(consolidate_songs.S3Store(s3, SOURCE_BUCKET), 'song_data',
+                                         consolidate_songs.S3Store(s3, OUTPUT_BUCKET), 'song_data_consolidated',
+                                         INDEX_KEY, target_bytes, workers=2)
+
+
+def read_object(s3, key):
+    return [json.loads(line) for line in
+            s3.get_object(Bucket=OUTPUT_BUCKET, Key=key)['Body'].read().decode('utf-8').splitlines()]
+
+
+def test_files_are_packed_to_the_target_size(s3):
+    for song_id in ['SOAA1', 'SOAB2', 'SOBA3', 'SOBB4', 'SOCA5']:
+        put_song(s3, song_id, 100)
+
+    summary = run_consolidate(s3, 250)
+
+    assert summary == {'files': 5, 'consolidated': 5, 'objects': 2, 'bytes': 505}
+    index = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key=INDEX_KEY)['Body'].read())
+    # A batch is closed once it reaches 250 bytes, i.e. after its third file:
+    assert {key: [source.rsplit('/', 1)[1] for source in item['sources']]
+            for key, item in index['objects'].items()} == \
+        {'song_data_consolidated/songs-part00000.json': ['SOAA1.json', 'SOAB2.json', 'SOBA3.json'],
+         'song_data_consolidated/songs-part00001.json': ['SOBB4.json', 'SOCA5.json']}
+    # One record per line, a newline being added after each file:
+    assert [record['song_id'] for record in read_object(s3, 'song_data_consolidated/songs-part00000.json')] == \
+        ['SOAA1', 'SOAB2', 'SOBA3']
+
+
+def test_rerun_only_consolidates_the_new_files(s3):
+    for song_id in ['SOAA1', 'SOAB2']:
+        put_song(s3, song_id, 100)
+    run_consolidate(s3, 1000)
+    put_song(s3, 'SOCA3', 100)
+
+    summary = run_consolidate(s3, 1000)
+
+    assert summary == {'files': 3, 'consolidated': 1, 'objects': 1, 'bytes': 101}
+    assert [record['song_id'] for record in read_object(s3, 'song_data_consolidated/songs-part00001.json')] == \
+        ['SOCA3']
+    assert run_consolidate(s3, 1000)['consolidated'] == 0
+
+
+def test_exists_matches_the_whole_key(s3):
+    store = consolidate_songs.S3Store(s3, OUTPUT_BUCKET)
+    s3.put_object(Bucket=OUTPUT_BUCKET, Key=f"{INDEX_KEY}.bak", Body=b'{}')
+
+    assert not store.exists(INDEX_KEY)
+    assert consolidate_songs.load_index(store, INDEX_KEY) == {'objects': {}}
+    assert store.exists(f"{INDEX_KEY}.bak")
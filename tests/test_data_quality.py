@@ -0,0 +1,49 @@
+"""
+Tests of the data quality checks on the local DuckDB backend (see local_backend.py): the star schema loaded from
+a generated dataset with duplicated songs and log lines must pass every check of data_quality.CHECKS, and
+loading the same staging rows again must not add songs or timestamps, nor, through the incremental merges (as
+the first incremental load after a full load does, the ledger being empty), songplays.
+"""
+import os
+
+import pytest
+
+import data_generator
+import data_quality
+import local_backend
+import sql_queries
+
+
+@pytest.fixture
+def loaded_backend(tmp_path):
+    data_generator.generate_dataset(str(tmp_path), 4000, duplicate_rate=0.05, seed=4000)
+    backend = local_backend.DuckDbBackend()
+    local_backend.run_pipeline(backend, os.path.join(tmp_path, 'log_data'), os.path.join(tmp_path, 'song_data'))
+    yield backend
+    backend.close()
+
+
+def test_every_check_passes(loaded_backend, config):
+    results = data_quality.run_checks(loaded_backend.execute, data_quality.get_quality_settings(config))
+
+    assert [result for result in results if not result['passed']] == []
+
+
+def test_songs_and_time_are_not_added_again(loaded_backend):
+    counts = {table: loaded_backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0] for table in ['songs', 'time']}
+
+    for query in [sql_queries.song_table_insert, sql_queries.time_table_insert]:
+        loaded_backend.execute(query)
+
+    assert {table: loaded_backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0] for table in counts} == counts
+
+
+def test_incremental_merge_after_a_full_load_adds_nothing(loaded_backend):
+    tables = ['songplays', 'users', 'songs', 'artists', 'time']
+    counts = {table: loaded_backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0] for table in tables}
+
+    # The staging tables still hold every object of the full load, as if they had been copied again:
+    for node in sql_queries.incremental_merge_nodes:
+        loaded_backend.execute(node['query'])
+
+    assert {table: loaded_backend.execute(f"SELECT COUNT(*) FROM {table};")[0][0] for table in tables} == counts
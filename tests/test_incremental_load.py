@@ -0,0 +1,291 @@
+"""
+Tests of incremental_load.py against a moto S3, the cluster being replaced by FakeCluster: the ledger and the
+staging rows are kept in memory, the COPYs read their manifest and the objects it lists from moto, and each
+connection buffers its writes until it commits, as a transaction would.
+"""
+import json
+import re
+import threading
+from contextlib import contextmanager
+
+import boto3
+import psycopg2 as pg
+import pytest
+
+import incremental_load
+from conftest import REGION
+
+INPUT_BUCKET = 'sparkify-input'
+MANIFEST_BUCKET = 'sparkify-manifests'
+
+
+class FakeCluster:
+    """
+    Committed state of the fake cluster: load_ledger (list of (key, prefix)), staging_events and staging_songs
+    (lists of JSON records) and the number of songplays. Statements containing 'fail_on' (string) fail, and the
+    songplays insert adds 'fan_out' (int) rows per 'NextSong' event.
+    """
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.state = {'load_ledger': [], 'staging_events': [], 'staging_songs': [], 'songplays': 0}
+        self.fail_on = None
+        self.fan_out = 1
+        self.copies = []
+        self.lock = threading.Lock()
+
+    def read_manifest(self, url):
+        """
+        Returns the JSON records of the objects listed by the COPY manifest at S3 url 'url'.
+        """
+        bucket, key = incremental_load.split_s3_url(url)
+        manifest = json.loads(self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        records = []
+        for entry in manifest['entries']:
+            bucket, key = incremental_load.split_s3_url(entry['url'])
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+            records += [json.loads(line) for line in body.splitlines() if line.strip()]
+        return records
+
+
+class FakeCursor:
+    """
+    Cursor of a FakeConnection: runs the statements of incremental_load.py on the state of its cluster, the
+    writes going to the pending changes of the connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.connection = conn
+        self.rows = []
+        self.description = None
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def view(self, table):
+        state, pending = self.conn.cluster.state, self.conn.pending
+        if table == 'songplays':
+            return state['songplays'] + pending.get('songplays', 0)
+        return pending.get(table, state[table]) if table.startswith('staging') else \
+            state[table] + pending.get(table, [])
+
+    def execute(self, query, params=None):
+        query = query.decode('utf-8') if isinstance(query, bytes) else query
+        cluster, pending = self.conn.cluster, self.conn.pending
+        if cluster.fail_on and cluster.fail_on in query:
+            raise pg.ProgrammingError(f"statement failed: {cluster.fail_on}")
+        self.rows, self.description = [], None
+        if 'SELECT s3_key FROM load_ledger' in query:
+            self.rows = [(key,) for key, prefix in self.view('load_ledger') if prefix == params[0]]
+        elif 'INSERT INTO load_ledger' in query:
+            pending.setdefault('load_ledger', []).extend(re.findall(r"\('([^']*)','([^']*)',\d+\)", query))
+        elif query.startswith('TRUNCATE'):
+            # TRUNCATE commits implicitly on Redshift.
+            cluster.state[query.split()[1]] = []
+        elif 'COPY staging_' in query:
+            table = re.search(r"COPY (\w+)", query).group(1)
+            url = re.search(r"FROM '([^']+)'", query).group(1)
+            cluster.copies.append((table, url))
+            pending[table] = self.view(table) + cluster.read_manifest(url)
+        elif 'INSERT INTO songplays' in query:
+            plays = [event for event in self.view('staging_events') if event['page'] == 'NextSong']
+            pending['songplays'] = pending.get('songplays', 0) + len(plays) * cluster.fan_out
+        elif 'SELECT COUNT(*) FROM songplays' in query:
+            self.rows = [(self.view('songplays'),)]
+        elif "SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong'" in query:
+            self.rows = [(len([event for event in self.view('staging_events') if event['page'] == 'NextSong']),)]
+        if self.rows:
+            self.description = [('count',)]
+
+    def mogrify(self, template, args):
+        template = template.decode('utf-8') if isinstance(template, bytes) else template
+        values = tuple("'" + value.replace("'", "''") + "'" if isinstance(value, str) else str(value)
+                       for value in args)
+        return (template % values).encode('utf-8')
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    """
+    psycopg2-like connection to 'cluster' (FakeCluster object), its writes pending until commit().
+    """
+    encoding = 'UTF8'
+    closed = 0
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.pending = {}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        with self.cluster.lock:
+            for table, change in self.pending.items():
+                if table.startswith('staging'):
+                    self.cluster.state[table] = change
+                else:
+                    self.cluster.state[table] += change
+        self.pending = {}
+
+    def rollback(self):
+        self.pending = {}
+
+    def cancel(self):
+        pass
+
+
+class FakeConnections:
+    """
+    Stand-in of ConnectionManager handing out connections to 'cluster' (FakeCluster object).
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def getconn(self):
+        return FakeConnection(self.cluster)
+
+    def schema_statements(self):
+        # The fake cluster has a single schema, with no readers to grant.
+        return []
+
+    def grant_statements(self, schema=None):
+        return []
+
+    def putconn(self, conn, close=False):
+        conn.rollback()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+
+def put_log(s3_client, key, pages):
+    """
+    Writes a log object 'key' under the LOG_DATA prefix with one event per page of 'pages' (list of strings).
+    """
+    events = [{'page': page, 'ts': 1541000000000 + index, 'userId': '1'} for index, page in enumerate(pages)]
+    s3_client.put_object(Bucket=INPUT_BUCKET, Key=f"log_data/{key}",
+                         Body='\n'.join(json.dumps(event) for event in events).encode('utf-8'))
+
+
+def put_song(s3_client, song_id):
+    """
+    Writes a song object of id 'song_id' under the SONG_DATA prefix.
+    """
+    s3_client.put_object(Bucket=INPUT_BUCKET, Key=f"song_data/{song_id}.json",
+                         Body=json.dumps({'song_id': song_id, 'title': song_id}).encode('utf-8'))
+
+
+@pytest.fixture
+def s3(aws):
+    client = boto3.client('s3', region_name=REGION)
+    for bucket in [INPUT_BUCKET, MANIFEST_BUCKET]:
+        client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': REGION})
+    return client
+
+
+@pytest.fixture
+def incremental_config(config):
+    config['S3']['log_data'] = f"'s3://{INPUT_BUCKET}/log_data'"
+    config['S3']['song_data'] = f"'s3://{INPUT_BUCKET}/song_data'"
+    config['INCREMENTAL']['manifest_prefix'] = f"'s3://{MANIFEST_BUCKET}/manifests'"
+    config['ETL']['retries'] = '0'
+    return config
+
+
+def run_load(s3, cluster, config):
+    connections = FakeConnections(cluster)
+    with connections.connection() as conn:
+        with conn.cursor() as cur:
+            return incremental_load.load_new_objects(s3, cur, conn, connections, config)
+
+
+def ledger_keys(cluster):
+    return sorted(key for key, _ in cluster.state['load_ledger'])
+
+
+def test_list_prefix_skips_folders(s3):
+    put_log(s3, '2018/11/a.json', ['NextSong'])
+    s3.put_object(Bucket=INPUT_BUCKET, Key='log_data/2018/12/', Body=b'')
+
+    objects = incremental_load.list_prefix(s3, f"'s3://{INPUT_BUCKET}/log_data'")
+    assert objects == {'log_data/2018/11/a.json':
+                       s3.head_object(Bucket=INPUT_BUCKET, Key='log_data/2018/11/a.json')['ContentLength']}
+
+
+def test_first_run_loads_every_object(s3, incremental_config):
+    put_log(s3, '2018/11/a.json', ['NextSong', 'Home', 'NextSong'])
+    put_song(s3, 'SOA')
+    cluster = FakeCluster(s3)
+
+    loaded = run_load(s3, cluster, incremental_config)
+
+    assert sorted(loaded.values()) == [1, 1]
+    assert sorted(table for table, _ in cluster.copies) == ['staging_events', 'staging_songs']
+    assert cluster.state['songplays'] == 2
+    assert ledger_keys(cluster) == ['log_data/2018/11/a.json', 'song_data/SOA.json']
+
+
+def test_next_run_loads_only_the_new_objects(s3, incremental_config):
+    put_log(s3, '2018/11/a.json', ['NextSong'])
+    put_song(s3, 'SOA')
+    cluster = FakeCluster(s3)
+    run_load(s3, cluster, incremental_config)
+    cluster.copies.clear()
+    put_log(s3, '2018/11/b.json', ['NextSong', 'NextSong'])
+
+    loaded = run_load(s3, cluster, incremental_config)
+
+    assert loaded == {f"s3://{INPUT_BUCKET}/log_data": 1, f"s3://{INPUT_BUCKET}/song_data": 0}
+    # Only the new log object is listed in the manifest, and no song is copied:
+    assert [table for table, _ in cluster.copies] == ['staging_events']
+    assert [event['page'] for event in cluster.state['staging_events']] == ['NextSong', 'NextSong']
+    assert cluster.state['songplays'] == 3
+    assert ledger_keys(cluster) == ['log_data/2018/11/a.json', 'log_data/2018/11/b.json', 'song_data/SOA.json']
+
+
+def test_nothing_to_load(s3, incremental_config):
+    put_log(s3, '2018/11/a.json', ['NextSong'])
+    cluster = FakeCluster(s3)
+    run_load(s3, cluster, incremental_config)
+    cluster.copies.clear()
+
+    assert sum(run_load(s3, cluster, incremental_config).values()) == 0
+    assert cluster.copies == []
+
+
+@pytest.mark.parametrize('failure', ['merge', 'row_count_check'])
+def test_failed_merge_records_nothing_and_is_loaded_again(s3, incremental_config, failure):
+    put_log(s3, '2018/11/a.json', ['NextSong', 'NextSong'])
+    put_song(s3, 'SOA')
+    cluster = FakeCluster(s3)
+    if failure == 'merge':
+        # The last merge node fails, once songplays and time have been appended:
+        cluster.fail_on = 'agg_daily_song_plays'
+        error = pg.ProgrammingError
+    else:
+        cluster.fan_out = 2
+        error = ValueError
+
+    with pytest.raises(error):
+        run_load(s3, cluster, incremental_config)
+    assert cluster.state['songplays'] == 0
+    assert cluster.state['load_ledger'] == []
+
+    cluster.fail_on, cluster.fan_out = None, 1
+    run_load(s3, cluster, incremental_config)
+    assert cluster.state['songplays'] == 2
+    assert ledger_keys(cluster) == ['log_data/2018/11/a.json', 'song_data/SOA.json']
@@ -0,0 +1,139 @@
+"""
+Tests of maintenance.py: on the local DuckDB backend (see local_backend.py) through LocalTableHealth, only the
+tables over the staleness threshold are analyzed, the worst first, and no action starts once the time budget
+is spent; RedshiftTableHealth runs the VACUUM and ANALYZE statements of sql_queries.py on a recording connection.
+"""
+import pytest
+
+import local_backend
+import maintenance
+from sql_queries import create_table_queries
+
+
+class RecordingBackend:
+    """
+    Local backend 'backend' (DuckDbBackend object) recording the statements it executes.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.statements = []
+
+    def execute(self, query):
+        self.statements.append(' '.join(query.split()))
+        return self.backend.execute(query)
+
+
+class RecordingCursor:
+    """
+    Cursor of a RecordingConnection: records the statements, returns no rows.
+    """
+    def __init__(self, statements):
+        self.statements = statements
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.statements.append(' '.join(query.split()))
+
+
+class RecordingConnection:
+    """
+    psycopg2-like connection recording the statements run on its cursors in 'statements' (list of strings).
+    """
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return RecordingCursor(self.statements)
+
+
+@pytest.fixture
+def backend():
+    duckdb_backend = local_backend.DuckDbBackend()
+    for query in create_table_queries:
+        duckdb_backend.execute(query)
+    duckdb_backend.execute("INSERT INTO users VALUES (1, 'Lily', 'Koch', 'F', 'paid', 1541000000000);")
+    duckdb_backend.execute("INSERT INTO users VALUES (2, 'Ryan', 'Smith', 'M', 'free', 1541000000000);")
+    duckdb_backend.execute("INSERT INTO time VALUES ('2018-10-31 15:33:20', 15, 31, 44, 10, 2018, 3);")
+    yield RecordingBackend(duckdb_backend)
+    duckdb_backend.close()
+
+
+@pytest.fixture
+def settings(config):
+    return maintenance.get_maintenance_settings(config)
+
+
+def analyzed(actions):
+    return [action['table'] for action in actions if action['status'] == 'done']
+
+
+def test_only_the_stale_tables_are_analyzed(backend, settings):
+    health = maintenance.LocalTableHealth(backend)
+    tables = ['users', 'time', 'songs']
+
+    # Never analyzed: every table with rows is over the threshold, the empty ones are healthy.
+    first = maintenance.run_maintenance(health, settings, tables)
+    assert sorted(analyzed(first['actions'])) == ['time', 'users']
+    assert first['after']['users']['stats_off'] == 0.0
+
+    second = maintenance.run_maintenance(health, settings, tables)
+    assert second['actions'] == []
+
+    # One row more out of three is a 33% change, over the 10% threshold:
+    backend.execute("INSERT INTO users VALUES (3, 'Ava', 'Fox', 'F', 'free', 1541000000000);")
+    third = maintenance.run_maintenance(health, settings, tables)
+    assert analyzed(third['actions']) == ['users']
+    assert third['actions'][0]['reason'] == "stats_off 33.3% > 10.0%"
+
+
+def test_no_action_starts_over_the_time_budget(backend, settings):
+    settings['time_budget'] = 0
+
+    result = maintenance.run_maintenance(maintenance.LocalTableHealth(backend), settings, ['users', 'time'])
+
+    assert [action['status'] for action in result['actions']] == ['over budget', 'over budget']
+    assert not any(statement.startswith('ANALYZE') for statement in backend.statements)
+
+
+def test_local_health_runs_analyze_only(backend, settings):
+    maintenance.run_maintenance(maintenance.LocalTableHealth(backend), settings, ['users'])
+
+    assert [statement for statement in backend.statements if not statement.startswith('SELECT')] == \
+        ['ANALYZE users;']
+
+
+def test_plan_puts_the_worst_table_first(settings):
+    health = {'songplays': {'rows': 100, 'stats_off': 20.0, 'unsorted': 50.0, 'deleted': 0.0},
+              'users': {'rows': 100, 'stats_off': 90.0, 'unsorted': 0.0, 'deleted': 15.0},
+              'time': {'rows': 100, 'stats_off': 5.0, 'unsorted': 5.0, 'deleted': 5.0},
+              'songs': {'rows': 0, 'stats_off': 100.0, 'unsorted': 100.0, 'deleted': 100.0}}
+
+    plan = maintenance.plan_maintenance(health, settings)
+
+    assert [(action['table'], action['action']) for action in plan] == \
+        [('users', 'delete'), ('users', 'analyze'), ('songplays', 'sort'), ('songplays', 'analyze')]
+
+
+def test_redshift_statements(settings):
+    conn = RecordingConnection()
+    tables_health = maintenance.RedshiftTableHealth(conn)
+    settings['max_unsorted'] = 5.0
+
+    for action in maintenance.ACTIONS:
+        tables_health.run(action, 'songplays', settings)
+
+    assert conn.statements == ['VACUUM DELETE ONLY songplays;', 'VACUUM SORT ONLY songplays TO 95 PERCENT;',
+                               'ANALYZE songplays;']
+
+
+def test_thresholds_must_be_percentages(config):
+    config['MAINTENANCE']['max_unsorted'] = '100'
+
+    with pytest.raises(ValueError):
+        maintenance.get_maintenance_settings(config)
@@ -0,0 +1,56 @@
+"""
+Tests of plan_guard.py on Redshift EXPLAIN texts: only a change of the shape of a plan regresses, a cost growing
+with the rows doesn't, and a cost growing faster than the rows only warns.
+"""
+import plan_guard
+
+BASELINE_PLAN = """XN Hash Join DS_DIST_NONE  (cost=0.12..{cost} rows={rows} width=86)
+  Hash Cond: ("outer".song_key = "inner".song_key)
+  ->  XN Seq Scan on songplays sp  (cost=0.00..{cost} rows={rows} width=40)
+  ->  XN Hash  (cost=0.10..0.10 rows=10 width=46)
+        ->  XN Seq Scan on songs s  (cost=0.00..0.10 rows=10 width=46)"""
+
+
+def plan(cost, rows, distribution='DS_DIST_NONE'):
+    text = BASELINE_PLAN.format(cost=cost, rows=rows).replace('DS_DIST_NONE', distribution)
+    return {'tree': plan_guard.parse_redshift_plan(text.splitlines())}
+
+
+def test_parse_redshift_plan():
+    tree = plan(100.0, 1000)['tree']
+
+    assert (tree['operator'], tree['distribution'], tree['cost'], tree['rows']) == ('Hash Join', 'DS_DIST_NONE',
+                                                                                    100.0, 1000)
+    assert [child['relation'] for child in tree['children']] == ['songplays', None]
+    assert tree['children'][1]['children'][0]['relation'] == 'songs'
+
+
+def test_cost_growing_with_the_rows_is_accepted():
+    assert plan_guard.compare_plans(plan(100.0, 1000), plan(1000.0, 10000), 2.0) == ([], [])
+
+
+def test_cost_growing_faster_than_the_rows_warns():
+    findings, warnings = plan_guard.compare_plans(plan(100.0, 1000), plan(1000.0, 1000), 2.0)
+
+    assert findings == []
+    assert len(warnings) == 1 and warnings[0].startswith("cost 100.00 -> 1000.00")
+
+
+def test_new_redistribution_regresses():
+    findings, warnings = plan_guard.compare_plans(plan(100.0, 1000), plan(100.0, 1000, 'DS_DIST_BOTH'), 2.0)
+
+    assert findings == ["new Hash Join DS_DIST_BOTH over songplays, songs"]
+    assert warnings == []
+
+
+def test_only_regressions_fail_the_guard():
+    baselines = {'insert_songplays:0': plan(100.0, 1000), 'insert_songs:0': plan(100.0, 1000)}
+    plans = {'insert_songplays:0': plan(1000.0, 1000), 'insert_songs:0': plan(100.0, 1000, 'DS_BCAST_INNER'),
+             'insert_time:0': plan(10.0, 10)}
+
+    findings, warnings, new_baselines = plan_guard.guard_plans(plans, baselines, 2.0)
+
+    assert list(findings) == ['insert_songs:0']
+    assert list(warnings) == ['insert_songplays:0']
+    assert set(new_baselines) == set(plans)
+    assert new_baselines['insert_songs:0'] == baselines['insert_songs:0']
@@ -0,0 +1,147 @@
+"""
+Tests of provisioning.py against a moto IAM and Redshift: the role and cluster are created, restored from a
+snapshot or left alone, and wait_until_available returns the endpoint once the 'cluster_available' waiter, or the
+backoff waiter of check_role_cluster.wait_for_cluster, succeeds.
+"""
+import json
+
+import boto3
+import botocore.exceptions
+import pytest
+
+import provisioning
+from conftest import REGION
+
+
+@pytest.fixture
+def managed_policies(monkeypatch):
+    """
+    Makes moto load the AWS managed IAM policies, so that AmazonS3ReadOnlyAccess can be attached.
+    """
+    monkeypatch.setenv('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+
+
+@pytest.fixture
+def clients(managed_policies, aws):
+    return boto3.client('iam', region_name=REGION), boto3.client('redshift', region_name=REGION)
+
+
+@pytest.fixture
+def provisioning_config(config):
+    config['CLUSTER']['cl_type'] = 'single-node'
+    config['PROVISIONING']['snapshot_identifier'] = ''
+    config['PROVISIONING']['waiter_delay'] = '1'
+    config['PROVISIONING']['waiter_max_attempts'] = '2'
+    config['EXPORT']['output'] = "'s3://sparkify-etl/export'"
+    return config
+
+
+def attached_policies(iam, config):
+    role_name = config.get('IAM_ROLE', 'iam_role_name')
+    return [policy['PolicyArn']
+            for policy in iam.list_attached_role_policies(RoleName=role_name)['AttachedPolicies']]
+
+
+def test_wait_until_available_returns_the_endpoint(clients, provisioning_config):
+    iam, redshift = clients
+    provisioning.provision(iam, redshift, provisioning_config, wait=False)
+    cluster_name = provisioning_config.get('CLUSTER', 'cl_identifier')
+
+    endpoint = provisioning.wait_until_available(redshift, cluster_name, delay=1, max_attempts=2)
+
+    cluster = redshift.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
+    assert endpoint == cluster['Endpoint']['Address']
+
+
+def test_wait_until_available_fails_on_a_missing_cluster(clients):
+    _, redshift = clients
+
+    with pytest.raises(botocore.exceptions.WaiterError):
+        provisioning.wait_until_available(redshift, 'missing-cluster', delay=1, max_attempts=1)
+
+
+def test_backoff_waiter_returns_the_endpoint(clients, provisioning_config):
+    iam, redshift = clients
+    provisioning_config['PROVISIONING']['waiter'] = 'backoff'
+
+    result = provisioning.provision(iam, redshift, provisioning_config)
+
+    cluster_name = provisioning_config.get('CLUSTER', 'cl_identifier')
+    cluster = redshift.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
+    assert result['endpoint'] == cluster['Endpoint']['Address']
+
+
+def test_backoff_waiter_fails_on_a_missing_cluster(aws):
+    redshift = boto3.client('redshift', region_name=REGION)
+
+    with pytest.raises(botocore.exceptions.WaiterError):
+        provisioning.wait_until_available(redshift, 'missing-cluster', delay=0, max_attempts=1, waiter='backoff')
+
+
+def test_unknown_waiter_is_rejected(config):
+    config['PROVISIONING']['waiter'] = 'spin'
+
+    with pytest.raises(ValueError):
+        provisioning.get_waiter_settings(config)
+
+
+def test_provision_creates_the_role_and_the_cluster(clients, provisioning_config):
+    iam, redshift = clients
+
+    result = provisioning.provision(iam, redshift, provisioning_config)
+
+    assert result['cluster'] == 'created'
+    role_name = provisioning_config.get('IAM_ROLE', 'iam_role_name')
+    assert result['role_arn'] == iam.get_role(RoleName=role_name)['Role']['Arn']
+    assert result['endpoint']
+    assert provisioning.S3_READ_POLICY_ARN in attached_policies(iam, provisioning_config)
+    assert {'concurrent_checks', 'launch_cluster', 'wait_available', 'total'} <= set(result['timings'])
+
+
+def test_provision_keeps_an_existing_cluster(clients, provisioning_config):
+    iam, redshift = clients
+    first = provisioning.provision(iam, redshift, provisioning_config)
+
+    second = provisioning.provision(iam, redshift, provisioning_config, wait=False)
+
+    assert second['cluster'] == 'existing'
+    assert second['role_arn'] == first['role_arn']
+    assert second['endpoint'] == first['endpoint']
+    assert 'launch_cluster' not in second['timings']
+
+
+def test_provision_restores_the_latest_snapshot(clients, provisioning_config):
+    iam, redshift = clients
+    cluster_name = provisioning_config.get('CLUSTER', 'cl_identifier')
+    provisioning.provision(iam, redshift, provisioning_config)
+    redshift.delete_cluster(ClusterIdentifier=cluster_name, SkipFinalClusterSnapshot=False,
+                            FinalClusterSnapshotIdentifier='sparkify-final')
+    provisioning_config['PROVISIONING']['snapshot_identifier'] = 'latest'
+
+    assert provisioning.find_snapshot(redshift, cluster_name, 'latest') == 'sparkify-final'
+    result = provisioning.provision(iam, redshift, provisioning_config)
+
+    assert result['cluster'] == 'restored'
+    assert result['endpoint']
+
+
+def test_role_can_only_write_under_the_export_prefix(clients, provisioning_config):
+    iam, redshift = clients
+    role_name = provisioning_config.get('IAM_ROLE', 'iam_role_name')
+
+    provisioning.provision(iam, redshift, provisioning_config, wait=False)
+
+    document = iam.get_role_policy(RoleName=role_name, PolicyName=provisioning.EXPORT_POLICY_NAME)['PolicyDocument']
+    document = json.loads(document) if isinstance(document, str) else document
+    writes = [statement for statement in document['Statement'] if 's3:PutObject' in statement['Action']]
+    assert [statement['Resource'] for statement in writes] == [['arn:aws:s3:::sparkify-etl/export/*']]
+
+
+def test_no_export_policy_without_export_output(clients, provisioning_config):
+    iam, redshift = clients
+    provisioning_config['EXPORT']['output'] = ''
+
+    provisioning.provision(iam, redshift, provisioning_config, wait=False)
+
+    role_name = provisioning_config.get('IAM_ROLE', 'iam_role_name')
+    assert iam.list_role_policies(RoleName=role_name)['PolicyNames'] == []
@@ -0,0 +1,78 @@
+"""
+Regression test of songplay_table_insert on the local backends (see local_backend.py): at several data sizes,
+the pipeline must give exactly one songplay per 'NextSong' log line playing a song of the song data (matched on
+title, artist and duration), and the insert must scale linearly, not quadratically as the former self-join did.
+The row counts and runtimes are printed (pytest -s).
+The Postgres backend runs against the database of environment variable SPARKIFY_TEST_PG_DSN (a libpq
+connection string), whose tables are dropped: it is skipped if the variable isn't set.
+"""
+import os
+
+import pytest
+
+import data_generator
+import local_backend
+
+SIZES = [2000, 8000, 32000]
+# Largest accepted growth of the insert time, relative to the growth of the data (linear) and in absolute terms
+# (timing noise on the smallest sizes):
+LINEAR_MARGIN = 4
+NOISE_SECONDS = 1.0
+
+
+@pytest.fixture(scope='module')
+def datasets(tmp_path_factory):
+    """
+    Returns a dictionary mapping each size of SIZES to the directory of a dataset of that many events, with
+    duplicated songs and log lines.
+    """
+    directories = {}
+    for size in SIZES:
+        directory = str(tmp_path_factory.mktemp(f"events-{size}"))
+        data_generator.generate_dataset(directory, size, duplicate_rate=0.05, seed=size)
+        directories[size] = directory
+    return directories
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request):
+    if request.param == 'duckdb':
+        backend = local_backend.DuckDbBackend()
+    else:
+        dsn = os.environ.get('SPARKIFY_TEST_PG_DSN')
+        if not dsn:
+            pytest.skip("SPARKIFY_TEST_PG_DSN is not set.")
+        backend = local_backend.PostgresBackend(dsn)
+    yield backend
+    backend.close()
+
+
+def expected_songplays(directory):
+    """
+    Returns the number of 'NextSong' log lines of the dataset under 'directory' playing a song of its song data,
+    and the number of 'NextSong' log lines.
+    """
+    songs = {(song['title'], song['artist_name'], song['duration'])
+             for song in local_backend.read_json_records(os.path.join(directory, 'song_data'))}
+    plays = [event for event in local_backend.read_json_records(os.path.join(directory, 'log_data'))
+             if event['page'] == 'NextSong']
+    return sum((event['song'], event['artist'], event['length']) in songs for event in plays), len(plays)
+
+
+def test_songplays_row_counts_and_runtime(backend, datasets):
+    report = []
+    for size, directory in datasets.items():
+        timings = local_backend.run_pipeline(backend, os.path.join(directory, 'log_data'),
+                                             os.path.join(directory, 'song_data'))
+        songplays = backend.execute("SELECT COUNT(*) FROM songplays;")[0][0]
+        expected, events = expected_songplays(directory)
+        report.append((size, events, songplays, timings['insert_songplays']))
+
+        assert songplays == expected
+        assert songplays <= events
+
+    print(f"\nsongplay_table_insert on {backend.dialect}:")
+    for size, events, songplays, seconds in report:
+        print(f"- {size} events: {songplays} songplays from {events} 'NextSong' events in {seconds:.3f}s")
+    (smallest, _, _, smallest_seconds), (largest, _, _, largest_seconds) = report[0], report[-1]
+    assert largest_seconds <= max(NOISE_SECONDS, LINEAR_MARGIN * largest / smallest * smallest_seconds)
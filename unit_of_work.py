@@ -0,0 +1,150 @@
+"""
+This module runs the statements of a stage as one unit of work: a single transaction committed once,
+instead of one commit per statement. A failure part-way through rolls the whole stage back, so no table
+is left half-built.
+Transient errors (serialization conflicts, deadlocks, dropped connections) are retried with exponential
+backoff. With savepoints enabled (Postgres), only the failing statement is retried; without (Redshift
+doesn't support savepoints) the whole unit is retried.
+Contains the following functions:
+- get_retry_settings()
+- is_transient_error()
+and the following class:
+- UnitOfWork.
+"""
+import random
+import time
+
+import psycopg2 as pg
+
+import instrumentation
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+# SQLSTATE codes of the errors worth retrying: serialization failure and deadlock.
+TRANSIENT_PGCODES = ['40001', '40P01']
+
+
+def get_retry_settings(config):
+    """
+    Returns the retry settings from section 'ETL' of config (ConfigParser object) as a dictionary
+    of keyword arguments for UnitOfWork: retries, backoff, use_savepoints.
+    """
+    return {
+        'retries': config.getint('ETL', 'retries', fallback=DEFAULT_RETRIES),
+        'backoff': config.getfloat('ETL', 'retry_backoff', fallback=DEFAULT_BACKOFF),
+        'use_savepoints': config.getboolean('ETL', 'use_savepoints', fallback=False),
+    }
+
+
+def is_transient_error(error):
+    """
+    Returns True if 'error' (exception) is worth retrying: a serialization failure, a deadlock,
+    or a dropped connection. Returns False otherwise.
+    """
+    if getattr(error, 'pgcode', None) in TRANSIENT_PGCODES:
+        return True
+    # OperationalError without pgcode, or InterfaceError: the connection to the server has been lost.
+    return isinstance(error, pg.InterfaceError) or \
+        (isinstance(error, pg.OperationalError) and getattr(error, 'pgcode', None) is None)
+
+
+class UnitOfWork:
+    """
+    Runs lists of statements on connection 'conn' (psycopg2 connection), each list in a single transaction.
+    'retries' (int) is the number of retries of a transient error, 'backoff' (float) the initial wait in
+    seconds, doubled at each retry (with jitter). 'use_savepoints' (bool) retries the failing statement only.
+    'connect' (callable returning a new psycopg2 connection, optional) is used to reconnect when the
+    connection drops; without it a dropped connection is not retried.
+    Keeps count of the statements run, commits made and retries, see print_summary().
+    """
+    def __init__(self, conn, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, use_savepoints=False,
+                 connect=None):
+        self.conn = conn
+        self.retries = retries
+        self.backoff = backoff
+        self.use_savepoints = use_savepoints
+        self.connect = connect
+        self.statement_count = 0
+        self.commit_count = 0
+        self.retry_count = 0
+
+    def wait(self, attempt):
+        """
+        Sleeps before retry number 'attempt' (int, starting at 1): exponential backoff with jitter.
+        """
+        delay = self.backoff * 2 ** (attempt - 1)
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def execute(self, cur, query, index, name=None):
+        """
+        Executes 'query' (string), number 'index' (int) of the unit, on cursor 'cur', instrumented under
+        'name' (string, optional, see instrumentation.py).
+        With savepoints, a transient error rolls back to the savepoint and retries the statement only.
+        """
+        if not self.use_savepoints:
+            instrumentation.execute(cur, query, name=name)
+            return
+        attempt = 0
+        while True:
+            cur.execute(f"SAVEPOINT statement_{index}")
+            try:
+                instrumentation.execute(cur, query, name=name)
+            except pg.Error as e:
+                if attempt >= self.retries or not is_transient_error(e) or self.conn.closed:
+                    raise
+                attempt += 1
+                self.retry_count += 1
+                print(f"\033[0;33mTransient error, retrying statement ({attempt}/{self.retries}): {e}\033[0m")
+                cur.execute(f"ROLLBACK TO SAVEPOINT statement_{index}")
+                self.wait(attempt)
+            else:
+                cur.execute(f"RELEASE SAVEPOINT statement_{index}")
+                return
+
+    def run(self, query_list, names=None, before_commit=None):
+        """
+        Runs the statements in query_list (list of strings) in a single transaction and commits once.
+        'names' (list of strings, optional) are the names under which the statements are instrumented.
+        'before_commit' (function taking the cursor, optional) runs after the statements, in the same
+        transaction, e.g. to check their result or record what they loaded.
+        A transient error retries the whole unit (after reconnecting if the connection dropped).
+        Any other error, or too many retries, rolls the transaction back and is raised.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.conn.cursor() as cur:
+                    for index, query in enumerate(query_list):
+                        self.execute(cur, query, index, names[index] if names else None)
+                    if before_commit is not None:
+                        before_commit(cur)
+                self.conn.commit()
+            except pg.Error as e:
+                if not self.conn.closed:
+                    self.conn.rollback()
+                can_reconnect = not self.conn.closed or self.connect is not None
+                if attempt >= self.retries or not is_transient_error(e) or not can_reconnect:
+                    raise
+                attempt += 1
+                self.retry_count += 1
+                print(f"\033[0;33mTransient error, retrying unit of work ({attempt}/{self.retries}): {e}\033[0m")
+                self.wait(attempt)
+                if self.conn.closed:
+                    self.conn = self.connect()
+            except Exception:
+                # e.g. a failed check of before_commit: nothing of the unit is committed.
+                if not self.conn.closed:
+                    self.conn.rollback()
+                raise
+            else:
+                self.statement_count += len(query_list)
+                self.commit_count += 1
+                return
+
+    def print_summary(self):
+        """
+        Prints the number of statements run, commits made and saved (compared to a commit per statement)
+        and retries.
+        """
+        print(f"{self.statement_count} statement(s) run in {self.commit_count} commit(s): "
+              f"{self.statement_count - self.commit_count} commit(s) saved, {self.retry_count} retry(ies).")